@@ -1,77 +1,726 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import MutableHeaders
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
+import sys
+import argparse
+import asyncio
 import logging
 import base64
 import io
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, NamedTuple
 import uuid
+import time
+import re
+import hashlib
+import hmac
+import secrets
+import gzip
+import zlib
+import heapq
+import random
+import importlib.util
+import math
+import wave
+import tempfile
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
+import threading
+import bson
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, timedelta
+from email.utils import format_datetime, parsedate_to_datetime
+import json
+import orjson
+import anyio
 import httpx
+from python_multipart.multipart import MultipartParser, parse_options_header
 class UserMessage:
     def __init__(self, text: str):
         self.text = text
 
 class LlmChat:
-    def __init__(self):
-        pass
+    def __init__(self, api_key=None, session_id=None, system_message=None, chunk_size=None, chunk_delay=None):
+        self.api_key = api_key
+        self.session_id = session_id
+        self.system_message = system_message
+        self.provider = None
+        self.model = None
+        # Chunked streaming mode, so streaming can be exercised offline
+        self.chunk_size = chunk_size or int(os.environ.get('MOCK_LLM_CHUNK_SIZE', '8'))
+        self.chunk_delay = chunk_delay if chunk_delay is not None else float(os.environ.get('MOCK_LLM_CHUNK_DELAY', '0'))
+
+    def with_model(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        return self
 
     def chat(self, message: UserMessage):
         # For now, return a simple mock response
         return {"response": f"Local AI mock reply to: {message.text}"}
-from elevenlabs import ElevenLabs
-from elevenlabs.types import VoiceSettings
+
+    async def send_message(self, message: UserMessage) -> str:
+        # Takes as long as the streamed reply, so overload behaviour can be exercised offline
+        if self.chunk_delay:
+            return "".join([chunk async for chunk in self.stream_message(message)])
+        return self.chat(message)["response"]
+
+    async def stream_message(self, message: UserMessage):
+        text = self.chat(message)["response"]
+        for start in range(0, len(text), self.chunk_size):
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            yield text[start:start + self.chunk_size]
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Metrics settings
+PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED', 'false').lower() == 'true'
+PROFILE_ROUTES = {route for route in os.environ.get('PROFILE_ROUTES', '').split(',') if route}
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.1'))
+PROFILE_INTERVAL_SECONDS = float(os.environ.get('PROFILE_INTERVAL_SECONDS', '0.005'))
+# Bearer token for /metrics, /metrics/profile and the */stats endpoints; unset disables them
+OPS_TOKEN = os.environ.get('OPS_TOKEN')
+
+# HTTP caching and compression settings
+HTTP_COMPRESSION_ENABLED = os.environ.get('HTTP_COMPRESSION_ENABLED', 'true').lower() == 'true'
+HTTP_COMPRESSION_MIN_BYTES = int(os.environ.get('HTTP_COMPRESSION_MIN_BYTES', '1024'))
+HTTP_GZIP_LEVEL = int(os.environ.get('HTTP_GZIP_LEVEL', '6'))
+HTTP_BROTLI_QUALITY = int(os.environ.get('HTTP_BROTLI_QUALITY', '4'))
+HTTP_PRIVATE_CACHE_CONTROL = os.environ.get('HTTP_PRIVATE_CACHE_CONTROL', 'private, no-cache')
+VOICES_CACHE_MAX_AGE_SECONDS = int(os.environ.get('VOICES_CACHE_MAX_AGE_SECONDS', '3600'))
+
+# Metrics
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Fixed-bucket latency histogram; observe() is a bisect and three increments
+
+    Not thread-safe: registry histograms are only observed on the event loop (driver threads
+    go through MongoCommandMetrics).
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class MetricsRegistry:
+    """Labelled histograms and counters rendered in Prometheus text format"""
+
+    def __init__(self):
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = {}
+        self.counters: Dict[str, Dict[tuple, Counter]] = {}
+        self.collectors = []
+        self.render_hooks = []
+        self.help: Dict[str, str] = {}
+
+    def histogram(self, name: str, help_text: str, **labels) -> Histogram:
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+            self.help.setdefault(name, help_text)
+        return histogram
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        counter = series.get(key)
+        if counter is None:
+            counter = series[key] = Counter()
+            self.help.setdefault(name, help_text)
+        return counter
+
+    def add_collector(self, collector):
+        """Register a callable returning [(name, type, help, labels, value)] gauges/counters at scrape time"""
+        self.collectors.append(collector)
+
+    def add_render_hook(self, hook):
+        """Register a callable run before each render, e.g. to publish samples recorded off the loop"""
+        self.render_hooks.append(hook)
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ""
+        escaped = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self) -> str:
+        for hook in self.render_hooks:
+            hook()
+        lines = []
+        for name, series in self.counters.items():
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, counter in series.items():
+                lines.append(f"{name}{self._labels(labels)} {counter.value}")
+        for name, series in self.histograms.items():
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        seen = set()
+        for collector in self.collectors:
+            for name, metric_type, help_text, labels, value in collector():
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name}{self._labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+_stage_histograms: Dict[str, Histogram] = {}
+
+def stage_histogram(stage: str) -> Histogram:
+    histogram = _stage_histograms.get(stage)
+    if histogram is None:
+        histogram = _stage_histograms[stage] = metrics.histogram(
+            "farha_stage_duration_seconds", "Duration of instrumented request stages", stage=stage
+        )
+    return histogram
+
+class Span:
+    """Time a stage of request handling into farha_stage_duration_seconds"""
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, stage: str):
+        self.histogram = stage_histogram(stage)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Records every driver command's duration, so each Mongo operation is timed without wrapping call sites
+
+    The callbacks run on Motor's executor threads, so they observe into histograms of their own
+    under a lock; before each render the loop copies those into the registry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[tuple, Histogram] = {}
+        metrics.add_render_hook(self.publish)
+
+    def _observe(self, command: str, status: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get((command, status))
+            if histogram is None:
+                histogram = self._histograms[(command, status)] = Histogram()
+            histogram.observe(seconds)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._observe(event.command_name, "ok", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self._observe(event.command_name, "error", event.duration_micros / 1e6)
+
+    def publish(self):
+        with self._lock:
+            for (command, status), source in self._histograms.items():
+                target = metrics.histogram(
+                    "farha_mongo_command_duration_seconds", "Duration of MongoDB commands",
+                    command=command, status=status
+                )
+                target.counts, target.sum, target.count = list(source.counts), source.sum, source.count
+
+mongo_command_metrics = MongoCommandMetrics()
+
+class StackSampler:
+    """Opt-in sampling profiler: while a sampled request is in flight, a thread records the
+    event-loop thread's stack every interval and aggregates folded stacks (flamegraph input)"""
+
+    def __init__(self, interval: float, max_stacks: int = 10000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks: Dict[str, int] = {}
+        self.active = 0
+        self.target_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.target_thread = threading.get_ident()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frame = sys._current_frames().get(self.target_thread)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({Path(frame.f_code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            if key in self.stacks or len(self.stacks) < self.max_stacks:
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]))
+
+stack_sampler = StackSampler(PROFILE_INTERVAL_SECONDS) if PROFILE_ENABLED else None
+
+class MetricsMiddleware:
+    """ASGI middleware recording request count and latency by method, route template and status"""
+
+    def __init__(self, app):
+        self.app = app
+        self._series: Dict[tuple, tuple] = {}
+
+    def _record(self, method: str, route: str, status: int, elapsed: float):
+        key = (method, route, status)
+        series = self._series.get(key)
+        if series is None:
+            labels = {"method": method, "route": route, "status": str(status)}
+            series = self._series[key] = (
+                metrics.counter("farha_http_requests_total", "HTTP requests handled", **labels),
+                metrics.histogram(
+                    "farha_http_request_duration_seconds", "HTTP request latency, including streamed bodies", **labels
+                )
+            )
+        series[0].inc()
+        series[1].observe(elapsed)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+        profiled = False
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        if stack_sampler is not None and scope["path"] in PROFILE_ROUTES and random.random() < PROFILE_SAMPLE_RATE:
+            profiled = True
+            stack_sampler.active += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if profiled:
+                stack_sampler.active -= 1
+            route = scope.get("route")
+            self._record(scope["method"], getattr(route, "path", "unmatched"), status, time.perf_counter() - started)
+
+# HTTP compression
+BROTLI_AVAILABLE = importlib.util.find_spec("brotli") is not None
+UNCOMPRESSED_MEDIA_TYPES = ("text/event-stream", "audio/", "image/", "video/", "application/gzip", "application/zstd", "application/octet-stream")
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick br (when brotli is installed) or gzip from an Accept-Encoding header, honouring q-values"""
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip().lower()] = weight
+    wildcard = weights.get("*", 0.0)
+    best = max(["br", "gzip"] if BROTLI_AVAILABLE else ["gzip"], key=lambda coding: weights.get(coding, wildcard))
+    return best if weights.get(best, wildcard) > 0 else None
+
+def http_compressor(encoding: str) -> tuple:
+    """(compress, flush) callables for an incremental br or gzip stream"""
+    if encoding == "br":
+        import brotli
+        compressor = brotli.Compressor(quality=HTTP_BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(HTTP_GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+class CompressionMiddleware:
+    """ASGI middleware compressing response bodies with br or gzip once they pass min_bytes
+
+    Bodies are held back until they cross the threshold, so small responses go out untouched
+    and streamed ones (history pages, exports) are compressed incrementally as they are sent.
+    """
+
+    def __init__(self, app, min_bytes: int = HTTP_COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.min_bytes = min_bytes
+        self._counters: Dict[str, tuple] = {}
+
+    def _record(self, encoding: str, raw: int, compressed: int):
+        counters = self._counters.get(encoding)
+        if counters is None:
+            counters = self._counters[encoding] = (
+                metrics.counter("farha_http_compression_input_bytes_total", "Response bytes before compression", encoding=encoding),
+                metrics.counter("farha_http_compression_output_bytes_total", "Response bytes after compression", encoding=encoding)
+            )
+        counters[0].inc(raw)
+        counters[1].inc(compressed)
+
+    def _compressible(self, message) -> bool:
+        headers = MutableHeaders(raw=message["headers"])
+        if not 200 <= message["status"] < 300 or message["status"] in (204, 206) or "content-encoding" in headers:
+            return False
+        if headers.get("content-type", "").startswith(UNCOMPRESSED_MEDIA_TYPES):
+            return False
+        length = headers.get("content-length")
+        return length is None or int(length) >= self.min_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = None
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                encoding = negotiate_encoding(value.decode("latin-1"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        held: List[bytes] = []
+        held_bytes = 0
+        compress = flush = None
+        raw_bytes = compressed_bytes = 0
+
+        async def send_wrapper(message):
+            nonlocal start, held_bytes, compress, flush, raw_bytes, compressed_bytes
+            if message["type"] == "http.response.start":
+                compressible = self._compressible(message)
+                if compressible or message["status"] in (200, 304):
+                    MutableHeaders(raw=message["headers"]).add_vary_header("Accept-Encoding")
+                if compressible:
+                    start = message
+                    return
+                await send(message)
+                return
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compress is None:
+                held.append(body)
+                held_bytes += len(body)
+                if more_body and held_bytes < self.min_bytes:
+                    return
+                body = b"".join(held)
+                held.clear()
+                if held_bytes < self.min_bytes:
+                    await send(start)
+                    start = None
+                    await send({"type": "http.response.body", "body": body, "more_body": False})
+                    return
+                headers = MutableHeaders(raw=start["headers"])
+                del headers["content-length"]
+                headers["content-encoding"] = encoding
+                compress, flush = http_compressor(encoding)
+                await send(start)
+
+            data = compress(body)
+            if not more_body:
+                data += flush()
+            raw_bytes += len(body)
+            compressed_bytes += len(data)
+            if data or not more_body:
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+            if not more_body:
+                self._record(encoding, raw_bytes, compressed_bytes)
+
+        await self.app(scope, receive, send_wrapper)
+
+# HTTP caching
+def weak_etag(*parts) -> str:
+    """Weak validator over JSON-serializable parts (weak: the body may be sent re-encoded)"""
+    return 'W/"' + hashlib.blake2b(orjson.dumps(parts), digest_size=12).hexdigest() + '"'
+
+def http_cache_headers(etag: str, last_modified: Optional[datetime] = None,
+                       cache_control: str = HTTP_PRIVATE_CACHE_CONTROL) -> Dict[str, str]:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+    return headers
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> bool:
+    """If-None-Match (weak comparison) when present, otherwise If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        opaque = etag.removeprefix("W/")
+        return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+    if_modified_since = request.headers.get("if-modified-since")
+    if not if_modified_since or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return last_modified.replace(microsecond=0) <= since
+
+# Single-flight
+class SingleFlight:
+    """At most one call per key at a time; concurrent callers for the key share its result
+
+    The call runs in its own task and every caller (the first one included) awaits it through
+    asyncio.shield, so a caller that is cancelled (e.g. its client disconnected) only stops
+    waiting: the work and everyone else waiting on it carry on.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Any, asyncio.Task] = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self._tasks
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    async def run(self, key, fn):
+        """Await fn() for key, joining the call already in flight if there is one"""
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.create_task(fn())
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved here so a failure nobody is left waiting for isn't logged as unhandled
+
+# MongoDB connection (created by the lifespan, or connect_database() for CLI use)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+STARTUP_DB_PING_RETRIES = int(os.environ.get('STARTUP_DB_PING_RETRIES', '5'))
+STARTUP_DB_PING_BACKOFF_SECONDS = float(os.environ.get('STARTUP_DB_PING_BACKOFF_SECONDS', '0.5'))
+client: Optional[AsyncIOMotorClient] = None
+db = None
+
+def connect_database():
+    """Create the Motor client once; a client installed beforehand (tests, benchmarks) is kept"""
+    global client, db
+    if client is None:
+        client = AsyncIOMotorClient(
+            os.environ['MONGO_URL'],
+            tz_aware=True,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            event_listeners=[mongo_command_metrics]
+        )
+        db = client[os.environ['DB_NAME']]
+    return db
 
 # Initialize LLM and ElevenLabs clients
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY')
-elevenlabs_client = None  # Will be initialized when API key is provided
+ELEVENLABS_API_KEY = os.environ.get('ELEVENLABS_API_KEY')
+elevenlabs_client = None
 
-# Create the main app
-app = FastAPI(title="F.A.R.H.A AI Assistant")
+def get_elevenlabs_client():
+    """Import the ElevenLabs SDK and build its client on first use"""
+    global elevenlabs_client
+    if elevenlabs_client is None:
+        from elevenlabs import ElevenLabs
+        elevenlabs_client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
+    return elevenlabs_client
+
+# TTS settings
+TTS_BACKEND = os.environ.get('TTS_BACKEND', 'elevenlabs' if ELEVENLABS_API_KEY else 'fake')
+TTS_MODEL_ID = os.environ.get('TTS_MODEL_ID', 'eleven_multilingual_v2')
+TTS_FAKE_LATENCY_SECONDS = float(os.environ.get('TTS_FAKE_LATENCY_SECONDS', '0'))
+TTS_CACHE_DIR = Path(os.environ.get('TTS_CACHE_DIR', str(ROOT_DIR / 'tts_cache')))
+TTS_CACHE_MAX_BYTES = int(os.environ.get('TTS_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# Keys audio URLs; when unset a random secret is generated once and kept in the cache directory
+TTS_CACHE_SECRET = os.environ.get('TTS_CACHE_SECRET')
+TTS_STREAM_CONCURRENCY = int(os.environ.get('TTS_STREAM_CONCURRENCY', '3'))
+TTS_STREAM_MIN_CHUNK_CHARS = int(os.environ.get('TTS_STREAM_MIN_CHUNK_CHARS', '40'))
+
+# STT settings
+STT_BACKEND = os.environ.get('STT_BACKEND', 'elevenlabs' if ELEVENLABS_API_KEY else 'fake')
+STT_MODEL_ID = os.environ.get('STT_MODEL_ID', 'scribe_v1')
+STT_FAKE_LATENCY_SECONDS = float(os.environ.get('STT_FAKE_LATENCY_SECONDS', '0'))
+STT_MAX_UPLOAD_BYTES = int(os.environ.get('STT_MAX_UPLOAD_BYTES', str(25 * 1024 * 1024)))
+STT_UPLOAD_CHUNK_BYTES = int(os.environ.get('STT_UPLOAD_CHUNK_BYTES', str(64 * 1024)))
+STT_SPOOL_MEMORY_BYTES = int(os.environ.get('STT_SPOOL_MEMORY_BYTES', str(1024 * 1024)))
+STT_WORKERS = int(os.environ.get('STT_WORKERS', '4'))
+STT_MAX_PENDING_JOBS = int(os.environ.get('STT_MAX_PENDING_JOBS', '64'))
+STT_JOB_TTL_SECONDS = float(os.environ.get('STT_JOB_TTL_SECONDS', '600'))
+# A job still queued after this long lost its worker (its audio lived in that process) and is reported failed
+STT_JOB_TIMEOUT_SECONDS = float(os.environ.get('STT_JOB_TIMEOUT_SECONDS', '300'))
+
+# Voice WebSocket settings
+VOICE_WS_QUEUE_SIZE = int(os.environ.get('VOICE_WS_QUEUE_SIZE', '32'))
+VOICE_WS_AUTH_TIMEOUT = float(os.environ.get('VOICE_WS_AUTH_TIMEOUT', '10'))
+
+# Auth upstream HTTP client settings
+AUTH_SESSION_DATA_URL = os.environ.get(
+    'AUTH_SESSION_DATA_URL', 'https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data'
+)
+AUTH_HTTP_MAX_CONNECTIONS = int(os.environ.get('AUTH_HTTP_MAX_CONNECTIONS', '100'))
+AUTH_HTTP_MAX_KEEPALIVE = int(os.environ.get('AUTH_HTTP_MAX_KEEPALIVE', '20'))
+AUTH_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('AUTH_HTTP_KEEPALIVE_EXPIRY', '30'))
+AUTH_HTTP_CONNECT_TIMEOUT = float(os.environ.get('AUTH_HTTP_CONNECT_TIMEOUT', '3'))
+AUTH_HTTP_TIMEOUT = float(os.environ.get('AUTH_HTTP_TIMEOUT', '10'))
+AUTH_HTTP_RETRIES = int(os.environ.get('AUTH_HTTP_RETRIES', '2'))
+AUTH_HTTP_BACKOFF_SECONDS = float(os.environ.get('AUTH_HTTP_BACKOFF_SECONDS', '0.2'))
+AUTH_EXCHANGE_CACHE_SECONDS = float(os.environ.get('AUTH_EXCHANGE_CACHE_SECONDS', '30'))
+AUTH_EXCHANGE_CACHE_SIZE = int(os.environ.get('AUTH_EXCHANGE_CACHE_SIZE', '10000'))
+http_client: Optional[httpx.AsyncClient] = None
+
+# API routes; the app itself is created with its lifespan at the bottom of the module
 api_router = APIRouter(prefix="/api")
 
 # Security
 security = HTTPBearer(auto_error=False)
 
+# Conversation context settings
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '2000'))
+CONTEXT_SUMMARY_TOKEN_BUDGET = int(os.environ.get('CONTEXT_SUMMARY_TOKEN_BUDGET', '500'))
+CONTEXT_CACHE_SIZE = int(os.environ.get('CONTEXT_CACHE_SIZE', '1000'))
+CONTEXT_MAX_TURNS = int(os.environ.get('CONTEXT_MAX_TURNS', '50'))
+
+# Response cache settings
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '5000'))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '3600'))
+
+# Chat write-behind settings
+CHAT_WRITE_BEHIND_ENABLED = os.environ.get('CHAT_WRITE_BEHIND_ENABLED', 'false').lower() == 'true'
+CHAT_WRITE_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BATCH_SIZE', '100'))
+CHAT_WRITE_FLUSH_INTERVAL = float(os.environ.get('CHAT_WRITE_FLUSH_INTERVAL', '0.05'))
+CHAT_WRITE_MAX_BUFFERED = int(os.environ.get('CHAT_WRITE_MAX_BUFFERED', '10000'))
+CHAT_WRITE_MAX_RETRIES = int(os.environ.get('CHAT_WRITE_MAX_RETRIES', '5'))
+CHAT_WRITE_RETRY_BACKOFF = float(os.environ.get('CHAT_WRITE_RETRY_BACKOFF', '0.1'))
+
+# LLM admission control settings
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '16'))
+LLM_MAX_QUEUED = int(os.environ.get('LLM_MAX_QUEUED', '200'))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('LLM_QUEUE_TIMEOUT_SECONDS', '30'))
+LLM_USER_RATE_PER_SECOND = float(os.environ.get('LLM_USER_RATE_PER_SECOND', '0.5'))
+LLM_USER_BURST = float(os.environ.get('LLM_USER_BURST', '5'))
+LLM_RATE_LIMIT_USERS = int(os.environ.get('LLM_RATE_LIMIT_USERS', '10000'))
+
+# Chat history paging settings
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get('HISTORY_MAX_PAGE_SIZE', '1000'))
+HISTORY_STREAM_BATCH_SIZE = int(os.environ.get('HISTORY_STREAM_BATCH_SIZE', '200'))
+
+# Chat archive settings
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_INTERVAL_SECONDS = float(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '0'))
+ARCHIVE_COMPRESSION = os.environ.get('ARCHIVE_COMPRESSION', 'zstd')
+ARCHIVE_DECODED_CACHE_SIZE = int(os.environ.get('ARCHIVE_DECODED_CACHE_SIZE', '32'))
+ARCHIVE_WRITE_RETRIES = int(os.environ.get('ARCHIVE_WRITE_RETRIES', '10'))
+
+# Chat export/import settings
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '500'))
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '1000'))
+IMPORT_MAX_LINE_BYTES = int(os.environ.get('IMPORT_MAX_LINE_BYTES', str(1024 * 1024)))
+# Cap on the uncompressed size of one import, and the piece size gzip bodies are inflated in
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', str(256 * 1024 * 1024)))
+IMPORT_READ_CHUNK_BYTES = int(os.environ.get('IMPORT_READ_CHUNK_BYTES', str(64 * 1024)))
+
+# Chat search settings
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')
+SEARCH_MAX_PAGE_SIZE = int(os.environ.get('SEARCH_MAX_PAGE_SIZE', '100'))
+SEARCH_MAX_QUERY_CHARS = int(os.environ.get('SEARCH_MAX_QUERY_CHARS', '256'))
+SEARCH_SNIPPET_CHARS = int(os.environ.get('SEARCH_SNIPPET_CHARS', '160'))
+SEARCH_INDEX_MAX_USERS = int(os.environ.get('SEARCH_INDEX_MAX_USERS', '100'))
+
+# Session cache settings
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL_SECONDS = float(os.environ.get('SESSION_CACHE_TTL_SECONDS', '60'))
+
+# Session lifecycle settings
+SESSION_TTL_DAYS = float(os.environ.get('SESSION_TTL_DAYS', '7'))
+SESSION_TTL_INDEX_ENABLED = os.environ.get('SESSION_TTL_INDEX_ENABLED', 'true').lower() == 'true'
+SESSION_SWEEP_INTERVAL_SECONDS = float(os.environ.get('SESSION_SWEEP_INTERVAL_SECONDS', '0'))
+SESSION_SWEEP_BATCH_SIZE = int(os.environ.get('SESSION_SWEEP_BATCH_SIZE', '1000'))
+SESSION_MAX_PER_USER = int(os.environ.get('SESSION_MAX_PER_USER', '10'))
+SESSION_SLIDING_EXPIRATION = os.environ.get('SESSION_SLIDING_EXPIRATION', 'false').lower() == 'true'
+SESSION_REFRESH_INTERVAL_SECONDS = float(os.environ.get('SESSION_REFRESH_INTERVAL_SECONDS', '3600'))
+
+def utc_now() -> datetime:
+    """The current UTC time at the millisecond precision Mongo stores, so in-memory and stored copies match"""
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
 # Models
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     email: str
     name: str
     picture: Optional[str] = None
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=utc_now)
 
 class ChatMessage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     message: str
     response: str
-    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    timestamp: datetime = Field(default_factory=utc_now)
     is_voice: bool = False
+    conversation_id: Optional[str] = None
 
 class ChatRequest(BaseModel):
     message: str
     is_voice: bool = False
+    conversation_id: Optional[str] = None
+    bypass_cache: bool = False
 
 class ChatResponse(BaseModel):
     response: str
     message_id: str
     timestamp: datetime
+    conversation_id: Optional[str] = None
 
 class TTSRequest(BaseModel):
     text: str
@@ -85,63 +734,408 @@ class TTSResponse(BaseModel):
     audio_url: str
     text: str
     voice_id: str
+    cached: bool = False
 
 class STTResponse(BaseModel):
     transcribed_text: str
     filename: str
 
+class STTJobResponse(BaseModel):
+    job_id: str
+    status: str
+    filename: str
+    transcribed_text: Optional[str] = None
+    error: Optional[str] = None
+
 class AuthSession(BaseModel):
     user_id: str
     session_token: str
     expires_at: datetime
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=utc_now)
 
 # Helper functions
+DATETIME_FIELDS = ('timestamp', 'created_at', 'expires_at')
+
 def prepare_for_mongo(data):
-    """Convert datetime objects to ISO strings for MongoDB storage"""
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if isinstance(value, datetime):
-                data[key] = value.isoformat()
-            elif isinstance(value, dict):
-                data[key] = prepare_for_mongo(value)
+    """Make naive datetimes UTC-aware in place so they are stored as native BSON dates"""
+    for key in DATETIME_FIELDS:
+        value = data.get(key)
+        if value is not None and value.tzinfo is None:
+            data[key] = value.replace(tzinfo=timezone.utc)
     return data
 
 def parse_from_mongo(item):
-    """Parse datetime strings back from MongoDB"""
+    """Parse datetime strings left over from documents stored before the date migration"""
     if isinstance(item, dict):
-        for key, value in item.items():
-            if isinstance(value, str) and key in ['timestamp', 'created_at', 'expires_at']:
+        for key in DATETIME_FIELDS:
+            value = item.get(key)
+            if isinstance(value, str):
                 try:
                     item[key] = datetime.fromisoformat(value.replace('Z', '+00:00'))
-                except:
+                except ValueError:
                     pass
     return item
 
+# Session cache
+class SessionCache:
+    """Bounded LRU + TTL cache of session token -> resolved User"""
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_token: str) -> Optional[User]:
+        entry = self._entries.get(session_token)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        user, deadline, expires_at = entry
+        if time.monotonic() >= deadline or datetime.now(timezone.utc) >= expires_at:
+            del self._entries[session_token]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(session_token)
+        self.hits += 1
+        return user
+
+    def expires_at(self, session_token: str) -> Optional[datetime]:
+        entry = self._entries.get(session_token)
+        return entry[2] if entry else None
+
+    def set(self, session_token: str, user: User, expires_at: datetime):
+        if self.max_size <= 0 or self.ttl_seconds <= 0:
+            return
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+
+        self._entries[session_token] = (user, time.monotonic() + self.ttl_seconds, expires_at)
+        self._entries.move_to_end(session_token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, session_token: str):
+        self._entries.pop(session_token, None)
+
+    def extend(self, session_token: str, expires_at: datetime):
+        entry = self._entries.get(session_token)
+        if entry:
+            self._entries[session_token] = (entry[0], entry[1], expires_at)
+
+    def invalidate_user(self, user_id: str):
+        for token in [t for t, entry in self._entries.items() if entry[0].id == user_id]:
+            del self._entries[token]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL_SECONDS)
+
 # Authentication
+async def require_ops_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Guard for operational endpoints (metrics, profiling, */stats): Bearer OPS_TOKEN"""
+    if not OPS_TOKEN:
+        raise HTTPException(status_code=403, detail="Operational endpoints are disabled; set OPS_TOKEN to enable them")
+    if not credentials or not hmac.compare_digest(credentials.credentials.encode(), OPS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Operations token required", headers={"WWW-Authenticate": "Bearer"})
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     if not credentials:
         raise HTTPException(status_code=401, detail="Authentication required")
     
-    session_token = credentials.credentials
+    return await resolve_session_user(credentials.credentials)
+
+async def resolve_session_user(session_token: str) -> User:
+    """Resolve a session token to its user, via the session cache when possible"""
+    with Span("auth"):
+        return await _resolve_session_user(session_token)
+
+async def _resolve_session_user(session_token: str) -> User:
+    cached_user = session_cache.get(session_token)
+    if cached_user:
+        if SESSION_SLIDING_EXPIRATION:
+            await refresh_session_expiry(session_token, session_cache.expires_at(session_token))
+        return cached_user
     
-    # Check if session exists and is valid
-    session = await db.auth_sessions.find_one({
-        "session_token": session_token,
-        "expires_at": {"$gt": datetime.now(timezone.utc).isoformat()}
-    })
+    # Resolve a valid session and its user in a single round-trip
+    results = await db.auth_sessions.aggregate([
+        {"$match": {
+            "session_token": session_token,
+            "expires_at": {"$gt": datetime.now(timezone.utc)}
+        }},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": "users",
+            "localField": "user_id",
+            "foreignField": "id",
+            "as": "user"
+        }}
+    ]).to_list(1)
     
-    if not session:
+    if not results:
         raise HTTPException(status_code=401, detail="Invalid or expired session")
     
-    # Get user
-    user = await db.users.find_one({"id": session["user_id"]})
-    if not user:
+    session = results[0]
+    if not session["user"]:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return User(**user)
+    current_user = User(**parse_from_mongo(session["user"][0]))
+    session_cache.set(session_token, current_user, session["expires_at"])
+    if SESSION_SLIDING_EXPIRATION:
+        await refresh_session_expiry(session_token, session["expires_at"])
+    
+    return current_user
+
+# Session lifecycle
+sessions_evicted = metrics.counter("farha_sessions_evicted_total", "Sessions evicted by the per-user session cap")
+
+def session_lifetime() -> timedelta:
+    return timedelta(days=SESSION_TTL_DAYS)
+
+async def refresh_session_expiry(session_token: str, expires_at: Optional[datetime]):
+    """Slide a session's expiry forward, writing at most once per SESSION_REFRESH_INTERVAL_SECONDS"""
+    if expires_at is None:
+        return
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    now = utc_now()
+    # The last refresh is implied by the current expiry, so no extra field or read is needed
+    if now - (expires_at - session_lifetime()) < timedelta(seconds=SESSION_REFRESH_INTERVAL_SECONDS):
+        return
+    new_expires_at = now + session_lifetime()
+    try:
+        # Conditional so concurrent requests and workers write once per interval between them
+        await db.auth_sessions.update_one(
+            {"session_token": session_token, "expires_at": {"$lt": new_expires_at - timedelta(seconds=SESSION_REFRESH_INTERVAL_SECONDS)}},
+            {"$set": {"expires_at": new_expires_at}}
+        )
+        session_cache.extend(session_token, new_expires_at)
+    except Exception as e:
+        logger.error(f"Error refreshing session expiry: {str(e)}")
+
+async def enforce_session_cap(user_id: str):
+    """Keep at most SESSION_MAX_PER_USER sessions per user, evicting the oldest"""
+    if SESSION_MAX_PER_USER <= 0:
+        return 0
+    stale = await db.auth_sessions.find(
+        {"user_id": user_id}, {"_id": 0, "session_token": 1}
+    ).sort([("created_at", DESCENDING)]).skip(SESSION_MAX_PER_USER).to_list(None)
+    if not stale:
+        return 0
+    tokens = [session["session_token"] for session in stale]
+    await db.auth_sessions.delete_many({"session_token": {"$in": tokens}})
+    for token in tokens:
+        session_cache.invalidate(token)
+    sessions_evicted.inc(len(tokens))
+    return len(tokens)
+
+class SessionSweeper:
+    """Deletes expired sessions in batches, for deployments that cannot use a TTL index"""
+
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.swept = metrics.counter("farha_sessions_swept_total", "Expired sessions deleted by the sweeper")
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping expired sessions: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self) -> int:
+        """Delete every session expired as of now, one bounded batch at a time"""
+        now = datetime.now(timezone.utc)
+        total = 0
+        while True:
+            expired = await db.auth_sessions.find(
+                {"expires_at": {"$lte": now}}, {"_id": 1, "session_token": 1}
+            ).limit(self.batch_size).to_list(self.batch_size)
+            if not expired:
+                break
+            await db.auth_sessions.delete_many({"_id": {"$in": [session["_id"] for session in expired]}})
+            for session in expired:
+                session_cache.invalidate(session["session_token"])
+            total += len(expired)
+            self.swept.inc(len(expired))
+            if len(expired) < self.batch_size:
+                break
+            # Yield between batches so a large backlog does not monopolize the loop
+            await asyncio.sleep(0)
+        return total
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+session_sweeper = SessionSweeper(
+    SESSION_SWEEP_INTERVAL_SECONDS, SESSION_SWEEP_BATCH_SIZE
+) if SESSION_SWEEP_INTERVAL_SECONDS > 0 else None
+
+# Auth upstream HTTP client
+def create_http_client() -> httpx.AsyncClient:
+    """Build the application-lifetime pooled client for the auth exchange"""
+    return httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=AUTH_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=AUTH_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=AUTH_HTTP_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(AUTH_HTTP_TIMEOUT, connect=AUTH_HTTP_CONNECT_TIMEOUT)
+    )
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = create_http_client()
+    return http_client
+
+async def fetch_auth_session_data(session_id: str) -> httpx.Response:
+    """Exchange a session ID with the auth upstream, retrying transient failures with backoff"""
+    for attempt in range(AUTH_HTTP_RETRIES + 1):
+        try:
+            with Span("auth_exchange"):
+                response = await get_http_client().get(AUTH_SESSION_DATA_URL, headers={"X-Session-ID": session_id})
+            if response.status_code < 500 and response.status_code != 429:
+                return response
+            if attempt == AUTH_HTTP_RETRIES:
+                return response
+        except httpx.TransportError as e:
+            if attempt == AUTH_HTTP_RETRIES:
+                logger.error(f"Auth upstream unreachable: {str(e)}")
+                raise HTTPException(status_code=502, detail="Authentication service unavailable")
+        delay = AUTH_HTTP_BACKOFF_SECONDS * (2 ** attempt)
+        await asyncio.sleep(delay + random.uniform(0, delay))
 
 # Auth endpoints
+class SessionExchangeCoalescer:
+    """Single-flight for session exchanges: concurrent calls for one session_id share one exchange,
+    and finished results are reused for a short TTL (re-renders, refreshes)"""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._inflight = SingleFlight()
+        self._results: "OrderedDict[str, tuple]" = OrderedDict()
+        self.exchanges = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    async def run(self, session_id: str, exchange):
+        entry = self._results.get(session_id)
+        if entry is not None:
+            result, deadline = entry
+            if time.monotonic() < deadline:
+                self.cache_hits += 1
+                return result
+            del self._results[session_id]
+
+        if session_id in self._inflight:
+            self.coalesced += 1
+        # Failures are shared with current waiters but never cached
+        return await self._inflight.run(session_id, lambda: self._exchange(session_id, exchange))
+
+    async def _exchange(self, session_id: str, exchange):
+        self.exchanges += 1
+        result = await exchange(session_id)
+        if self.ttl_seconds > 0:
+            self._results[session_id] = (result, time.monotonic() + self.ttl_seconds)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+        return result
+
+    def invalidate_user(self, user_id: str):
+        for session_id in [key for key, (result, _) in self._results.items() if result["user"]["id"] == user_id]:
+            del self._results[session_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "exchanges": self.exchanges,
+            "coalesced": self.coalesced,
+            "cache_hits": self.cache_hits,
+            "cached": len(self._results),
+            "inflight": len(self._inflight)
+        }
+
+session_exchanges = SessionExchangeCoalescer(AUTH_EXCHANGE_CACHE_SECONDS, AUTH_EXCHANGE_CACHE_SIZE)
+
+async def upsert_user(auth_data: Dict[str, Any]) -> User:
+    """Find or create the user for an email in one atomic upsert"""
+    new_user = User(email=auth_data["email"], name=auth_data["name"], picture=auth_data.get("picture"))
+    on_insert = prepare_for_mongo(new_user.dict())
+    del on_insert["email"]
+    try:
+        document = await db.users.find_one_and_update(
+            {"email": new_user.email},
+            {"$setOnInsert": on_insert},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+            projection={"_id": 0}
+        )
+    except DuplicateKeyError:
+        # Lost an upsert race on the unique email index; the winner's document is there now
+        document = await db.users.find_one({"email": new_user.email}, {"_id": 0})
+    return User(**parse_from_mongo(document))
+
+async def exchange_session(session_id: str) -> Dict[str, Any]:
+    """Exchange a session ID upstream, then upsert the user and the session"""
+    response = await fetch_auth_session_data(session_id)
+
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Invalid session ID")
+
+    auth_data = response.json()
+    user = await upsert_user(auth_data)
+
+    # Create session
+    session_token = auth_data["session_token"]
+    expires_at = utc_now() + session_lifetime()
+
+    auth_session = AuthSession(
+        user_id=user.id,
+        session_token=session_token,
+        expires_at=expires_at
+    )
+
+    session_dict = prepare_for_mongo(auth_session.dict())
+    await db.auth_sessions.update_one(
+        {"session_token": session_token},
+        {"$set": session_dict},
+        upsert=True
+    )
+    await enforce_session_cap(user.id)
+
+    return {
+        "user": user.dict(),
+        "session_token": session_token,
+        "expires_at": expires_at.isoformat()
+    }
+
 @api_router.post("/auth/session")
 async def process_session(session_data: Dict[str, Any]):
     """Process session ID from Emergent Auth"""
@@ -151,50 +1145,7 @@ async def process_session(session_data: Dict[str, Any]):
         if not session_id:
             raise HTTPException(status_code=400, detail="Session ID required")
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-                headers={"X-Session-ID": session_id}
-            )
-            
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Invalid session ID")
-        
-        auth_data = response.json()
-        
-        # Check if user exists
-        existing_user = await db.users.find_one({"email": auth_data["email"]})
-        
-        if existing_user:
-            user = User(**existing_user)
-        else:
-            # Create new user
-            user = User(
-                email=auth_data["email"],
-                name=auth_data["name"],
-                picture=auth_data.get("picture")
-            )
-            user_dict = prepare_for_mongo(user.dict())
-            await db.users.insert_one(user_dict)
-        
-        # Create session
-        session_token = auth_data["session_token"]
-        expires_at = datetime.now(timezone.utc) + timedelta(days=7)
-        
-        auth_session = AuthSession(
-            user_id=user.id,
-            session_token=session_token,
-            expires_at=expires_at
-        )
-        
-        session_dict = prepare_for_mongo(auth_session.dict())
-        await db.auth_sessions.insert_one(session_dict)
-        
-        return {
-            "user": user.dict(),
-            "session_token": session_token,
-            "expires_at": expires_at.isoformat()
-        }
+        return await session_exchanges.run(session_id, exchange_session)
         
     except HTTPException:
         # Re-raise HTTP exceptions (400, 401, etc) as-is
@@ -209,130 +1160,2543 @@ async def logout(current_user: User = Depends(get_current_user)):
     try:
         # Delete all sessions for user
         await db.auth_sessions.delete_many({"user_id": current_user.id})
+        session_cache.invalidate_user(current_user.id)
+        session_exchanges.invalidate_user(current_user.id)
+        conversation_contexts.invalidate_user(current_user.id)
         return {"message": "Logged out successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error logging out: {str(e)}")
 
-# Chat endpoints
-@api_router.post("/chat", response_model=ChatResponse)
-async def chat_with_farha(request: ChatRequest, current_user: User = Depends(get_current_user)):
-    """Chat with F.A.R.H.A AI assistant"""
-    try:
-        # Initialize LLM chat with system message
-        system_message = "You are F.A.R.H.A, a sophisticated AI assistant. You are knowledgeable, helpful, and have a friendly personality. Respond naturally and conversationally."
-        
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"farha_{current_user.id}_{uuid.uuid4()}",
-            system_message=system_message
-        ).with_model("openai", "gpt-5")
-        
-        # Create user message
-        user_message = UserMessage(text=request.message)
-        
-        # Get response from AI
-        ai_response = await chat.send_message(user_message)
-        
-        # Save chat message to database
-        chat_message = ChatMessage(
-            user_id=current_user.id,
-            message=request.message,
-            response=ai_response,
-            is_voice=request.is_voice
-        )
-        
-        chat_dict = prepare_for_mongo(chat_message.dict())
-        await db.chat_messages.insert_one(chat_dict)
-        
-        return ChatResponse(
-            response=ai_response,
-            message_id=chat_message.id,
-            timestamp=chat_message.timestamp
-        )
-        
-    except Exception as e:
-        logger.error(f"Error in chat: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error processing chat: {str(e)}")
+# Chat write-behind buffer
+class ChatWriteBuffer:
+    """Buffers chat_messages documents and writes them with insert_many on size or time thresholds"""
 
-@api_router.get("/chat/history", response_model=List[ChatMessage])
-async def get_chat_history(current_user: User = Depends(get_current_user), limit: int = 50):
-    """Get chat history for current user"""
-    try:
-        messages = await db.chat_messages.find(
-            {"user_id": current_user.id}
-        ).sort("timestamp", -1).limit(limit).to_list(limit)
-        
-        return [ChatMessage(**parse_from_mongo(msg)) for msg in messages]
-        
-    except Exception as e:
-        logger.error(f"Error getting chat history: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error getting chat history: {str(e)}")
+    def __init__(self, batch_size: int, flush_interval: float, max_buffered: int, max_retries: int, retry_backoff: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._queue: List[Dict[str, Any]] = []
+        self._pending: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._capacity = asyncio.Semaphore(max_buffered)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
 
-# Voice endpoints (require ElevenLabs API key setup)
-@api_router.post("/voice/tts", response_model=TTSResponse)
-async def text_to_speech(request: TTSRequest, current_user: User = Depends(get_current_user)):
-    """Convert text to speech using ElevenLabs"""
-    try:
-        # For now, return a mock response since ElevenLabs requires API key setup
-        return TTSResponse(
-            audio_url="data:audio/mpeg;base64,",  # Empty base64 for now
-            text=request.text,
-            voice_id=request.voice_id
-        )
-        
-    except Exception as e:
-        logger.error(f"Error in TTS: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error generating speech: {str(e)}")
+    def start(self):
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
 
-@api_router.post("/voice/stt", response_model=STTResponse)
-async def speech_to_text(audio_file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
-    """Convert speech to text using ElevenLabs"""
-    try:
-        # For now, return a mock response since ElevenLabs requires API key setup
-        return STTResponse(
-            transcribed_text="Hello F.A.R.H.A",  # Mock transcription
-            filename=audio_file.filename or "unknown.audio"
-        )
-        
-    except Exception as e:
-        logger.error(f"Error in STT: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error transcribing audio: {str(e)}")
+    async def add(self, document: Dict[str, Any]):
+        """Queue a document, waiting for room when the buffer is full"""
+        await self._capacity.acquire()
+        # A fixed _id makes retrying an insert the server already applied fail as a duplicate key
+        # (counted as written below) instead of storing the message twice
+        document.setdefault("_id", bson.ObjectId())
+        self._pending.setdefault(document["user_id"], {})[document["id"]] = document
+        self._queue.append(document)
+        self.start()
+        if len(self._queue) == 1 or len(self._queue) >= self.batch_size:
+            self._wakeup.set()
 
-@api_router.get("/voice/voices")
-async def get_available_voices(current_user: User = Depends(get_current_user)):
-    """Get available voices for TTS"""
-    # Mock response for now
-    return {
-        "voices": [
-            {"id": "21m00Tcm4TlvDq8ikWAM", "name": "Rachel", "category": "premade"},
-            {"id": "AZnzlk1XvdvUeBnXmlld", "name": "Domi", "category": "premade"},
-            {"id": "EXAVITQu4vr4xnSDxMaL", "name": "Bella", "category": "premade"}
-        ]
-    }
+    def pending_for(self, user_id: str) -> List[Dict[str, Any]]:
+        """Documents for a user that are not yet confirmed written (read-your-writes)"""
+        return list(self._pending.get(user_id, {}).values())
 
-# User profile
-@api_router.get("/user/profile", response_model=User)
-async def get_user_profile(current_user: User = Depends(get_current_user)):
-    """Get current user profile"""
-    return current_user
+    async def _run(self):
+        while True:
+            if not self._queue:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if len(self._queue) < self.batch_size and not self._closing:
+                # Give a partial batch up to flush_interval to fill
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+            if batch:
+                await self._write(batch)
 
-# Health check
-@api_router.get("/health")
-async def health_check():
-    return {"status": "healthy", "service": "F.A.R.H.A AI Assistant"}
+    async def _write(self, batch: List[Dict[str, Any]]):
+        remaining = batch
+        for attempt in range(self.max_retries + 1):
+            try:
+                await db.chat_messages.insert_many(remaining, ordered=False)
+                remaining = []
+                break
+            except BulkWriteError as e:
+                # Duplicate keys mean an earlier attempt already wrote the document
+                failed_indexes = {
+                    error["index"] for error in e.details.get("writeErrors", []) if error.get("code") != 11000
+                }
+                remaining = [document for index, document in enumerate(remaining) if index in failed_indexes]
+                if not remaining:
+                    break
+            except Exception as e:
+                logger.warning(f"Chat write-behind batch failed (attempt {attempt + 1}): {str(e)}")
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
 
-# Include router
-app.include_router(api_router)
+        if remaining:
+            self.failed += len(remaining)
+            logger.error(f"Dropping {len(remaining)} chat messages after {self.max_retries} retries")
+        self.written += len(batch) - len(remaining)
+        self.batches += 1
+        for document in batch:
+            user_pending = self._pending.get(document["user_id"], {})
+            user_pending.pop(document["id"], None)
+            if not user_pending:
+                self._pending.pop(document["user_id"], None)
+            self._capacity.release()
 
-# CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
+    async def drain(self):
+        """Flush everything still buffered and stop the flusher"""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+        elif self._queue:
+            self.start()
+            await self._task
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": len(self._queue),
+            "pending": sum(len(documents) for documents in self._pending.values()),
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches
+        }
+
+chat_write_buffer = ChatWriteBuffer(
+    CHAT_WRITE_BATCH_SIZE, CHAT_WRITE_FLUSH_INTERVAL, CHAT_WRITE_MAX_BUFFERED,
+    CHAT_WRITE_MAX_RETRIES, CHAT_WRITE_RETRY_BACKOFF
+) if CHAT_WRITE_BEHIND_ENABLED else None
+
+async def persist_chat_message(chat_dict: Dict[str, Any]):
+    """Write a chat message directly, or hand it to the write-behind buffer when enabled"""
+    if chat_write_buffer is not None:
+        await chat_write_buffer.add(chat_dict)
+    else:
+        await db.chat_messages.insert_one(chat_dict)
+    chat_search.add(chat_dict)
+
+def pending_chat_messages(user_id: str) -> List[Dict[str, Any]]:
+    return chat_write_buffer.pending_for(user_id) if chat_write_buffer is not None else []
+
+# Conversation context
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token) used for context budgeting"""
+    return len(text) // 4 + 1
+
+class ConversationContext:
+    """Token-budgeted window of recent turns plus a rolling summary of older ones"""
+
+    def __init__(self, token_budget: int, summary_token_budget: int):
+        self.token_budget = token_budget
+        self.summary_token_budget = summary_token_budget
+        self.turns = deque()
+        self.turn_tokens = 0
+        self.summary = deque()
+        self.summary_tokens = 0
+        # Id of the newest hot (or buffered) turn included; validates the cached window against the DB
+        self.newest_id: Optional[str] = None
+
+    def add_turn(self, message: str, response: str, message_id: Optional[str] = None):
+        if message_id is not None:
+            self.newest_id = message_id
+        turn = (message, response, estimate_tokens(message) + estimate_tokens(response))
+        self.turns.append(turn)
+        self.turn_tokens += turn[2]
+        # Fold the oldest turns into the summary until the window fits the budget again
+        while self.turn_tokens > self.token_budget and len(self.turns) > 1:
+            old_message, old_response, tokens = self.turns.popleft()
+            self.turn_tokens -= tokens
+            self._summarize(old_message, old_response)
+
+    def _summarize(self, message: str, response: str):
+        line = f"- User asked: {message[:160]} / F.A.R.H.A answered: {response[:160]}"
+        self.summary.append(line)
+        self.summary_tokens += estimate_tokens(line)
+        while self.summary_tokens > self.summary_token_budget and self.summary:
+            self.summary_tokens -= estimate_tokens(self.summary.popleft())
+
+    def render(self, system_message: str) -> str:
+        parts = [system_message]
+        if self.summary:
+            parts.append("Summary of earlier conversation:\n" + "\n".join(self.summary))
+        if self.turns:
+            parts.append("Recent conversation:\n" + "\n".join(
+                f"User: {message}\nF.A.R.H.A: {response}" for message, response, _ in self.turns
+            ))
+        return "\n\n".join(parts)
+
+class ConversationContextCache:
+    """LRU cache of conversation contexts, rebuilt from one bounded query on a miss
+
+    A cached window is checked against the conversation's newest turn (one indexed find_one)
+    on every lookup, so turns written by other workers trigger a rebuild instead of being missed.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._contexts: "OrderedDict[tuple, ConversationContext]" = OrderedDict()
+
+    @staticmethod
+    def _newest_id(user_id: str, conversation_id: str, newest: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Id of the newest turn across a hot document and this worker's buffered writes"""
+        candidates = [document for document in pending_chat_messages(user_id) if document.get("conversation_id") == conversation_id]
+        if newest is not None:
+            candidates.append(parse_from_mongo(dict(newest)))
+        if not candidates:
+            return None
+        return max(candidates, key=lambda document: (document["timestamp"], document["id"]))["id"]
+
+    async def get(self, user_id: str, conversation_id: str) -> ConversationContext:
+        key = (user_id, conversation_id)
+        context = self._contexts.get(key)
+        if context is not None:
+            newest = await db.chat_messages.find_one(
+                {"user_id": user_id, "conversation_id": conversation_id},
+                {"_id": 0, "id": 1, "timestamp": 1},
+                sort=[("timestamp", DESCENDING), ("id", DESCENDING)]
+            )
+            if self._newest_id(user_id, conversation_id, newest) == context.newest_id:
+                self._contexts.move_to_end(key)
+                return context
+
+        context = ConversationContext(CONTEXT_TOKEN_BUDGET, CONTEXT_SUMMARY_TOKEN_BUDGET)
+        recent = await db.chat_messages.find(
+            {"user_id": user_id, "conversation_id": conversation_id},
+            {"_id": 0, "id": 1, "message": 1, "response": 1, "timestamp": 1}
+        ).sort([("timestamp", DESCENDING), ("id", DESCENDING)]).limit(CONTEXT_MAX_TURNS).to_list(CONTEXT_MAX_TURNS)
+        newest_id = self._newest_id(user_id, conversation_id, recent[0] if recent else None)
+        if len(recent) < CONTEXT_MAX_TURNS:
+            # Resuming a conversation whose earlier turns have been archived
+            oldest = (recent[-1]["timestamp"], recent[-1]["id"]) if recent else None
+            async for document in chat_archive.iter_messages(user_id, oldest, conversation_id):
+                recent.append(document)
+                if len(recent) >= CONTEXT_MAX_TURNS:
+                    break
+        recent_ids = {document.get("id") for document in recent}
+        buffered = sorted(
+            (document for document in pending_chat_messages(user_id)
+             if document.get("conversation_id") == conversation_id and document["id"] not in recent_ids),
+            key=lambda document: document["timestamp"]
+        )
+        for document in list(reversed(recent)) + buffered:
+            context.add_turn(document["message"], document["response"])
+        context.newest_id = newest_id
+
+        self._contexts[key] = context
+        while len(self._contexts) > self.max_size:
+            self._contexts.popitem(last=False)
+        return context
+
+    def invalidate_user(self, user_id: str):
+        for key in [key for key in self._contexts if key[0] == user_id]:
+            del self._contexts[key]
+
+conversation_contexts = ConversationContextCache(CONTEXT_CACHE_SIZE)
+
+# Response cache
+class ResponseCache:
+    """LRU + TTL cache of LLM replies keyed on normalized prompt, system message and model"""
+
+    def __init__(self, max_size: int, ttl_seconds: float, enabled: bool = True):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled and max_size > 0 and ttl_seconds > 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        return re.sub(r"\s+", " ", prompt).strip().rstrip(".!?").strip().casefold()
+
+    def key(self, prompt: str, system_message: str, model: str) -> str:
+        raw = "\0".join([model, system_message, self.normalize(prompt)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        response, deadline, latency = entry
+        if time.monotonic() >= deadline:
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.seconds_saved += latency
+        return response
+
+    def set(self, key: str, response: str, latency: float):
+        if not self.enabled or not response:
+            return
+        self._entries[key] = (response, time.monotonic() + self.ttl_seconds, latency)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "seconds_saved": round(self.seconds_saved, 6)
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_ENABLED)
+
+def response_cache_key(chat: LlmChat, prompt: str) -> str:
+    return response_cache.key(prompt, chat.system_message or "", f"{chat.provider}/{chat.model}")
+
+# LLM admission control
+class LLMSlot:
+    """Async context manager holding one of the scheduler's concurrency slots"""
+    __slots__ = ("scheduler", "user_id")
+
+    def __init__(self, scheduler: "LLMScheduler", user_id: str):
+        self.scheduler = scheduler
+        self.user_id = user_id
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.user_id)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.scheduler.release()
+
+class LLMScheduler:
+    """Admission control in front of LLM calls
+
+    A global cap on concurrent calls, a token bucket per user, and a bounded wait
+    queue served round-robin across users so one busy user cannot starve the rest.
+    """
+
+    def __init__(self, max_concurrency: int, max_queued: int, queue_timeout: float,
+                 rate: float, burst: float, max_users: int):
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.active = 0
+        self.queued = 0
+        # user_id -> waiters; dict order is the round-robin order
+        self._waiters: "OrderedDict[str, deque]" = OrderedDict()
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.wait_seconds = metrics.histogram("farha_llm_queue_wait_seconds", "Time LLM calls waited for a slot")
+        self.rejections = {
+            reason: metrics.counter("farha_llm_rejections_total", "LLM calls rejected by admission control", reason=reason)
+            for reason in ("rate_limited", "queue_full", "queue_timeout")
+        }
+
+    def _take_token(self, user_id: str) -> float:
+        """Take a token from the user's bucket; returns 0, or seconds until one is available"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [self.burst, now]
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+    def _retry_after(self) -> int:
+        """Rough seconds until a queued call would be admitted"""
+        return max(1, math.ceil(self.queue_timeout * self.queued / max(self.max_queued, 1)))
+
+    def admit(self, user_id: str):
+        """Fast rejection before any work: 429 when the user is over rate, 503 when the queue is full"""
+        retry_after = self._take_token(user_id)
+        if retry_after:
+            self.rejections["rate_limited"].inc()
+            raise HTTPException(
+                status_code=429,
+                detail="Too many chat requests, please slow down",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+        if self.active >= self.max_concurrency and self.queued >= self.max_queued:
+            self.rejections["queue_full"].inc()
+            raise HTTPException(
+                status_code=503,
+                detail="Assistant is busy, please retry shortly",
+                headers={"Retry-After": str(self._retry_after())}
+            )
+
+    def slot(self, user_id: str) -> LLMSlot:
+        return LLMSlot(self, user_id)
+
+    async def acquire(self, user_id: str):
+        """Wait for a concurrency slot, in round-robin order across users"""
+        if self.active < self.max_concurrency and not self.queued:
+            self.active += 1
+            self.wait_seconds.observe(0.0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiters = self._waiters.get(user_id)
+        if waiters is None:
+            waiters = self._waiters[user_id] = deque()
+        waiters.append(future)
+        self.queued += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as this waiter gave up
+                self.release()
+            else:
+                self._discard(user_id, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejections["queue_timeout"].inc()
+                raise HTTPException(
+                    status_code=503,
+                    detail="Assistant is busy, please retry shortly",
+                    headers={"Retry-After": str(self._retry_after())}
+                )
+            raise
+        self.wait_seconds.observe(time.perf_counter() - started)
+
+    def _discard(self, user_id: str, future: asyncio.Future):
+        waiters = self._waiters.get(user_id)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del self._waiters[user_id]
+
+    def release(self):
+        """Hand the slot to the next user in round-robin order, or free it"""
+        while self._waiters:
+            user_id, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self._waiters.move_to_end(user_id)
+            else:
+                del self._waiters[user_id]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "queued_users": len(self._waiters),
+            "rejections": {reason: counter.value for reason, counter in self.rejections.items()},
+            "wait_count": self.wait_seconds.count,
+            "wait_seconds_total": round(self.wait_seconds.sum, 6)
+        }
+
+llm_scheduler = LLMScheduler(
+    LLM_MAX_CONCURRENCY, LLM_MAX_QUEUED, LLM_QUEUE_TIMEOUT_SECONDS,
+    LLM_USER_RATE_PER_SECOND, LLM_USER_BURST, LLM_RATE_LIMIT_USERS
+)
+
+# Chat endpoints
+FARHA_SYSTEM_MESSAGE = "You are F.A.R.H.A, a sophisticated AI assistant. You are knowledgeable, helpful, and have a friendly personality. Respond naturally and conversationally."
+
+def create_farha_chat(user_id: str, conversation_id: str, context: ConversationContext) -> LlmChat:
+    """Initialize LLM chat with the F.A.R.H.A system message and the conversation so far"""
+    return LlmChat(
+        api_key=EMERGENT_LLM_KEY,
+        session_id=f"farha_{user_id}_{conversation_id}",
+        system_message=context.render(FARHA_SYSTEM_MESSAGE)
+    ).with_model("openai", "gpt-5")
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Format a Server-Sent Event frame"""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+@api_router.post("/chat", response_model=ChatResponse)
+async def chat_with_farha(request: ChatRequest, current_user: User = Depends(get_current_user)):
+    """Chat with F.A.R.H.A AI assistant"""
+    try:
+        conversation_id = request.conversation_id or str(uuid.uuid4())
+        context = await conversation_contexts.get(current_user.id, conversation_id)
+        chat = create_farha_chat(current_user.id, conversation_id, context)
+        
+        # Create user message
+        user_message = UserMessage(text=request.message)
+        
+        # Get response from AI, reusing a cached reply for a repeated prompt
+        cache_key = response_cache_key(chat, request.message)
+        ai_response = None if request.bypass_cache else response_cache.get(cache_key)
+        if ai_response is None:
+            llm_scheduler.admit(current_user.id)
+            async with llm_scheduler.slot(current_user.id):
+                started = time.perf_counter()
+                with Span("llm"):
+                    ai_response = await chat.send_message(user_message)
+            response_cache.set(cache_key, ai_response, time.perf_counter() - started)
+        
+        # Save chat message to database
+        chat_message = ChatMessage(
+            user_id=current_user.id,
+            message=request.message,
+            response=ai_response,
+            is_voice=request.is_voice,
+            conversation_id=conversation_id
+        )
+        
+        chat_dict = prepare_for_mongo(chat_message.dict())
+        await persist_chat_message(chat_dict)
+        context.add_turn(request.message, ai_response, chat_message.id)
+        
+        return ChatResponse(
+            response=ai_response,
+            message_id=chat_message.id,
+            timestamp=chat_message.timestamp,
+            conversation_id=conversation_id
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in chat: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing chat: {str(e)}")
+
+@api_router.post("/chat/stream")
+async def stream_chat_with_farha(request: ChatRequest, current_user: User = Depends(get_current_user)):
+    """Chat with F.A.R.H.A, streaming tokens as Server-Sent Events"""
+    conversation_id = request.conversation_id or str(uuid.uuid4())
+    context = await conversation_contexts.get(current_user.id, conversation_id)
+    chat = create_farha_chat(current_user.id, conversation_id, context)
+    user_message = UserMessage(text=request.message)
+    chat_message = ChatMessage(
+        user_id=current_user.id,
+        message=request.message,
+        response="",
+        is_voice=request.is_voice,
+        conversation_id=conversation_id
+    )
+
+    cache_key = response_cache_key(chat, request.message)
+    cached_response = None if request.bypass_cache else response_cache.get(cache_key)
+    if cached_response is None:
+        llm_scheduler.admit(current_user.id)
+
+    async def event_stream():
+        chunks = []
+        completed = False
+        failed = False
+        try:
+            if cached_response is not None:
+                chunks.append(cached_response)
+                yield format_sse("token", {"text": cached_response})
+            else:
+                async with llm_scheduler.slot(current_user.id):
+                    started = time.perf_counter()
+                    async for chunk in chat.stream_message(user_message):
+                        chunks.append(chunk)
+                        yield format_sse("token", {"text": chunk})
+                    stage_histogram("llm_stream").observe(time.perf_counter() - started)
+                response_cache.set(cache_key, "".join(chunks), time.perf_counter() - started)
+            completed = True
+            yield format_sse("done", {
+                "message_id": chat_message.id,
+                "timestamp": chat_message.timestamp.isoformat(),
+                "conversation_id": conversation_id
+            })
+        except HTTPException as e:
+            failed = True
+            yield format_sse("error", {"detail": e.detail, "status": e.status_code})
+        except Exception as e:
+            failed = True
+            logger.error(f"Error in chat stream: {str(e)}")
+            yield format_sse("error", {"detail": f"Error processing chat: {str(e)}"})
+        finally:
+            # Persist once the stream completes, or with the partial reply if the client went away
+            if not failed and (completed or chunks):
+                chat_message.response = "".join(chunks)
+                with anyio.CancelScope(shield=True):
+                    try:
+                        await persist_chat_message(prepare_for_mongo(chat_message.dict()))
+                        context.add_turn(chat_message.message, chat_message.response, chat_message.id)
+                    except Exception as e:
+                        logger.error(f"Error saving streamed chat: {str(e)}")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Fields the frontend renders for a history entry
+HISTORY_PROJECTION = {"_id": 0, "id": 1, "message": 1, "response": 1, "timestamp": 1, "is_voice": 1, "conversation_id": 1}
+
+def encode_history_cursor(timestamp: datetime, message_id: str) -> str:
+    """Build an opaque keyset cursor from the last message of a page"""
+    raw = f"{timestamp.isoformat()},{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_history_cursor(cursor: str):
+    """Decode a keyset cursor back into (timestamp, message_id)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, message_id = raw.split(",", 1)
+        timestamp = datetime.fromisoformat(timestamp)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid history cursor")
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp, message_id
+
+def history_query(user_id: str, before: Optional[str] = None, conversation_id: Optional[str] = None) -> Dict[str, Any]:
+    """Query for a user's messages, strictly older than the cursor when given"""
+    query: Dict[str, Any] = {"user_id": user_id}
+    if conversation_id:
+        query["conversation_id"] = conversation_id
+    if before:
+        timestamp, message_id = decode_history_cursor(before)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "id": {"$lt": message_id}}
+        ]
+    return query
+
+def buffered_history(user_id: str, before: Optional[str] = None, conversation_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Not-yet-written messages matching a history query, projected and newest first"""
+    documents = pending_chat_messages(user_id)
+    if not documents:
+        return []
+    boundary = decode_history_cursor(before) if before else None
+    matches = []
+    for document in documents:
+        if conversation_id and document.get("conversation_id") != conversation_id:
+            continue
+        if boundary and (document["timestamp"], document["id"]) >= boundary:
+            continue
+        matches.append({field: document.get(field) for field in HISTORY_PROJECTION if field != "_id"})
+    return sorted(matches, key=lambda document: (document["timestamp"], document["id"]), reverse=True)
+
+async def stream_history_page(cursor, limit: int, buffered: Optional[List[Dict[str, Any]]] = None,
+                              archived=None, before: Optional[tuple] = None):
+    """Serialize a history page incrementally as {"messages": [...], "next_cursor": ...}
+
+    Documents are trusted projections (no _id) and are encoded directly with orjson,
+    without a model round-trip. Buffered (not yet written) messages are merged in order
+    so a user always sees their own writes. Once the hot collection is exhausted the page
+    continues from `archived(boundary)`, an async iterator of older archived messages.
+    """
+    buffered = buffered or []
+    buffered_ids = {document["id"] for document in buffered}
+    buffer = [b'{"messages":[']
+    count = 0
+    last = None
+
+    def emit(document):
+        nonlocal count, last
+        last = (document["timestamp"], document["id"])
+        if count:
+            buffer.append(b",")
+        buffer.append(orjson.dumps(document))
+        count += 1
+
+    try:
+        async for document in cursor:
+            if count >= limit:
+                break
+            parse_from_mongo(document)
+            while buffered and count < limit and (buffered[0]["timestamp"], buffered[0]["id"]) > (document["timestamp"], document["id"]):
+                emit(buffered.pop(0))
+            if count >= limit:
+                break
+            if document["id"] in buffered_ids:
+                continue
+            emit(document)
+            if count % HISTORY_STREAM_BATCH_SIZE == 0:
+                yield b"".join(buffer)
+                buffer = []
+        while buffered and count < limit:
+            emit(buffered.pop(0))
+        if archived is not None and count < limit:
+            async for document in archived(last or before):
+                emit({field: document.get(field) for field in HISTORY_PROJECTION if field != "_id"})
+                if count >= limit:
+                    break
+    except Exception as e:
+        logger.error(f"Error streaming chat history: {str(e)}")
+        raise
+
+    next_cursor = encode_history_cursor(*last) if count == limit and last else None
+    buffer.append(b'],"next_cursor":' + orjson.dumps(next_cursor) + b'}')
+    yield b"".join(buffer)
+
+async def newest_history_message(user_id: str, query: Dict[str, Any], buffered: List[Dict[str, Any]],
+                                 before: Optional[str] = None, conversation_id: Optional[str] = None) -> Optional[tuple]:
+    """(timestamp, id) of the newest message a history page would start with, across buffer, hot and archive"""
+    candidates = [(document["timestamp"], document["id"]) for document in buffered[:1]]
+    document = await db.chat_messages.find_one(
+        query, {"_id": 0, "id": 1, "timestamp": 1}, sort=[("timestamp", DESCENDING), ("id", DESCENDING)]
+    )
+    if document is not None:
+        parse_from_mongo(document)
+        candidates.append((document["timestamp"], document["id"]))
+    if not candidates:
+        archived = chat_archive.iter_messages(user_id, decode_history_cursor(before) if before else None, conversation_id)
+        async for document in archived:
+            candidates.append((document["timestamp"], document["id"]))
+            break
+        await archived.aclose()
+    if not candidates:
+        return None
+    timestamp, message_id = max(candidates)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp, message_id
+
+async def history_version(user_id: str) -> tuple:
+    """(version, changed_at) of a user's history, moved by changes that don't add a newest message"""
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "history_version": 1, "history_changed_at": 1})
+    user = user or {}
+    return user.get("history_version", 0), user.get("history_changed_at")
+
+async def bump_history_version(user_id: str):
+    """Invalidate cached history pages after an import or merge rewrote older parts of the history"""
+    await db.users.update_one(
+        {"id": user_id},
+        {"$inc": {"history_version": 1}, "$set": {"history_changed_at": utc_now()}}
+    )
+
+@api_router.get("/chat/history")
+async def get_chat_history(
+    http_request: Request,
+    current_user: User = Depends(get_current_user),
+    limit: int = 50,
+    before: Optional[str] = None,
+    conversation_id: Optional[str] = None
+):
+    """Get a page of chat history for current user, newest first
+
+    The ETag comes from the page's newest message (id and timestamp), the user's history version
+    (bumped by imports and user merges, which can add older messages) and the page parameters, so
+    a matching If-None-Match is answered with 304 before the page is read or serialized.
+    """
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    query = history_query(current_user.id, before, conversation_id)
+    try:
+        buffered = buffered_history(current_user.id, before, conversation_id)
+
+        newest = await newest_history_message(current_user.id, query, buffered, before, conversation_id)
+        version, changed_at = await history_version(current_user.id)
+        moments = [moment for moment in (newest[0] if newest else None, changed_at) if moment is not None]
+        last_modified = max(moments) if moments else None
+        etag = weak_etag("history", current_user.id, newest, version, limit, before, conversation_id)
+        headers = http_cache_headers(etag, last_modified)
+        if is_not_modified(http_request, etag, last_modified):
+            return Response(status_code=304, headers=headers)
+
+        cursor = db.chat_messages.find(query, HISTORY_PROJECTION).sort(
+            [("timestamp", DESCENDING), ("id", DESCENDING)]
+        ).limit(limit).batch_size(min(limit, HISTORY_STREAM_BATCH_SIZE))
+
+        def archived(boundary):
+            return chat_archive.iter_messages(current_user.id, boundary, conversation_id)
+
+        return StreamingResponse(
+            stream_history_page(cursor, limit, buffered, archived, decode_history_cursor(before) if before else None),
+            media_type="application/json",
+            headers=headers
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting chat history: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error getting chat history: {str(e)}")
+
+# Chat archive
+ARCHIVE_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ARCHIVE_PROJECTION = {"_id": 0, "id": 1, "user_id": 1, "message": 1, "response": 1, "timestamp": 1, "is_voice": 1, "conversation_id": 1}
+ARCHIVE_ROW_FIELDS = ("id", "timestamp", "conversation_id", "is_voice", "message", "response")
+
+def archive_codec() -> str:
+    return "zstd" if ARCHIVE_COMPRESSION == "zstd" and importlib.util.find_spec("zstandard") is not None else "gzip"
+
+def pack_archive_rows(documents: List[Dict[str, Any]], codec: str) -> tuple:
+    """Packed JSON rows (no repeated keys, integer microsecond timestamps), compressed; returns (blob, raw size)"""
+    rows = [[
+        document["id"],
+        (document["timestamp"] - ARCHIVE_EPOCH) // timedelta(microseconds=1),
+        document.get("conversation_id"),
+        document.get("is_voice", False),
+        document["message"],
+        document["response"]
+    ] for document in documents]
+    raw = orjson.dumps(rows)
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=10).compress(raw), len(raw)
+    return gzip.compress(raw, compresslevel=6), len(raw)
+
+def unpack_archive_rows(blob: bytes, codec: str) -> List[Dict[str, Any]]:
+    if codec == "zstd":
+        import zstandard
+        raw = zstandard.ZstdDecompressor().decompress(blob)
+    else:
+        raw = gzip.decompress(blob)
+    documents = []
+    for row in orjson.loads(raw):
+        document = dict(zip(ARCHIVE_ROW_FIELDS, row))
+        document["timestamp"] = ARCHIVE_EPOCH + timedelta(microseconds=document["timestamp"])
+        documents.append(document)
+    return documents
+
+async def collection_sizes(name: str) -> Dict[str, Any]:
+    """Data, storage and index sizes from collStats; estimated from BSON sizes where unsupported"""
+    try:
+        stats = await db.command({"collStats": name})
+        return {
+            "count": stats.get("count", 0),
+            "size_bytes": stats.get("size", 0),
+            "storage_bytes": stats.get("storageSize", 0),
+            "index_bytes": stats.get("totalIndexSize", 0)
+        }
+    except NotImplementedError:
+        count = size = 0
+        async for document in db[name].find({}):
+            count += 1
+            size += len(bson.encode(document))
+        return {"count": count, "size_bytes": size, "storage_bytes": None, "index_bytes": None, "estimated": True}
+
+class ChatArchive:
+    """Cold tier: whole months of a user's messages packed into one compressed blob per user and month
+
+    Months are archived only once they are entirely older than the hot window, so archived
+    messages always sort before hot ones and history pages read through by keyset.
+    """
+
+    def __init__(self, after_days: int, cache_size: int):
+        self.after_days = after_days
+        self.cache_size = cache_size
+        self._decoded: "OrderedDict[tuple, List[Dict[str, Any]]]" = OrderedDict()
+        self.last_report: Optional[Dict[str, Any]] = None
+
+    def cutoff(self, now: Optional[datetime] = None) -> datetime:
+        """Start of the month containing now - after_days; everything before it is cold"""
+        boundary = (now or datetime.now(timezone.utc)) - timedelta(days=self.after_days)
+        return boundary.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    async def _rows(self, blob: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Decoded rows of a blob, newest first, through a small LRU of decoded months"""
+        key = (blob["_id"], blob["archived_at"])
+        rows = self._decoded.get(key)
+        if rows is not None:
+            self._decoded.move_to_end(key)
+            return rows
+        stored = await db.chat_archive.find_one({"_id": blob["_id"]}, {"data": 1, "codec": 1})
+        rows = await asyncio.to_thread(unpack_archive_rows, stored["data"], stored["codec"])
+        rows.sort(key=lambda row: (row["timestamp"], row["id"]), reverse=True)
+        self._decoded[key] = rows
+        while len(self._decoded) > self.cache_size:
+            self._decoded.popitem(last=False)
+        return rows
+
+    async def iter_messages(self, user_id: str, before: Optional[tuple] = None, conversation_id: Optional[str] = None):
+        """Archived messages strictly older than `before`, newest first"""
+        query: Dict[str, Any] = {"user_id": user_id}
+        if conversation_id:
+            query["conversation_ids"] = conversation_id
+        if before:
+            query["first_timestamp"] = {"$lte": before[0]}
+        blobs = db.chat_archive.find(query, {"data": 0}).sort([("last_timestamp", DESCENDING)])
+        async for blob in blobs:
+            for row in await self._rows(blob):
+                if before and (row["timestamp"], row["id"]) >= before:
+                    continue
+                if conversation_id and row["conversation_id"] != conversation_id:
+                    continue
+                yield dict(row)
+
+    async def archive(self, now: Optional[datetime] = None) -> Dict[str, Any]:
+        """Move every cold month out of chat_messages; returns counts and before/after sizes"""
+        started = time.perf_counter()
+        before = {name: await collection_sizes(name) for name in ("chat_messages", "chat_archive")}
+        cutoff = self.cutoff(now)
+        codec = archive_codec()
+        messages = blobs = 0
+        for user_id in await db.chat_messages.distinct("user_id", {"timestamp": {"$lt": cutoff}}):
+            user_messages, user_blobs = await self.archive_user(user_id, cutoff, codec)
+            messages += user_messages
+            blobs += user_blobs
+            chat_search.invalidate_user(user_id, scope="archive")
+        self.last_report = {
+            "cutoff": cutoff.isoformat(),
+            "codec": codec,
+            "archived_messages": messages,
+            "blobs_written": blobs,
+            "duration_s": round(time.perf_counter() - started, 3),
+            "before": before,
+            "after": {name: await collection_sizes(name) for name in ("chat_messages", "chat_archive")}
+        }
+        logger.info(f"Archived {messages} chat messages into {blobs} blobs")
+        return self.last_report
+
+    async def archive_user(self, user_id: str, cutoff: datetime, codec: str) -> tuple:
+        """Archive one user's cold messages month by month, oldest first"""
+        cursor = db.chat_messages.find(
+            {"user_id": user_id, "timestamp": {"$lt": cutoff}}, ARCHIVE_PROJECTION
+        ).sort([("timestamp", ASCENDING), ("id", ASCENDING)]).batch_size(1000)
+        month, documents, messages, blobs = None, [], 0, 0
+        async for document in cursor:
+            parse_from_mongo(document)
+            key = document["timestamp"].strftime("%Y-%m")
+            if documents and key != month:
+                messages += await self._write_month(user_id, month, documents, codec)
+                blobs += 1
+                documents = []
+            month = key
+            documents.append(document)
+        if documents:
+            messages += await self._write_month(user_id, month, documents, codec)
+            blobs += 1
+        return messages, blobs
+
+    async def _write_month(self, user_id: str, month: str, documents: List[Dict[str, Any]], codec: str) -> int:
+        """Write (or merge into) the user's blob for a month, then delete the archived hot copies
+
+        The write is conditional on the blob version that was read, so two passes on the same
+        month (several workers, or the archiver racing an import fold) never overwrite each
+        other: the loser re-reads, re-merges and retries.
+        """
+        blob_id = f"{user_id}:{month}"
+        for attempt in range(ARCHIVE_WRITE_RETRIES):
+            existing = await db.chat_archive.find_one({"_id": blob_id}, {"data": 1, "codec": 1, "version": 1})
+            merged = {document["id"]: document for document in documents}
+            if existing:
+                # Late writes into an archived month (e.g. imports) are merged; ids dedupe reruns
+                for row in await asyncio.to_thread(unpack_archive_rows, existing["data"], existing["codec"]):
+                    merged.setdefault(row["id"], row)
+            rows = sorted(merged.values(), key=lambda row: (row["timestamp"], row["id"]))
+            data, raw_bytes = await asyncio.to_thread(pack_archive_rows, rows, codec)
+            version = existing.get("version") if existing else None
+            blob = {
+                "_id": blob_id,
+                "user_id": user_id,
+                "month": month,
+                "count": len(rows),
+                "first_timestamp": rows[0]["timestamp"],
+                "last_timestamp": rows[-1]["timestamp"],
+                "conversation_ids": sorted({row["conversation_id"] for row in rows if row.get("conversation_id")}),
+                "codec": codec,
+                "raw_bytes": raw_bytes,
+                "data": data,
+                "version": (version or 0) + 1,
+                "archived_at": utc_now()
+            }
+            if existing:
+                # Blobs written before versioning have no version field; {"version": None} matches those
+                written = (await db.chat_archive.replace_one({"_id": blob_id, "version": version}, blob)).matched_count == 1
+            else:
+                try:
+                    await db.chat_archive.insert_one(blob)
+                    written = True
+                except DuplicateKeyError:
+                    written = False
+            if written:
+                break
+            logger.info(f"Archive blob {blob_id} changed concurrently, retrying merge (attempt {attempt + 1})")
+        else:
+            raise RuntimeError(f"Archive blob {blob_id} kept changing; gave up after {ARCHIVE_WRITE_RETRIES} attempts")
+
+        # Deleting only after the conditional write succeeded makes a crash or a race leave duplicates, never losses
+        ids = [document["id"] for document in documents]
+        for start in range(0, len(ids), 1000):
+            await db.chat_messages.delete_many({"user_id": user_id, "id": {"$in": ids[start:start + 1000]}})
+        return len(documents)
+
+chat_archive = ChatArchive(ARCHIVE_AFTER_DAYS, ARCHIVE_DECODED_CACHE_SIZE)
+
+class ChatArchiver:
+    """Runs the archival pass periodically in the background"""
+
+    def __init__(self, archive: ChatArchive, interval: float):
+        self.archive = archive
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.archive.archive()
+            except Exception as e:
+                logger.error(f"Error archiving chat history: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+chat_archiver = ChatArchiver(chat_archive, ARCHIVE_INTERVAL_SECONDS) if ARCHIVE_INTERVAL_SECONDS > 0 else None
+
+# Chat export and import
+EXPORT_PROJECTION = {"_id": 0, "id": 1, "user_id": 1, "message": 1, "response": 1, "timestamp": 1, "is_voice": 1, "conversation_id": 1}
+
+async def iter_export_documents(user_id: str, conversation_id: Optional[str] = None):
+    """All of a user's messages oldest first: archived months one blob at a time, then the hot cursor"""
+    query: Dict[str, Any] = {"user_id": user_id}
+    if conversation_id:
+        query["conversation_id"] = conversation_id
+    archive_query = {"user_id": user_id, **({"conversation_ids": conversation_id} if conversation_id else {})}
+    async for blob in db.chat_archive.find(archive_query, {"_id": 1}).sort([("first_timestamp", ASCENDING)]):
+        stored = await db.chat_archive.find_one({"_id": blob["_id"]}, {"data": 1, "codec": 1})
+        for row in await asyncio.to_thread(unpack_archive_rows, stored["data"], stored["codec"]):
+            if conversation_id and row["conversation_id"] != conversation_id:
+                continue
+            row["user_id"] = user_id
+            yield row
+    cursor = db.chat_messages.find(query, EXPORT_PROJECTION).sort(
+        [("timestamp", ASCENDING), ("id", ASCENDING)]
+    ).batch_size(EXPORT_BATCH_SIZE)
+    async for document in cursor:
+        yield parse_from_mongo(document)
+
+async def stream_export(documents, compress: bool):
+    """NDJSON lines flushed every EXPORT_BATCH_SIZE documents, optionally gzip-compressed"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    count = 0
+    async for document in documents:
+        buffer.append(orjson.dumps(document))
+        buffer.append(b"\n")
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            chunk = b"".join(buffer)
+            buffer = []
+            yield compressor.compress(chunk) if compressor else chunk
+    chunk = b"".join(buffer)
+    if compressor:
+        yield compressor.compress(chunk) + compressor.flush()
+    elif chunk:
+        yield chunk
+
+async def iter_ndjson_lines(chunks):
+    """Split a byte stream into lines, transparently gunzipping it when it starts with the gzip magic
+
+    Input is inflated and split IMPORT_READ_CHUNK_BYTES at a time, and the line and total size
+    caps are checked as the data grows, so a small gzip bomb never expands in memory.
+    """
+    decompressor = None
+    pending = b""
+    total = 0
+    first = True
+
+    def pieces(chunk: bytes):
+        if decompressor is None:
+            for start in range(0, len(chunk), IMPORT_READ_CHUNK_BYTES):
+                yield chunk[start:start + IMPORT_READ_CHUNK_BYTES]
+            return
+        while chunk:
+            yield decompressor.decompress(chunk, IMPORT_READ_CHUNK_BYTES)
+            chunk = decompressor.unconsumed_tail
+
+    def split(piece: bytes) -> List[bytes]:
+        nonlocal pending, total
+        total += len(piece)
+        if total > IMPORT_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Import too large")
+        *lines, pending = (pending + piece).split(b"\n")
+        if len(pending) > IMPORT_MAX_LINE_BYTES:
+            raise HTTPException(status_code=413, detail="Import line too long")
+        return lines
+
+    async for chunk in chunks:
+        if first and chunk:
+            first = False
+            if chunk[:2] == b"\x1f\x8b":
+                decompressor = zlib.decompressobj(31)
+        for piece in pieces(chunk):
+            for line in split(piece):
+                yield line
+    if decompressor:
+        for line in split(decompressor.flush()):
+            yield line
+    yield pending
+
+async def import_chat_messages(lines, user_id: Optional[str] = None) -> Dict[str, Any]:
+    """Ingest NDJSON ChatMessage lines with batched unordered insert_many; duplicate ids are skipped
+
+    With user_id, every message is imported for that user regardless of the user_id in the file.
+    """
+    started = time.perf_counter()
+    report = {"received": 0, "inserted": 0, "duplicates": 0, "invalid": 0}
+    users = set()
+    oldest = None
+    batch = []
+    cutoff = chat_archive.cutoff()
+    archived_ids: Dict[tuple, set] = {}
+
+    async def already_archived(document) -> bool:
+        # Archived ids left chat_messages, so the unique index can't catch them; check the month's blob
+        key = (document["user_id"], document["timestamp"].astimezone(timezone.utc).strftime("%Y-%m"))
+        if key not in archived_ids:
+            blob = await db.chat_archive.find_one({"_id": f"{key[0]}:{key[1]}"}, {"_id": 1, "archived_at": 1})
+            archived_ids[key] = {row["id"] for row in await chat_archive._rows(blob)} if blob else set()
+        return document["id"] in archived_ids[key]
+
+    async def flush():
+        nonlocal batch
+        # Only months older than the cutoff can have been archived
+        fresh = [document for document in batch if document["timestamp"] >= cutoff or not await already_archived(document)]
+        report["duplicates"] += len(batch) - len(fresh)
+        batch = fresh
+        if not batch:
+            return
+        try:
+            result = await db.chat_messages.insert_many(batch, ordered=False)
+            report["inserted"] += len(result.inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            report["inserted"] += e.details.get("nInserted", len(batch) - len(errors))
+            report["duplicates"] += len(errors)
+
+    async for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        report["received"] += 1
+        try:
+            data = orjson.loads(line)
+            if user_id:
+                data["user_id"] = user_id
+            document = prepare_for_mongo(ChatMessage(**data).dict())
+        except Exception:
+            report["invalid"] += 1
+            continue
+        if document["timestamp"].tzinfo is None:
+            document["timestamp"] = document["timestamp"].replace(tzinfo=timezone.utc)
+        users.add(document["user_id"])
+        oldest = document["timestamp"] if oldest is None else min(oldest, document["timestamp"])
+        batch.append(document)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await flush()
+            batch = []
+    if batch:
+        await flush()
+
+    for imported_user in users:
+        chat_search.invalidate_user(imported_user)
+        conversation_contexts.invalidate_user(imported_user)
+        if report["inserted"]:
+            await bump_history_version(imported_user)
+        # Keep archived months strictly older than the hot tier: fold old imports into the archive
+        cutoff = chat_archive.cutoff()
+        if oldest < cutoff and await db.chat_archive.find_one({"user_id": imported_user}, {"_id": 1}):
+            await chat_archive.archive_user(imported_user, cutoff, archive_codec())
+
+    duration = time.perf_counter() - started
+    report["duration_s"] = round(duration, 3)
+    report["messages_per_second"] = round(report["received"] / duration, 1) if duration > 0 else None
+    return report
+
+@api_router.get("/chat/export")
+async def export_chat_history(
+    current_user: User = Depends(get_current_user),
+    compress: bool = False,
+    conversation_id: Optional[str] = None
+):
+    """Stream the current user's full history as NDJSON, oldest first (?compress=true for gzip)"""
+    filename = "farha-chat-history.ndjson" + (".gz" if compress else "")
+    return StreamingResponse(
+        stream_export(iter_export_documents(current_user.id, conversation_id), compress),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.post("/chat/import")
+async def import_chat_history(request: Request, current_user: User = Depends(get_current_user)):
+    """Import NDJSON (optionally gzip) chat messages into the current user's history"""
+    try:
+        return await import_chat_messages(iter_ndjson_lines(request.stream()), current_user.id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error importing chat history: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error importing chat history: {str(e)}")
+
+# Chat search
+SEARCH_STOPWORDS = frozenset(
+    "a an and are as at be but by can do for from has have how i if in is it its me my no not of on or so "
+    "that the their them then there these they this to was we were what when where which who why will with "
+    "would you your".split()
+)
+SEARCH_TOKEN = re.compile(r"\w+")
+SEARCH_PROJECTION = {"_id": 0, "id": 1, "message": 1, "response": 1, "timestamp": 1, "conversation_id": 1}
+SEARCH_FIELD_WEIGHTS = (("message", 2.0), ("response", 1.0))
+
+def search_terms(text: str) -> List[str]:
+    """Lowercased word tokens without stopwords, as used for both indexing and queries"""
+    return [term for term in SEARCH_TOKEN.findall(text.lower()) if term not in SEARCH_STOPWORDS]
+
+def encode_search_cursor(tier: str, score: float, message_id: str) -> str:
+    raw = f"{tier},{score!r},{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_search_cursor(cursor: str):
+    """Decode a search cursor back into (tier, (score, message_id))"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        tier, score, message_id = raw.split(",", 2)
+        if tier not in ("hot", "archive"):
+            raise ValueError(tier)
+        return tier, (float(score), message_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid search cursor")
+
+def search_snippet(document: Dict[str, Any], terms: List[str], width: int) -> Dict[str, Any]:
+    """A window of the best matching field around the first hit, with [start, end) highlight ranges"""
+    pattern = re.compile(r"\b(?:" + "|".join(map(re.escape, terms)) + r")\w*", re.IGNORECASE) if terms else None
+    field, text, match = "response", document.get("response") or "", None
+    for candidate in ("response", "message"):
+        value = document.get(candidate) or ""
+        found = pattern.search(value) if pattern else None
+        if found:
+            field, text, match = candidate, value, found
+            break
+
+    start = 0
+    if match and match.start() > width // 3:
+        start = text.find(" ", match.start() - width // 3) + 1 or match.start()
+    end = min(len(text), start + width)
+    prefix = "…" if start > 0 else ""
+    highlights = []
+    if pattern:
+        for hit in pattern.finditer(text, start, end):
+            highlights.append([hit.start() - start + len(prefix), hit.end() - start + len(prefix)])
+    return {
+        "field": field,
+        "text": prefix + text[start:end] + ("…" if end < len(text) else ""),
+        "highlights": highlights
+    }
+
+class UserSearchIndex:
+    """In-memory inverted index over one user's messages: term -> {message_id: weighted term frequency}
+
+    Projected documents are kept alongside so results and snippets need no further reads.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, float]] = {}
+        self.documents: Dict[str, Dict[str, Any]] = {}
+
+    def add(self, document: Dict[str, Any]):
+        message_id = document["id"]
+        if message_id in self.documents:
+            return
+        self.documents[message_id] = parse_from_mongo(
+            {field: document.get(field) for field in SEARCH_PROJECTION if field != "_id"}
+        )
+        if document.get("archived"):
+            self.documents[message_id]["archived"] = True
+        weights: Dict[str, float] = {}
+        for field, weight in SEARCH_FIELD_WEIGHTS:
+            for term in search_terms(document.get(field) or ""):
+                weights[term] = weights.get(term, 0.0) + weight
+        for term, weight in weights.items():
+            self.postings.setdefault(term, {})[message_id] = weight
+
+    def search(self, terms: List[str], limit: int, after: Optional[tuple], conversation_id: Optional[str]):
+        """Top (score, id) pairs by tf-idf, ordered by score then id, strictly after the cursor"""
+        total = len(self.documents) or 1
+        scores: Dict[str, float] = {}
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + total / len(postings))
+            for message_id, weight in postings.items():
+                scores[message_id] = scores.get(message_id, 0.0) + weight * idf
+        candidates = (
+            (score, message_id) for message_id, score in scores.items()
+            if (conversation_id is None or self.documents[message_id]["conversation_id"] == conversation_id)
+            and (after is None or (score, message_id) < after)
+        )
+        return heapq.nlargest(limit, candidates)
+
+class ChatSearch:
+    """Full-text search over chat history: a Mongo text index, or an in-process inverted index
+
+    The in-process index is built per user on first search and kept current on write; "auto"
+    uses Mongo and falls back when $text is unavailable (e.g. the local Mongo stand-in).
+    Archived months are searched in-process: as part of the user's index ("all" scope), or
+    after the Mongo results run out ("archive" scope).
+    """
+
+    def __init__(self, backend: str, max_users: int, snippet_chars: int):
+        self.backend = backend
+        self.max_users = max_users
+        self.snippet_chars = snippet_chars
+        self._indexes: "OrderedDict[tuple, UserSearchIndex]" = OrderedDict()
+        self._building = SingleFlight()
+        self._pending: Dict[tuple, List[Dict[str, Any]]] = {}
+
+    def add(self, document: Dict[str, Any]):
+        """Keep a loaded (or loading) user index current with a newly written message"""
+        key = (document.get("user_id"), "all")
+        index = self._indexes.get(key)
+        if index is not None:
+            index.add(document)
+        elif key in self._building:
+            self._pending.setdefault(key, []).append(document)
+
+    def invalidate_user(self, user_id: str, scope: Optional[str] = None):
+        for key in [key for key in self._indexes if key[0] == user_id and scope in (None, key[1])]:
+            del self._indexes[key]
+
+    async def search(self, user_id: str, query: str, limit: int,
+                     after: Optional[str] = None, conversation_id: Optional[str] = None):
+        terms = search_terms(query)
+        if not terms:
+            return [], None
+        tier, boundary = decode_search_cursor(after) if after else ("hot", None)
+        if self.backend in ("auto", "mongo"):
+            try:
+                documents = [] if tier == "archive" else await self._search_mongo(user_id, query, limit, boundary, conversation_id)
+            except NotImplementedError:
+                if self.backend == "mongo":
+                    raise
+                logger.info("Mongo $text search unavailable, using the in-process search index")
+                self.backend = "memory"
+            else:
+                self.backend = "mongo"
+                if len(documents) < limit:
+                    documents += await self._search_memory(
+                        user_id, "archive", terms, limit - len(documents),
+                        boundary if tier == "archive" else None, conversation_id
+                    )
+                return self._page(documents, terms, limit)
+        return self._page(await self._search_memory(user_id, "all", terms, limit, boundary, conversation_id), terms, limit)
+
+    def _page(self, documents: List[Dict[str, Any]], terms: List[str], limit: int):
+        results = [{
+            "id": document["id"],
+            "conversation_id": document.get("conversation_id"),
+            "timestamp": document["timestamp"],
+            "message": document["message"],
+            "score": round(document["score"], 4),
+            "archived": document.get("archived", False),
+            "snippet": search_snippet(document, terms, self.snippet_chars)
+        } for document in documents]
+        last = documents[-1] if documents else None
+        next_cursor = encode_search_cursor(
+            "archive" if last.get("archived") else "hot", last["score"], last["id"]
+        ) if len(documents) == limit else None
+        return results, next_cursor
+
+    async def _search_mongo(self, user_id: str, query: str, limit: int, boundary, conversation_id):
+        match: Dict[str, Any] = {"user_id": user_id, "$text": {"$search": query}}
+        if conversation_id:
+            match["conversation_id"] = conversation_id
+        pipeline: List[Dict[str, Any]] = [
+            {"$match": match},
+            {"$project": {**SEARCH_PROJECTION, "score": {"$meta": "textScore"}}}
+        ]
+        if boundary:
+            score, message_id = boundary
+            pipeline.append({"$match": {"$or": [
+                {"score": {"$lt": score}},
+                {"score": score, "id": {"$lt": message_id}}
+            ]}})
+        pipeline += [{"$sort": {"score": -1, "id": -1}}, {"$limit": limit}]
+        return await db.chat_messages.aggregate(pipeline).to_list(limit)
+
+    async def _search_memory(self, user_id: str, scope: str, terms: List[str], limit: int, boundary, conversation_id):
+        index = await self._index_for(user_id, scope)
+        return [
+            {**index.documents[message_id], "score": score}
+            for score, message_id in index.search(terms, limit, boundary, conversation_id)
+        ]
+
+    async def _index_for(self, user_id: str, scope: str) -> UserSearchIndex:
+        key = (user_id, scope)
+        index = self._indexes.get(key)
+        if index is not None:
+            self._indexes.move_to_end(key)
+            return index
+        return await self._building.run(key, lambda: self._build(user_id, scope))
+
+    async def _build(self, user_id: str, scope: str) -> UserSearchIndex:
+        key = (user_id, scope)
+        try:
+            index = UserSearchIndex()
+            if scope == "all":
+                async for document in db.chat_messages.find({"user_id": user_id}, SEARCH_PROJECTION).batch_size(1000):
+                    index.add(document)
+                for document in pending_chat_messages(user_id) + self._pending.pop(key, []):
+                    index.add(document)
+            async for document in chat_archive.iter_messages(user_id):
+                document["archived"] = True
+                index.add(document)
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_users:
+                self._indexes.popitem(last=False)
+            return index
+        finally:
+            self._pending.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "indexed_users": len(self._indexes),
+            "indexed_messages": sum(len(index.documents) for index in self._indexes.values()),
+            "indexed_terms": sum(len(index.postings) for index in self._indexes.values())
+        }
+
+chat_search = ChatSearch(SEARCH_BACKEND, SEARCH_INDEX_MAX_USERS, SEARCH_SNIPPET_CHARS)
+
+@api_router.get("/chat/search")
+async def search_chat_history(
+    q: str,
+    current_user: User = Depends(get_current_user),
+    limit: int = 20,
+    after: Optional[str] = None,
+    conversation_id: Optional[str] = None
+):
+    """Search the current user's messages and responses, best matches first"""
+    q = q.strip()[:SEARCH_MAX_QUERY_CHARS]
+    if not q:
+        raise HTTPException(status_code=400, detail="Search query required")
+    limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+    try:
+        with Span("search"):
+            results, next_cursor = await chat_search.search(current_user.id, q, limit, after, conversation_id)
+        return {"results": results, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error searching chat history: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error searching chat history: {str(e)}")
+
+# Speech synthesis
+class SpeechSynthesizer:
+    """Backend that turns a TTSRequest into encoded audio bytes"""
+    name = "base"
+    media_type = "application/octet-stream"
+    extension = "bin"
+
+    async def synthesize(self, request: TTSRequest) -> bytes:
+        raise NotImplementedError
+
+    def stream_header(self) -> bytes:
+        """Bytes sent once before the frames of a chunked stream"""
+        return b""
+
+    def stream_frames(self, audio: bytes) -> bytes:
+        """Audio frames of one synthesized chunk, ready to append to a stream"""
+        return audio
+
+class FakeSpeechSynthesizer(SpeechSynthesizer):
+    """Local stand-in producing a deterministic WAV tone sized to the text"""
+    name = "fake"
+    media_type = "audio/wav"
+    extension = "wav"
+    sample_rate = 16000
+
+    def __init__(self, latency: float = 0.0, seconds_per_char: float = 0.06, max_seconds: float = 30.0):
+        self.latency = latency
+        self.seconds_per_char = seconds_per_char
+        self.max_seconds = max_seconds
+
+    def _render(self, request: TTSRequest) -> bytes:
+        seconds = min(self.max_seconds, max(0.2, len(request.text) * self.seconds_per_char))
+        frequency = 180 + int(hashlib.sha256(request.voice_id.encode()).hexdigest()[:4], 16) % 240
+        period = array("h", (
+            int(8000 * request.stability * math.sin(2 * math.pi * i / (self.sample_rate / frequency)))
+            for i in range(int(self.sample_rate / frequency))
+        ))
+        total = int(seconds * self.sample_rate)
+        samples = (period * (total // len(period) + 1))[:total]
+
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(samples.tobytes())
+        return buffer.getvalue()
+
+    async def synthesize(self, request: TTSRequest) -> bytes:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._render(request)
+
+    def stream_header(self) -> bytes:
+        # WAV header with unknown (maximal) lengths, followed by raw PCM from each chunk
+        header = io.BytesIO()
+        with wave.open(header, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+        data = bytearray(header.getvalue())
+        data[4:8] = (0xFFFFFFFF).to_bytes(4, "little")
+        data[40:44] = (0xFFFFFFFF - 36).to_bytes(4, "little")
+        return bytes(data)
+
+    def stream_frames(self, audio: bytes) -> bytes:
+        return audio[44:]
+
+class ElevenLabsSpeechSynthesizer(SpeechSynthesizer):
+    name = "elevenlabs"
+    media_type = "audio/mpeg"
+    extension = "mp3"
+
+    def __init__(self, model_id: str):
+        self.model_id = model_id
+
+    def _convert(self, request: TTSRequest) -> bytes:
+        from elevenlabs.types import VoiceSettings
+
+        audio = get_elevenlabs_client().text_to_speech.convert(
+            voice_id=request.voice_id,
+            text=request.text,
+            model_id=self.model_id,
+            output_format="mp3_44100_128",
+            voice_settings=VoiceSettings(
+                stability=request.stability,
+                similarity_boost=request.similarity_boost,
+                style=request.style,
+                use_speaker_boost=request.use_speaker_boost
+            )
+        )
+        return b"".join(audio)
+
+    async def synthesize(self, request: TTSRequest) -> bytes:
+        return await asyncio.to_thread(self._convert, request)
+
+def create_speech_synthesizer() -> SpeechSynthesizer:
+    if TTS_BACKEND == "elevenlabs":
+        if not ELEVENLABS_API_KEY:
+            raise RuntimeError("TTS_BACKEND=elevenlabs requires ELEVENLABS_API_KEY")
+        return ElevenLabsSpeechSynthesizer(TTS_MODEL_ID)
+    return FakeSpeechSynthesizer(latency=TTS_FAKE_LATENCY_SECONDS)
+
+speech_synthesizer = create_speech_synthesizer()
+
+# TTS audio cache
+class CachedAudio(NamedTuple):
+    key: str
+    path: Path
+    size: int
+    media_type: str
+    etag: str
+
+AUDIO_MEDIA_TYPES = {"wav": "audio/wav", "mp3": "audio/mpeg", "bin": "application/octet-stream"}
+
+class TTSAudioCache:
+    """Content-addressed on-disk audio cache with a size cap and LRU eviction
+
+    Files are named <key>.<content digest>.<ext>: the key is an HMAC of the synthesis
+    parameters under a server secret, so an audio URL can't be derived from a guessed
+    phrase; the digest gives each stored body a strong ETag.
+    """
+    # Partial writes older than this are left over from a crashed process
+    STALE_TEMP_SECONDS = 60
+
+    def __init__(self, directory: Path, max_bytes: int, secret: Optional[str] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._secret = secret.encode() if secret else None
+        self._entries: "OrderedDict[str, CachedAudio]" = OrderedDict()
+        self._inflight = SingleFlight()
+        self._loaded = False
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key_for(self, request: TTSRequest, synthesizer: SpeechSynthesizer) -> str:
+        params = [
+            synthesizer.name, request.text, request.voice_id, request.stability,
+            request.similarity_boost, request.style, request.use_speaker_boost
+        ]
+        return hmac.new(self._cache_secret(), json.dumps(params).encode(), hashlib.sha256).hexdigest()
+
+    def _cache_secret(self) -> bytes:
+        """The configured secret, or one generated on first use and shared through the cache directory"""
+        if self._secret is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self.directory / ".secret"
+            if not path.exists():
+                # Written aside and linked into place, so concurrent workers agree on one secret
+                secret = secrets.token_hex(32).encode()
+                temp_path = self.directory / f".secret.{uuid.uuid4().hex[:8]}.tmp"
+                temp_path.touch(mode=0o600)
+                temp_path.write_bytes(secret)
+                try:
+                    os.link(temp_path, path)
+                except FileExistsError:
+                    pass
+                finally:
+                    temp_path.unlink(missing_ok=True)
+            self._secret = path.read_bytes().strip()
+        return self._secret
+
+    def _load(self):
+        if self._loaded:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in self.directory.glob("*.*.*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.name.endswith(".tmp"):
+                # Never index a partial write; remove it once it's clearly not in progress
+                if time.time() - stat.st_mtime > self.STALE_TEMP_SECONDS:
+                    path.unlink(missing_ok=True)
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort(key=lambda file: file[0])
+        for _, size, path in files:
+            key, digest, extension = path.name.split(".", 2)
+            self._entries[key] = CachedAudio(key, path, size, AUDIO_MEDIA_TYPES.get(extension, "application/octet-stream"), f'"{digest}"')
+            self.total_bytes += size
+        self._loaded = True
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self.total_bytes -= entry.size
+            self.evictions += 1
+            entry.path.unlink(missing_ok=True)
+
+    def get(self, key: str) -> Optional[CachedAudio]:
+        self._load()
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if not entry.path.exists():
+            self.discard(entry)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def discard(self, entry: CachedAudio):
+        """Forget an entry whose file went missing (evicted or removed under us)"""
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+            self.total_bytes -= entry.size
+
+    def _write(self, key: str, audio: bytes, extension: str) -> Path:
+        digest = hashlib.sha256(audio).hexdigest()[:32]
+        path = self.directory / f"{key}.{digest}.{extension}"
+        temp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        temp_path.write_bytes(audio)
+        os.replace(temp_path, path)
+        return path
+
+    async def get_or_synthesize(self, request: TTSRequest, synthesizer: SpeechSynthesizer):
+        """Return (entry, cached), synthesizing at most once per key even under concurrency"""
+        key = self.key_for(request, synthesizer)
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            os.utime(entry.path)
+            return entry, True
+
+        # Joining a synthesis already in flight counts as a hit. Synthesis runs detached, so a
+        # cancelled caller (e.g. a disconnected stream) doesn't fail others waiting on the phrase
+        cached = key in self._inflight
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return await self._inflight.run(key, lambda: self._synthesize(key, request, synthesizer)), cached
+
+    async def _synthesize(self, key: str, request: TTSRequest, synthesizer: SpeechSynthesizer) -> CachedAudio:
+        audio = await synthesizer.synthesize(request)
+        path = await asyncio.to_thread(self._write, key, audio, synthesizer.extension)
+        entry = CachedAudio(key, path, len(audio), synthesizer.media_type, f'"{path.name.split(".")[1]}"')
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.total_bytes -= previous.size
+            if previous.path != path:
+                previous.path.unlink(missing_ok=True)
+        self._entries[key] = entry
+        self.total_bytes += entry.size
+        self._evict()
+        return entry
+
+    async def audio(self, request: TTSRequest, synthesizer: SpeechSynthesizer) -> bytes:
+        """Audio bytes for a request, synthesizing again if the cached file is evicted before it is read"""
+        while True:
+            entry, _ = await self.get_or_synthesize(request, synthesizer)
+            try:
+                return await asyncio.to_thread(entry.path.read_bytes)
+            except FileNotFoundError:
+                self.discard(entry)
+
+    def stats(self) -> Dict[str, Any]:
+        self._load()
+        return {
+            "entries": len(self._entries),
+            "total_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+tts_audio_cache = TTSAudioCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, TTS_CACHE_SECRET)
+
+def split_tts_text(text: str, min_chars: int) -> List[str]:
+    """Split text at sentence boundaries, merging short sentences into chunks of at least min_chars"""
+    chunks = []
+    current = ""
+    for sentence in re.split(r"(?<=[.!?;:])\s+", text.strip()):
+        current = f"{current} {sentence}".strip()
+        if len(current) >= min_chars:
+            chunks.append(current)
+            current = ""
+    if current:
+        if chunks and len(current) < min_chars // 2:
+            chunks[-1] = f"{chunks[-1]} {current}"
+        else:
+            chunks.append(current)
+    return chunks
+
+async def stream_tts_chunks(request: TTSRequest, chunks: List[str], synthesizer: SpeechSynthesizer):
+    """Synthesize chunks a bounded window ahead of the one being sent and yield their frames in order
+
+    At most TTS_STREAM_CONCURRENCY chunks are synthesizing or waiting to be sent, so a slow client
+    holds back synthesis instead of letting the whole reply pile up in memory.
+    """
+    started = time.perf_counter()
+    window = max(1, TTS_STREAM_CONCURRENCY)
+    remaining = deque(chunks)
+    in_flight: deque = deque()
+
+    def read_ahead():
+        while remaining and len(in_flight) < window:
+            text = remaining.popleft()
+            in_flight.append(asyncio.create_task(tts_audio_cache.audio(request.copy(update={"text": text}), synthesizer)))
+
+    try:
+        yield synthesizer.stream_header()
+        read_ahead()
+        index = 0
+        while in_flight:
+            audio = await in_flight[0]
+            in_flight.popleft()
+            read_ahead()
+            if index == 0:
+                first_audio = time.perf_counter() - started
+            index += 1
+            yield synthesizer.stream_frames(audio)
+        logger.info(
+            f"TTS stream: {len(chunks)} chunks, first audio after {first_audio * 1000:.1f} ms, "
+            f"total {(time.perf_counter() - started) * 1000:.1f} ms"
+        )
+    finally:
+        # Client went away or a chunk failed: stop reading ahead and cancel what is pending
+        remaining.clear()
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+def parse_range_header(range_header: str, size: int):
+    """Parse a single 'bytes=start-end' range; returns (start, end) inclusive or None if unsatisfiable"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    try:
+        if start:
+            start, end = int(start), int(end) if end else size - 1
+        else:
+            length = int(end)
+            if length <= 0:
+                return None
+            start, end = max(0, size - length), size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, min(end, size - 1)
+
+def read_audio_range(path: Path, start: int, length: int) -> bytes:
+    with open(path, "rb") as audio_file:
+        audio_file.seek(start)
+        return audio_file.read(length)
+
+# Speech transcription
+class SpeechTranscriber:
+    """Backend that turns an uploaded audio file into text; runs on a worker thread"""
+    name = "base"
+
+    def transcribe(self, audio, filename: str) -> str:
+        raise NotImplementedError
+
+    def partial(self, received_bytes: int) -> Optional[str]:
+        """Interim transcript while audio is still streaming in, if the backend offers one"""
+        return None
+
+class FakeSpeechTranscriber(SpeechTranscriber):
+    """Local stand-in that consumes the upload and returns a fixed phrase"""
+    name = "fake"
+
+    def __init__(self, latency: float = 0.0, text: str = "Hello F.A.R.H.A"):
+        self.latency = latency
+        self.text = text
+
+    def transcribe(self, audio, filename: str) -> str:
+        while audio.read(STT_UPLOAD_CHUNK_BYTES):
+            pass
+        if self.latency:
+            time.sleep(self.latency)
+        return self.text
+
+    def partial(self, received_bytes: int) -> Optional[str]:
+        words = self.text.split()
+        return " ".join(words[:min(len(words), received_bytes // 4096)]) or None
+
+class ElevenLabsSpeechTranscriber(SpeechTranscriber):
+    name = "elevenlabs"
+
+    def __init__(self, model_id: str):
+        self.model_id = model_id
+
+    def transcribe(self, audio, filename: str) -> str:
+        result = get_elevenlabs_client().speech_to_text.convert(file=(filename, audio), model_id=self.model_id)
+        return result.text
+
+def create_speech_transcriber() -> SpeechTranscriber:
+    if STT_BACKEND == "elevenlabs":
+        if not ELEVENLABS_API_KEY:
+            raise RuntimeError("STT_BACKEND=elevenlabs requires ELEVENLABS_API_KEY")
+        return ElevenLabsSpeechTranscriber(STT_MODEL_ID)
+    return FakeSpeechTranscriber(latency=STT_FAKE_LATENCY_SECONDS)
+
+class TranscriptionPool:
+    """Bounded worker pool for transcription; async-mode jobs are tracked in the `stt_jobs` collection"""
+
+    def __init__(self, transcriber: SpeechTranscriber, max_workers: int, max_pending: int, job_ttl_seconds: float):
+        self.transcriber = transcriber
+        self.max_pending = max_pending
+        self.job_ttl_seconds = job_ttl_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stt")
+        self.pending = 0
+        self._tasks: Dict[asyncio.Task, str] = {}
+
+    def _reserve(self):
+        if self.pending >= self.max_pending:
+            raise HTTPException(
+                status_code=503,
+                detail="Transcription queue is full",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+
+    def _transcribe_and_close(self, audio, filename: str) -> str:
+        try:
+            return self.transcriber.transcribe(audio, filename)
+        finally:
+            audio.close()
+
+    async def _run(self, audio, filename: str) -> str:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._transcribe_and_close, audio, filename
+            )
+        finally:
+            self.pending -= 1
+
+    async def transcribe(self, audio, filename: str) -> str:
+        self._reserve()
+        return await self._run(audio, filename)
+
+    async def transcribe_stream(self, frames, filename: str):
+        """Spool streamed audio frames, yielding (False, partial) while receiving and (True, text) at the end"""
+        spool = tempfile.SpooledTemporaryFile(max_size=STT_SPOOL_MEMORY_BYTES)
+        size = 0
+        last_partial = None
+        try:
+            async for frame in frames:
+                size += len(frame)
+                if size > STT_MAX_UPLOAD_BYTES:
+                    raise ValueError(f"Audio stream exceeds {STT_MAX_UPLOAD_BYTES} bytes")
+                spool.write(frame)
+                partial = self.transcriber.partial(size)
+                if partial and partial != last_partial:
+                    last_partial = partial
+                    yield False, partial
+            if size == 0:
+                raise ValueError("Audio stream is empty")
+            spool.seek(0)
+            self._reserve()
+        except BaseException:
+            spool.close()
+            raise
+        yield True, await self._run(spool, filename)
+
+    async def submit_job(self, user_id: str, audio, filename: str) -> Dict[str, Any]:
+        """Record a queued job in `stt_jobs`, so a poll served by any worker can find it, then start it here"""
+        self._reserve()
+        now = utc_now()
+        job = {
+            "job_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "status": "queued",
+            "filename": filename,
+            "transcribed_text": None,
+            "error": None,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=self.job_ttl_seconds)
+        }
+        try:
+            await db.stt_jobs.insert_one(dict(job))
+        except BaseException:
+            self.pending -= 1
+            raise
+        task = asyncio.create_task(self._run_job(job, audio))
+        self._tasks[task] = job["job_id"]
+        task.add_done_callback(lambda done: self._tasks.pop(done, None))
+        return job
+
+    async def _run_job(self, job: Dict[str, Any], audio):
+        try:
+            update = {"status": "completed", "transcribed_text": await self._run(audio, job["filename"])}
+        except Exception as e:
+            logger.error(f"Error in STT job {job['job_id']}: {str(e)}")
+            update = {"status": "failed", "error": str(e)}
+        await self._finish_job(job["job_id"], update)
+
+    async def _finish_job(self, job_id: str, update: Dict[str, Any]):
+        # The result is kept for the TTL from completion; Mongo's TTL monitor removes it after that
+        update["expires_at"] = utc_now() + timedelta(seconds=self.job_ttl_seconds)
+        try:
+            await db.stt_jobs.update_one({"job_id": job_id}, {"$set": update})
+        except Exception as e:
+            logger.error(f"Error saving STT job {job_id}: {str(e)}")
+
+    async def get_job(self, job_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        now = datetime.now(timezone.utc)
+        job = await db.stt_jobs.find_one(
+            {"job_id": job_id, "user_id": user_id, "expires_at": {"$gt": now}}, {"_id": 0}
+        )
+        if job and job["status"] == "queued" and job["created_at"] < now - timedelta(seconds=STT_JOB_TIMEOUT_SECONDS):
+            # Its worker restarted or died before finishing
+            job.update(status="failed", error="Transcription was interrupted")
+        return job
+
+    async def shutdown(self):
+        interrupted = list(self._tasks.values())
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if interrupted:
+            try:
+                await db.stt_jobs.update_many(
+                    {"job_id": {"$in": interrupted}, "status": "queued"},
+                    {"$set": {"status": "failed", "error": "Transcription was interrupted"}}
+                )
+            except Exception as e:
+                logger.error(f"Error marking interrupted STT jobs: {str(e)}")
+
+transcription_pool = TranscriptionPool(
+    create_speech_transcriber(), STT_WORKERS, STT_MAX_PENDING_JOBS, STT_JOB_TTL_SECONDS
 )
 
+# Room for the multipart boundaries and part headers around the file itself
+STT_MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+async def spool_multipart_upload(request: Request, field: str = "audio_file") -> tuple:
+    """Stream a multipart body's `field` file straight into one spooled temp file; returns (spool, filename)
+
+    The size limit is checked against Content-Length before reading and then per received
+    chunk, so an oversized upload is rejected early rather than after being spooled in full.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > STT_MAX_UPLOAD_BYTES + STT_MULTIPART_OVERHEAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Audio file exceeds {STT_MAX_UPLOAD_BYTES} bytes")
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+
+    spool = tempfile.SpooledTemporaryFile(max_size=STT_SPOOL_MEMORY_BYTES)
+    part = {"headers": {}, "field": b"", "value": b"", "target": False}
+    upload = {"found": False, "filename": None, "size": 0}
+
+    def on_part_begin():
+        part.update(headers={}, target=False)
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part.update(field=b"", value=b"")
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        if disposition.get(b"name") == field.encode() and not upload["found"]:
+            part["target"] = True
+            upload["found"] = True
+            upload["filename"] = disposition.get(b"filename", b"").decode("utf-8", "replace") or None
+
+    def on_part_data(data, start, end):
+        if part["target"]:
+            upload["size"] += end - start
+            if upload["size"] <= STT_MAX_UPLOAD_BYTES:
+                spool.write(data[start:end])
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if upload["size"] > STT_MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"Audio file exceeds {STT_MAX_UPLOAD_BYTES} bytes")
+        parser.finalize()
+        if not upload["found"]:
+            raise HTTPException(status_code=400, detail=f"{field} required")
+        if upload["size"] == 0:
+            raise HTTPException(status_code=400, detail="Audio file is empty")
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, upload["filename"]
+
+# Voice WebSocket pipeline
+SENTENCE_BOUNDARY = re.compile(r"[.!?;:](?:\s+|$)")
+
+async def voice_ws_sender(websocket: WebSocket, outbound: asyncio.Queue):
+    """Single writer for the socket: JSON events and binary audio frames, in queue order"""
+    while True:
+        item = await outbound.get()
+        if isinstance(item, bytes):
+            await websocket.send_bytes(item)
+        else:
+            await websocket.send_json(item)
+
+async def voice_tts_stage(sentences: asyncio.Queue, template: TTSRequest, outbound: asyncio.Queue, timings: Dict[str, float], started: float):
+    """Synthesize sentences as they arrive, up to TTS_STREAM_CONCURRENCY at once, emitting audio in order"""
+    in_flight: asyncio.Queue = asyncio.Queue(maxsize=max(1, TTS_STREAM_CONCURRENCY))
+
+    async def synthesize(text: str) -> bytes:
+        return await tts_audio_cache.audio(template.copy(update={"text": text}), speech_synthesizer)
+
+    async def produce():
+        while True:
+            text = await sentences.get()
+            if text is None:
+                await in_flight.put(None)
+                return
+            await in_flight.put((text, asyncio.create_task(synthesize(text))))
+
+    producer = asyncio.create_task(produce())
+    pending_tasks = []
+    try:
+        index = 0
+        while True:
+            item = await in_flight.get()
+            if item is None:
+                break
+            text, task = item
+            pending_tasks.append(task)
+            audio = await task
+            if index == 0:
+                timings["first_audio_ms"] = (time.perf_counter() - started) * 1000
+                await outbound.put({"type": "audio_start", "media_type": speech_synthesizer.media_type})
+                await outbound.put(speech_synthesizer.stream_header())
+            await outbound.put({"type": "audio", "index": index, "text": text})
+            await outbound.put(speech_synthesizer.stream_frames(audio))
+            index += 1
+        await producer
+    finally:
+        producer.cancel()
+        while not in_flight.empty():
+            item = in_flight.get_nowait()
+            if item is not None:
+                pending_tasks.append(item[1])
+        for task in pending_tasks:
+            task.cancel()
+        await asyncio.gather(producer, *pending_tasks, return_exceptions=True)
+
+async def run_voice_turn(user: User, config: Dict[str, Any], audio_frames: asyncio.Queue, outbound: asyncio.Queue):
+    """One voice turn: streamed STT -> streamed LLM tokens -> sentence-wise TTS, overlapped"""
+
+    started = None
+
+    async def frames():
+        nonlocal started
+        try:
+            while True:
+                frame = await audio_frames.get()
+                if frame is None:
+                    started = time.perf_counter()
+                    return
+                yield frame
+        finally:
+            # Unblock a receive loop waiting on a full queue if this turn stops early
+            while not audio_frames.empty():
+                audio_frames.get_nowait()
+
+    transcript = None
+    async for is_final, text in transcription_pool.transcribe_stream(frames(), config.get("filename", "voice.webm")):
+        await outbound.put({"type": "transcript", "final": is_final, "text": text})
+        if is_final:
+            transcript = text
+    # Latencies are measured from the end of the user's audio
+    timings = {"transcript_ms": (time.perf_counter() - started) * 1000}
+    if not transcript or not transcript.strip():
+        await outbound.put({"type": "error", "detail": "No speech recognized"})
+        return
+
+    conversation_id = config.get("conversation_id") or str(uuid.uuid4())
+    context = await conversation_contexts.get(user.id, conversation_id)
+    chat = create_farha_chat(user.id, conversation_id, context)
+    template = TTSRequest(text=".", **{
+        key: config[key] for key in ("voice_id", "stability", "similarity_boost", "style", "use_speaker_boost") if key in config
+    })
+
+    llm_scheduler.admit(user.id)
+    sentences: asyncio.Queue = asyncio.Queue(maxsize=VOICE_WS_QUEUE_SIZE)
+    tts_task = asyncio.create_task(voice_tts_stage(sentences, template, outbound, timings, started))
+    try:
+        chunks = []
+        pending = ""
+        async with llm_scheduler.slot(user.id):
+            async for chunk in chat.stream_message(UserMessage(text=transcript)):
+                if not chunks:
+                    timings["first_token_ms"] = (time.perf_counter() - started) * 1000
+                chunks.append(chunk)
+                await outbound.put({"type": "token", "text": chunk})
+                pending += chunk
+                # Hand complete sentences to TTS while the model keeps generating
+                while True:
+                    match = SENTENCE_BOUNDARY.search(pending, TTS_STREAM_MIN_CHUNK_CHARS)
+                    if not match:
+                        break
+                    await sentences.put(pending[:match.end()].strip())
+                    pending = pending[match.end():]
+        if pending.strip():
+            await sentences.put(pending.strip())
+        await sentences.put(None)
+
+        chat_message = ChatMessage(
+            user_id=user.id,
+            message=transcript,
+            response="".join(chunks),
+            is_voice=True,
+            conversation_id=conversation_id
+        )
+        await persist_chat_message(prepare_for_mongo(chat_message.dict()))
+        context.add_turn(chat_message.message, chat_message.response, chat_message.id)
+
+        await tts_task
+        timings["total_ms"] = (time.perf_counter() - started) * 1000
+        await outbound.put({
+            "type": "turn_end",
+            "message_id": chat_message.id,
+            "timestamp": chat_message.timestamp.isoformat(),
+            "conversation_id": conversation_id,
+            "transcript": transcript,
+            "timings": {key: round(value, 2) for key, value in timings.items()}
+        })
+    finally:
+        if not tts_task.done():
+            tts_task.cancel()
+            await asyncio.gather(tts_task, return_exceptions=True)
+
+async def authenticate_websocket(websocket: WebSocket) -> User:
+    """Authenticate once per connection from a first {"type": "auth", "token": ...} message
+
+    Tokens are never taken from the URL: servers and proxies log request paths with their query.
+    A first frame that isn't a JSON object raises KeyError (binary) or ValueError.
+    """
+    message = await asyncio.wait_for(websocket.receive_json(), timeout=VOICE_WS_AUTH_TIMEOUT)
+    if not isinstance(message, dict):
+        raise ValueError("Expected a JSON object")
+    if message.get("type") != "auth" or not message.get("token"):
+        raise HTTPException(status_code=401, detail="Authentication required")
+    return await resolve_session_user(message["token"])
+
+@api_router.websocket("/ws/voice")
+async def voice_websocket(websocket: WebSocket):
+    """Voice turns over one connection.
+
+    Client sends {"type": "auth", "token": ...} first, then per turn {"type": "start", ...options},
+    binary audio frames and {"type": "end"}.
+    Server pushes transcript, token, audio_start/audio (+ binary frames) and turn_end events.
+    """
+    await websocket.accept()
+    try:
+        user = await authenticate_websocket(websocket)
+    except (KeyError, ValueError):
+        await websocket.close(code=1008)
+        return
+    except (HTTPException, asyncio.TimeoutError, WebSocketDisconnect):
+        await websocket.close(code=4401)
+        return
+
+    outbound: asyncio.Queue = asyncio.Queue(maxsize=VOICE_WS_QUEUE_SIZE)
+    sender = asyncio.create_task(voice_ws_sender(websocket, outbound))
+    turn_task: Optional[asyncio.Task] = None
+    audio_frames: Optional[asyncio.Queue] = None
+
+    async def run_turn(config, frames):
+        try:
+            await run_voice_turn(user, config, frames, outbound)
+        except HTTPException as e:
+            await outbound.put({"type": "error", "detail": e.detail})
+        except Exception as e:
+            logger.error(f"Error in voice turn: {str(e)}")
+            await outbound.put({"type": "error", "detail": f"Error processing voice turn: {str(e)}"})
+
+    def start_turn(config):
+        nonlocal turn_task, audio_frames
+        audio_frames = asyncio.Queue(maxsize=VOICE_WS_QUEUE_SIZE)
+        turn_task = asyncio.create_task(run_turn(config, audio_frames))
+
+    await outbound.put({"type": "ready", "user_id": user.id})
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                if audio_frames is None:
+                    if turn_task is not None and not turn_task.done():
+                        await outbound.put({"type": "error", "detail": "Previous turn still in progress"})
+                        continue
+                    start_turn({})
+                if turn_task.done():
+                    continue  # Turn already failed; drop frames until the client sends "end"
+                await audio_frames.put(message["bytes"])
+                continue
+
+            try:
+                event = json.loads(message.get("text") or "{}")
+            except ValueError:
+                await outbound.put({"type": "error", "detail": "Invalid JSON message"})
+                continue
+            if event.get("type") == "start":
+                if turn_task is not None and not turn_task.done():
+                    await outbound.put({"type": "error", "detail": "Previous turn still in progress"})
+                    continue
+                start_turn(event)
+            elif event.get("type") == "end" and audio_frames is not None:
+                await audio_frames.put(None)
+                audio_frames = None
+            elif event.get("type") == "cancel" and turn_task is not None:
+                turn_task.cancel()
+                audio_frames = None
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in (turn_task, sender):
+            if task is not None and not task.done():
+                task.cancel()
+        await asyncio.gather(*(task for task in (turn_task, sender) if task is not None), return_exceptions=True)
+
+# Voice endpoints (require ElevenLabs API key setup)
+@api_router.post("/voice/tts", response_model=TTSResponse)
+async def text_to_speech(request: TTSRequest, current_user: User = Depends(get_current_user)):
+    """Convert text to speech, serving repeated phrases from the audio cache"""
+    try:
+        entry, cached = await tts_audio_cache.get_or_synthesize(request, speech_synthesizer)
+        return TTSResponse(
+            audio_url=f"/api/voice/audio/{entry.key}",
+            text=request.text,
+            voice_id=request.voice_id,
+            cached=cached
+        )
+        
+    except Exception as e:
+        logger.error(f"Error in TTS: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error generating speech: {str(e)}")
+
+@api_router.post("/voice/tts/stream")
+async def stream_text_to_speech(request: TTSRequest, current_user: User = Depends(get_current_user)):
+    """Stream synthesized speech chunk by chunk, starting as soon as the first sentence is ready"""
+    chunks = split_tts_text(request.text, TTS_STREAM_MIN_CHUNK_CHARS)
+    if not chunks:
+        raise HTTPException(status_code=400, detail="Text required")
+    return StreamingResponse(
+        stream_tts_chunks(request, chunks, speech_synthesizer),
+        media_type=speech_synthesizer.media_type,
+        headers={"Cache-Control": "no-store", "X-TTS-Chunks": str(len(chunks))}
+    )
+
+@api_router.get("/voice/audio/{audio_hash}")
+async def get_voice_audio(audio_hash: str, http_request: Request):
+    """Serve cached synthesized audio with strong ETags and byte-range support
+
+    The URL is unguessable (an HMAC key) but not tied to a session, since <audio> elements can't
+    send one; responses are private so shared caches never keep a user's audio.
+    """
+    entry = tts_audio_cache.get(audio_hash) if re.fullmatch(r"[0-9a-f]{64}", audio_hash) else None
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Audio not found")
+
+    headers = {
+        "ETag": entry.etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=31536000, immutable"
+    }
+    if is_not_modified(http_request, entry.etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = http_request.headers.get("range")
+    if_range = http_request.headers.get("if-range")
+    if range_header and (not if_range or if_range == entry.etag):
+        byte_range = parse_range_header(range_header, entry.size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{entry.size}"
+            return Response(status_code=416, headers=headers)
+        start, end = byte_range
+        try:
+            content = await asyncio.to_thread(read_audio_range, entry.path, start, end - start + 1)
+        except FileNotFoundError:
+            tts_audio_cache.discard(entry)
+            raise HTTPException(status_code=404, detail="Audio not found")
+        headers["Content-Range"] = f"bytes {start}-{end}/{entry.size}"
+        return Response(content=content, status_code=206, media_type=entry.media_type, headers=headers)
+
+    try:
+        content = await asyncio.to_thread(entry.path.read_bytes)
+    except FileNotFoundError:
+        # Evicted between the lookup and the read
+        tts_audio_cache.discard(entry)
+        raise HTTPException(status_code=404, detail="Audio not found")
+    return Response(content=content, media_type=entry.media_type, headers=headers)
+
+@api_router.post("/voice/stt", response_model=STTResponse)
+async def speech_to_text(
+    request: Request,
+    mode: str = "sync",
+    current_user: User = Depends(get_current_user)
+):
+    """Convert speech to text (multipart `audio_file`); mode=async queues a job and returns 202 with its status URL"""
+    try:
+        if mode not in ("sync", "async"):
+            raise HTTPException(status_code=400, detail="mode must be 'sync' or 'async'")
+        
+        # Parsed here rather than through File(...), which spools the whole part uncapped first
+        audio, filename = await spool_multipart_upload(request)
+        filename = filename or "unknown.audio"
+        
+        if mode == "async":
+            try:
+                job = await transcription_pool.submit_job(current_user.id, audio, filename)
+            except Exception:
+                audio.close()
+                raise
+            status_url = f"/api/voice/stt/jobs/{job['job_id']}"
+            return JSONResponse(
+                status_code=202,
+                content={"job_id": job["job_id"], "status": job["status"], "status_url": status_url},
+                headers={"Location": status_url}
+            )
+        
+        try:
+            transcribed_text = await transcription_pool.transcribe(audio, filename)
+        except HTTPException:
+            audio.close()
+            raise
+        return STTResponse(transcribed_text=transcribed_text, filename=filename)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in STT: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error transcribing audio: {str(e)}")
+
+@api_router.get("/voice/stt/jobs/{job_id}", response_model=STTJobResponse)
+async def get_speech_to_text_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """Poll an async transcription job"""
+    job = await transcription_pool.get_job(job_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Transcription job not found")
+    return STTJobResponse(**job)
+
+# Mock voice list for now; serialized once, with validators fixed at startup
+AVAILABLE_VOICES_BODY = orjson.dumps({
+    "voices": [
+        {"id": "21m00Tcm4TlvDq8ikWAM", "name": "Rachel", "category": "premade"},
+        {"id": "AZnzlk1XvdvUeBnXmlld", "name": "Domi", "category": "premade"},
+        {"id": "EXAVITQu4vr4xnSDxMaL", "name": "Bella", "category": "premade"}
+    ]
+})
+AVAILABLE_VOICES_ETAG = weak_etag("voices", AVAILABLE_VOICES_BODY.decode())
+AVAILABLE_VOICES_LAST_MODIFIED = datetime.now(timezone.utc)
+
+@api_router.get("/voice/voices")
+async def get_available_voices(http_request: Request, current_user: User = Depends(get_current_user)):
+    """Get available voices for TTS"""
+    headers = http_cache_headers(
+        AVAILABLE_VOICES_ETAG, AVAILABLE_VOICES_LAST_MODIFIED, f"private, max-age={VOICES_CACHE_MAX_AGE_SECONDS}"
+    )
+    if is_not_modified(http_request, AVAILABLE_VOICES_ETAG, AVAILABLE_VOICES_LAST_MODIFIED):
+        return Response(status_code=304, headers=headers)
+    return Response(content=AVAILABLE_VOICES_BODY, media_type="application/json", headers=headers)
+
+@api_router.get("/auth/exchange/stats", dependencies=[Depends(require_ops_token)])
+async def get_session_exchange_stats():
+    """Get session exchange single-flight and result cache counters"""
+    return session_exchanges.stats()
+
+@api_router.get("/auth/cache/stats", dependencies=[Depends(require_ops_token)])
+async def get_session_cache_stats():
+    """Get session cache hit/miss counters"""
+    return session_cache.stats()
+
+@api_router.get("/voice/cache/stats", dependencies=[Depends(require_ops_token)])
+async def get_tts_cache_stats():
+    """Get TTS audio cache size and hit/miss counters"""
+    return tts_audio_cache.stats()
+
+@api_router.get("/chat/write-buffer/stats", dependencies=[Depends(require_ops_token)])
+async def get_chat_write_buffer_stats():
+    """Get write-behind buffer depth and throughput counters"""
+    if chat_write_buffer is None:
+        return {"enabled": False}
+    return {"enabled": True, **chat_write_buffer.stats()}
+
+@api_router.get("/chat/cache/stats", dependencies=[Depends(require_ops_token)])
+async def get_response_cache_stats():
+    """Get response cache hit rate and latency saved"""
+    return response_cache.stats()
+
+@api_router.get("/chat/archive/stats", dependencies=[Depends(require_ops_token)])
+async def get_chat_archive_stats():
+    """Get the last archival run's counts and before/after storage sizes"""
+    return chat_archive.last_report or {"archived_messages": 0, "last_run": None}
+
+@api_router.get("/chat/search/stats", dependencies=[Depends(require_ops_token)])
+async def get_chat_search_stats():
+    """Get the active search backend and in-process index size"""
+    return chat_search.stats()
+
+@api_router.get("/chat/scheduler/stats", dependencies=[Depends(require_ops_token)])
+async def get_llm_scheduler_stats():
+    """Get LLM admission control queue depth, rejections and wait time"""
+    return llm_scheduler.stats()
+
+# User profile
+@api_router.get("/user/profile", response_model=User)
+async def get_user_profile(http_request: Request, current_user: User = Depends(get_current_user)):
+    """Get current user profile (the ETag is a digest of the profile fields)"""
+    profile = current_user.dict()
+    etag = weak_etag("profile", profile)
+    headers = http_cache_headers(etag)
+    if is_not_modified(http_request, etag):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(profile, headers=headers)
+
+# Health check
+@api_router.get("/health")
+async def health_check():
+    return {"status": "healthy", "service": "F.A.R.H.A AI Assistant"}
+
+@api_router.get("/ready")
+async def readiness_check():
+    """Readiness probe: 503 until startup warmup has finished and again once shutdown begins"""
+    if not app_ready:
+        return JSONResponse(status_code=503, content={"status": "not ready"})
+    return {"status": "ready", "startup_ms": round(startup_seconds * 1000, 2)}
+
+# Metrics endpoints
+def cache_metrics():
+    gauges = [
+        ("farha_session_cache_hits_total", "counter", "Session cache hits", {}, session_cache.hits),
+        ("farha_session_cache_misses_total", "counter", "Session cache misses", {}, session_cache.misses),
+        ("farha_response_cache_hits_total", "counter", "Response cache hits", {}, response_cache.hits),
+        ("farha_response_cache_misses_total", "counter", "Response cache misses", {}, response_cache.misses),
+        ("farha_tts_cache_hits_total", "counter", "TTS audio cache hits", {}, tts_audio_cache.hits),
+        ("farha_tts_cache_misses_total", "counter", "TTS audio cache misses", {}, tts_audio_cache.misses),
+        ("farha_stt_pending", "gauge", "Transcriptions queued or running", {}, transcription_pool.pending),
+        ("farha_llm_active", "gauge", "LLM calls in flight", {}, llm_scheduler.active),
+        ("farha_llm_queue_depth", "gauge", "LLM calls waiting for a slot", {}, llm_scheduler.queued),
+        ("farha_auth_exchanges_total", "counter", "Session exchanges sent upstream", {}, session_exchanges.exchanges),
+        ("farha_auth_exchanges_coalesced_total", "counter", "Session exchanges joined to one in flight", {}, session_exchanges.coalesced),
+        ("farha_auth_exchange_cache_hits_total", "counter", "Session exchanges served from the result cache", {}, session_exchanges.cache_hits)
+    ]
+    if chat_write_buffer is not None:
+        gauges.append(("farha_chat_write_buffered", "gauge", "Chat messages awaiting write-behind", {}, len(chat_write_buffer._queue)))
+    return gauges
+
+metrics.add_collector(cache_metrics)
+
+@api_router.get("/metrics", dependencies=[Depends(require_ops_token)])
+async def get_metrics():
+    """Prometheus metrics"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@api_router.get("/metrics/profile", dependencies=[Depends(require_ops_token)])
+async def get_profile(reset: bool = False):
+    """Folded stacks from the sampling profiler (PROFILE_ENABLED + PROFILE_ROUTES)"""
+    if stack_sampler is None:
+        raise HTTPException(status_code=404, detail="Profiling is not enabled")
+    folded = stack_sampler.folded()
+    if reset:
+        stack_sampler.stacks = {}
+    return Response(content=folded, media_type="text/plain")
+
 # Logging
 logging.basicConfig(
     level=logging.INFO,
@@ -340,6 +3704,230 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# Database indexes and maintenance
+async def create_indexes(strict: bool = True):
+    """Create the indexes the auth and chat queries rely on
+
+    At startup (strict=False) an index that can't be built, e.g. the unique email index over
+    duplicate users from before the atomic upsert, is logged and skipped instead of keeping
+    every worker from becoming ready; `migrate-dates` fixes the data and builds it strictly.
+    """
+    async def ensure(collection, keys, **options):
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            if strict:
+                raise
+            logger.error(f"Could not create index {keys} on {collection.name}, run 'python server.py migrate-dates': {str(e)}")
+
+    await ensure(db.auth_sessions, "session_token", unique=True)
+    await ensure(db.auth_sessions, [("user_id", ASCENDING), ("created_at", DESCENDING)])
+    if SESSION_TTL_INDEX_ENABLED:
+        # Mongo's TTL monitor removes sessions once expires_at (a native date) has passed
+        await ensure(db.auth_sessions, "expires_at", expireAfterSeconds=0)
+    else:
+        await ensure(db.auth_sessions, "expires_at")
+    await ensure(db.users, "email", unique=True)
+    await ensure(db.users, "id", unique=True)
+    # Write-behind retries and imports count duplicate keys on id as already written
+    await ensure(db.chat_messages, "id", unique=True)
+    await ensure(db.chat_messages, [("user_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)])
+    await ensure(db.chat_messages, [
+        ("user_id", ASCENDING), ("conversation_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)
+    ])
+    await ensure(db.chat_archive, [("user_id", ASCENDING), ("last_timestamp", DESCENDING)])
+    await ensure(db.chat_archive, [("user_id", ASCENDING), ("conversation_ids", ASCENDING)])
+    await ensure(db.stt_jobs, "job_id", unique=True)
+    await ensure(db.stt_jobs, "expires_at", expireAfterSeconds=0)
+    # Prefixed by user_id so every search is confined to one user's entries in the index
+    await ensure(db.chat_messages, 
+        [("user_id", ASCENDING), ("message", TEXT), ("response", TEXT)],
+        weights={"message": 2, "response": 1},
+        name="chat_text"
+    )
+
+async def migrate_datetime_fields(batch_size: int = 1000) -> Dict[str, int]:
+    """Convert ISO-string dates written by older versions into native BSON dates"""
+    fields_by_collection = {
+        "users": ["created_at"],
+        "auth_sessions": ["created_at", "expires_at"],
+        "chat_messages": ["timestamp"]
+    }
+    migrated = {}
+    for collection_name, fields in fields_by_collection.items():
+        collection = db[collection_name]
+        query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        projection = {field: 1 for field in fields}
+        operations = []
+        count = 0
+        async for document in collection.find(query, projection).batch_size(batch_size):
+            parsed = parse_from_mongo(dict(document))
+            updates = {
+                field: parsed[field] for field in fields
+                if isinstance(document.get(field), str) and isinstance(parsed.get(field), datetime)
+            }
+            if not updates:
+                continue
+            operations.append(UpdateOne({"_id": document["_id"]}, {"$set": updates}))
+            if len(operations) >= batch_size:
+                await collection.bulk_write(operations, ordered=False)
+                count += len(operations)
+                operations = []
+        if operations:
+            await collection.bulk_write(operations, ordered=False)
+            count += len(operations)
+        migrated[collection_name] = count
+        logger.info(f"Migrated {count} {collection_name} documents to native dates")
+    return migrated
+
+async def merge_duplicate_users() -> Dict[str, int]:
+    """Fold users sharing an email (left by the old find-then-insert login race) into the oldest one
+
+    Their sessions, hot messages and archived months move to the kept user, so the unique
+    email index can be built afterwards.
+    """
+    merged = {"users": 0, "auth_sessions": 0, "chat_messages": 0, "archived_months": 0}
+    duplicates_by_email = db.users.aggregate([
+        {"$match": {"email": {"$ne": None}}},
+        {"$group": {"_id": "$email", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ])
+    async for group in duplicates_by_email:
+        users = await db.users.find({"email": group["_id"]}, {"_id": 1, "id": 1, "created_at": 1}).sort(
+            [("created_at", ASCENDING), ("_id", ASCENDING)]
+        ).to_list(None)
+        keep, duplicates = users[0], users[1:]
+        duplicate_ids = [user["id"] for user in duplicates]
+        moved = {"$set": {"user_id": keep["id"]}}
+        merged["auth_sessions"] += (await db.auth_sessions.update_many({"user_id": {"$in": duplicate_ids}}, moved)).modified_count
+        merged["chat_messages"] += (await db.chat_messages.update_many({"user_id": {"$in": duplicate_ids}}, moved)).modified_count
+        blobs = await db.chat_archive.find({"user_id": {"$in": duplicate_ids}}, {"_id": 1, "month": 1}).to_list(None)
+        for blob in blobs:
+            stored = await db.chat_archive.find_one({"_id": blob["_id"]}, {"data": 1, "codec": 1})
+            rows = await asyncio.to_thread(unpack_archive_rows, stored["data"], stored["codec"])
+            await chat_archive._write_month(keep["id"], blob["month"], rows, archive_codec())
+            await db.chat_archive.delete_one({"_id": blob["_id"]})
+            merged["archived_months"] += 1
+        await db.users.delete_many({"_id": {"$in": [user["_id"] for user in duplicates]}})
+        await bump_history_version(keep["id"])
+        merged["users"] += len(duplicates)
+    logger.info(f"Merged {merged['users']} duplicate users")
+    return merged
+
+async def warm_up_database():
+    """Ping Mongo until it answers, so the first request does not pay for connection setup"""
+    for attempt in range(STARTUP_DB_PING_RETRIES + 1):
+        try:
+            await db.command("ping")
+            return
+        except Exception as e:
+            if attempt == STARTUP_DB_PING_RETRIES:
+                raise
+            logger.warning(f"Database not reachable yet ({str(e)}), retrying")
+            await asyncio.sleep(STARTUP_DB_PING_BACKOFF_SECONDS * (2 ** attempt))
+
+# Lifespan
+app_ready = False
+startup_seconds = 0.0
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create and warm pools before reporting ready; drain and close them on shutdown"""
+    global app_ready, startup_seconds
+    started = time.perf_counter()
+    if stack_sampler is not None:
+        stack_sampler.start()
+    connect_database()
+    await warm_up_database()
+    await create_indexes(strict=False)
+    get_http_client()
+    if chat_write_buffer is not None:
+        chat_write_buffer.start()
+    if session_sweeper is not None:
+        session_sweeper.start()
+    if chat_archiver is not None:
+        chat_archiver.start()
+    startup_seconds = time.perf_counter() - started
+    app_ready = True
+    logger.info(f"Ready in {startup_seconds * 1000:.1f}ms")
+    try:
+        yield
+    finally:
+        app_ready = False
+        if chat_archiver is not None:
+            await chat_archiver.stop()
+        if session_sweeper is not None:
+            await session_sweeper.stop()
+        # Before the client closes, so interrupted jobs can still be marked failed
+        await transcription_pool.shutdown()
+        if chat_write_buffer is not None:
+            await chat_write_buffer.drain()
+        client.close()
+        if http_client is not None:
+            await http_client.aclose()
+
+# Create the main app
+app = FastAPI(title="F.A.R.H.A AI Assistant", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Include router
+app.include_router(api_router)
+
+# Response compression (inside the metrics middleware, so its cost is measured)
+if HTTP_COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware, min_bytes=HTTP_COMPRESSION_MIN_BYTES)
+
+# Request metrics
+app.add_middleware(MetricsMiddleware)
+
+# CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_credentials=True,
+    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="F.A.R.H.A backend maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser(
+        "migrate-dates",
+        help="Convert string-dated documents to native dates, merge duplicate users and build indexes; run before deploying"
+    )
+    migrate_parser.add_argument("--batch-size", type=int, default=1000)
+    sweep_parser = subparsers.add_parser("sweep-sessions", help="Delete expired auth sessions")
+    sweep_parser.add_argument("--batch-size", type=int, default=SESSION_SWEEP_BATCH_SIZE)
+    archive_parser = subparsers.add_parser("archive-history", help="Move cold chat history into compressed monthly blobs")
+    archive_parser.add_argument("--after-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    import_parser = subparsers.add_parser("import-history", help="Import NDJSON (optionally gzip) chat messages")
+    import_parser.add_argument("path", help="NDJSON file, or - for stdin")
+    import_parser.add_argument("--user-id", help="Import every message for this user instead of the user_id in the file")
+    args = parser.parse_args(argv)
+    connect_database()
+
+    if args.command == "migrate-dates":
+        async def run_migration():
+            migrated = await migrate_datetime_fields(batch_size=args.batch_size)
+            merged = await merge_duplicate_users()
+            await create_indexes()
+            return {"migrated": migrated, "merged": merged}
+        print(asyncio.run(run_migration()))
+    elif args.command == "sweep-sessions":
+        print({"swept": asyncio.run(SessionSweeper(0, args.batch_size).sweep())})
+    elif args.command == "archive-history":
+        print(json.dumps(asyncio.run(ChatArchive(args.after_days, 0).archive()), indent=2, default=str))
+    elif args.command == "import-history":
+        async def read_chunks():
+            source = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+            with source:
+                while True:
+                    chunk = await asyncio.to_thread(source.read, 1024 * 1024)
+                    if not chunk:
+                        return
+                    yield chunk
+        print(json.dumps(asyncio.run(import_chat_messages(iter_ndjson_lines(read_chunks()), args.user_id))))
+    client.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,793 @@
+"""Offline load-test and benchmark harness for the F.A.R.H.A backend.
+
+Runs the FastAPI app in-process (ASGI transport) or behind a local uvicorn,
+against a local Mongo stand-in (mongomock-motor) and the fake LLM/TTS/STT
+backends, drives concurrent scenarios and reports RPS, p50/p95/p99 and errors
+as JSON. With --baseline the run fails when it regresses past --tolerance.
+
+    python backend_bench.py --mode asgi --concurrency 50 --requests 500
+    python backend_bench.py --mode uvicorn --output bench.json --baseline bench_baseline.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).parent / 'backend'
+AUTH_UPSTREAM_URL = 'http://auth.bench/session-data'
+ALL_SCENARIOS = ['login_storm', 'chat_burst', 'history_paging', 'search', 'http_cache', 'voice_turn', 'voice_ws', 'metrics_overhead', 'serialization', 'startup']
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+class ScenarioResult:
+    """Latency samples and error counts for one scenario"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.error_samples = []
+        self.extra = {}
+        self.started = None
+        self.finished = None
+
+    def record(self, latency, ok, detail=None):
+        self.latencies.append(latency)
+        if not ok:
+            self.errors += 1
+            if detail and len(self.error_samples) < 5:
+                self.error_samples.append(detail)
+
+    def to_dict(self):
+        duration = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        count = len(self.latencies)
+        result = {
+            "requests": count,
+            "errors": self.errors,
+            "error_rate": round(self.errors / count, 4) if count else 0.0,
+            "duration_s": round(duration, 3),
+            "rps": round(count / duration, 1) if duration > 0 else 0.0
+        }
+        for pct in (50, 95, 99):
+            value = percentile(self.latencies, pct)
+            result[f"p{pct}_ms"] = round(value * 1000, 2) if value is not None else None
+        if self.error_samples:
+            result["error_samples"] = self.error_samples
+        result.update(self.extra)
+        return result
+
+
+async def run_concurrently(result, total, concurrency, request_fn):
+    """Run request_fn(i) for i in range(total) with at most `concurrency` in flight"""
+    indexes = iter(range(total))
+
+    async def worker():
+        for index in indexes:
+            started = time.perf_counter()
+            try:
+                ok, detail = await request_fn(index)
+            except Exception as e:
+                ok, detail = False, f"{type(e).__name__}: {e}"
+            result.record(time.perf_counter() - started, ok, detail)
+
+    result.started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, total))))
+    result.finished = time.perf_counter()
+    return result
+
+
+def create_auth_upstream(latency):
+    """Local stand-in for the OAuth session-data endpoint; session ids look like '<user>-<nonce>'"""
+    from fastapi import FastAPI, Header
+
+    upstream = FastAPI()
+
+    @upstream.get("/session-data")
+    async def session_data(x_session_id: str = Header(...)):
+        if latency:
+            await asyncio.sleep(latency)
+        user_index = x_session_id.split("-", 1)[0]
+        return {
+            "email": f"bench-user-{user_index}@example.com",
+            "name": f"Bench User {user_index}",
+            "picture": None,
+            "session_token": f"bench-token-{x_session_id}"
+        }
+
+    return upstream
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FarhaBenchmark:
+    def __init__(self, args):
+        self.args = args
+        self.tokens = []
+        self.results = {}
+        self.server = None
+        self.uvicorn_server = None
+        self.base_url = "http://bench"
+
+    def load_app(self):
+        """Import the app with fake engines and swap in the local Mongo stand-in"""
+        os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+        os.environ.setdefault('DB_NAME', 'farha_bench')
+        os.environ['AUTH_SESSION_DATA_URL'] = AUTH_UPSTREAM_URL
+        os.environ['MOCK_LLM_CHUNK_DELAY'] = str(self.args.llm_latency)
+        os.environ['TTS_FAKE_LATENCY_SECONDS'] = str(self.args.tts_latency)
+        os.environ['STT_FAKE_LATENCY_SECONDS'] = str(self.args.stt_latency)
+        os.environ['LLM_MAX_CONCURRENCY'] = str(self.args.llm_concurrency)
+        os.environ['LLM_USER_RATE_PER_SECOND'] = str(self.args.llm_user_rate)
+        os.environ.setdefault('OPS_TOKEN', 'bench-ops-token')
+        os.environ.setdefault('TTS_BACKEND', 'fake')
+        os.environ.setdefault('STT_BACKEND', 'fake')
+        os.environ.setdefault('TTS_CACHE_DIR', str(Path(os.environ.get('TMPDIR', '/tmp')) / 'farha_bench_tts'))
+        sys.path.insert(0, str(BACKEND_DIR))
+
+        import httpx
+        import server
+
+        if self.args.mongo == 'mock':
+            try:
+                from mongomock_motor import AsyncMongoMockClient
+            except ImportError:
+                raise SystemExit("--mongo mock needs mongomock-motor (pip install mongomock-motor)")
+            server.client = AsyncMongoMockClient(tz_aware=True)
+            server.db = server.client[os.environ['DB_NAME']]
+        else:
+            server.connect_database()
+
+        server.http_client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=create_auth_upstream(self.args.auth_latency))
+        )
+        self.server = server
+
+    def start_uvicorn(self):
+        import uvicorn
+
+        port = free_port()
+        config = uvicorn.Config(self.server.app, host="127.0.0.1", port=port, log_level="warning")
+        self.uvicorn_server = uvicorn.Server(config)
+        thread = threading.Thread(target=self.uvicorn_server.run, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 10
+        while not self.uvicorn_server.started:
+            if time.monotonic() > deadline:
+                raise SystemExit("uvicorn did not start")
+            time.sleep(0.05)
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    def create_client(self):
+        import httpx
+
+        limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+        if self.args.mode == 'uvicorn':
+            return httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=60)
+        return httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=self.server.app), base_url=self.base_url, timeout=60
+        )
+
+    def auth_headers(self, index):
+        return {"Authorization": f"Bearer {self.tokens[index % len(self.tokens)]}"}
+
+    async def login_storm(self, client):
+        result = ScenarioResult("login_storm")
+
+        async def login(index):
+            session_id = f"{index % self.args.users}-{uuid.uuid4().hex}"
+            response = await client.post("/api/auth/session", json={"session_id": session_id})
+            if response.status_code == 200:
+                self.tokens.append(response.json()["session_token"])
+            return response.status_code == 200, f"{response.status_code}: {response.text[:120]}"
+
+        return await run_concurrently(result, self.args.requests, self.args.concurrency, login)
+
+    async def ensure_tokens(self, client):
+        if not self.tokens:
+            await run_concurrently(ScenarioResult("warmup"), self.args.users, self.args.concurrency, self._login_once(client))
+
+    def _login_once(self, client):
+        async def login(index):
+            response = await client.post("/api/auth/session", json={"session_id": f"{index}-{uuid.uuid4().hex}"})
+            if response.status_code == 200:
+                self.tokens.append(response.json()["session_token"])
+            return response.status_code == 200, None
+        return login
+
+    async def chat_burst(self, client):
+        result = ScenarioResult("chat_burst")
+        statuses = {}
+
+        async def chat(index):
+            response = await client.post(
+                "/api/chat",
+                json={"message": f"Benchmark prompt {index}", "bypass_cache": True},
+                headers=self.auth_headers(index)
+            )
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            return response.status_code == 200, f"{response.status_code}: {response.text[:120]}"
+
+        await run_concurrently(result, self.args.requests, self.args.concurrency, chat)
+        # 429/503 here are admission control shedding load (see --llm-concurrency / --llm-user-rate)
+        result.extra["status_counts"] = {str(status): count for status, count in sorted(statuses.items())}
+        return result
+
+    async def seed_history(self, client, token):
+        profile = (await client.get("/api/user/profile", headers={"Authorization": f"Bearer {token}"})).json()
+        server = self.server
+        documents = [
+            server.prepare_for_mongo(server.ChatMessage(
+                user_id=profile["id"],
+                message=f"Seeded question {i}",
+                response=f"Seeded answer {i} " + "lorem ipsum " * 10,
+                conversation_id="bench-history"
+            ).dict())
+            for i in range(self.args.history_size)
+        ]
+        for start in range(0, len(documents), 1000):
+            await server.db.chat_messages.insert_many(documents[start:start + 1000])
+
+    async def history_paging(self, client):
+        result = ScenarioResult("history_paging")
+        token = self.tokens[0]
+        await self.seed_history(client, token)
+        headers = {"Authorization": f"Bearer {token}"}
+        pages_per_walk = math.ceil(self.args.history_size / self.args.page_size)
+        cursors = {}
+
+        async def page(index):
+            walker = index // pages_per_walk
+            params = {"limit": self.args.page_size}
+            if cursors.get(walker):
+                params["before"] = cursors[walker]
+            response = await client.get("/api/chat/history", params=params, headers=headers)
+            if response.status_code != 200:
+                return False, f"{response.status_code}: {response.text[:120]}"
+            cursors[walker] = response.json()["next_cursor"]
+            return True, None
+
+        # Each walker pages sequentially through the whole history; walkers run concurrently
+        walkers = max(1, self.args.concurrency // 5)
+        result.started = time.perf_counter()
+
+        async def walk(walker):
+            for page_index in range(pages_per_walk):
+                started = time.perf_counter()
+                try:
+                    ok, detail = await page(walker * pages_per_walk + page_index)
+                except Exception as e:
+                    ok, detail = False, f"{type(e).__name__}: {e}"
+                result.record(time.perf_counter() - started, ok, detail)
+
+        await asyncio.gather(*(walk(walker) for walker in range(walkers)))
+        result.finished = time.perf_counter()
+        result.extra["pages_per_walk"] = pages_per_walk
+        return result
+
+    async def http_cache(self, client):
+        """Repeat loads of the read endpoints: identity bodies vs compressed vs If-None-Match revalidation"""
+        result = ScenarioResult("http_cache")
+        token = self.tokens[1 % len(self.tokens)]
+        await self.seed_history(client, token)
+        headers = {"Authorization": f"Bearer {token}"}
+        endpoints = {
+            "profile": ("/api/user/profile", {}),
+            "voices": ("/api/voice/voices", {}),
+            "history": ("/api/chat/history", {"limit": self.args.page_size})
+        }
+        names = list(endpoints)
+        report = {name: {} for name in names}
+        etags = {}
+
+        async def load(name, extra_headers, variant):
+            path, params = endpoints[name]
+            async with client.stream("GET", path, params=params, headers={**headers, **extra_headers}) as response:
+                size = 0
+                async for chunk in response.aiter_raw():
+                    size += len(chunk)
+            stats = report[name].setdefault(variant, {"bytes": [], "status_counts": {}})
+            stats["bytes"].append(size)
+            stats["status_counts"][str(response.status_code)] = stats["status_counts"].get(str(response.status_code), 0) + 1
+            if variant == "compressed":
+                stats["encoding"] = response.headers.get("content-encoding")
+            etags[name] = response.headers.get("etag")
+            return response.status_code in (200, 304), f"{response.status_code}"
+
+        # First loads: the same responses without and with compression
+        for name in names:
+            for variant, variant_headers in (("full", {"Accept-Encoding": "identity"}), ("compressed", {"Accept-Encoding": "br, gzip"})):
+                variant_result = ScenarioResult(f"{name}_{variant}")
+                await run_concurrently(
+                    variant_result, self.args.requests, self.args.concurrency,
+                    lambda index, name=name, variant=variant, variant_headers=variant_headers: load(name, variant_headers, variant)
+                )
+                report[name][variant]["p50_ms"] = variant_result.to_dict()["p50_ms"]
+
+        # Repeat loads revalidate with the stored ETag; this is the scenario's measured traffic
+        latencies = {name: [] for name in names}
+
+        async def revalidate(index):
+            name = names[index % len(names)]
+            started = time.perf_counter()
+            ok, detail = await load(name, {"Accept-Encoding": "br, gzip", "If-None-Match": etags[name] or ""}, "revalidated")
+            latencies[name].append(time.perf_counter() - started)
+            return ok, detail
+
+        await run_concurrently(result, self.args.requests, self.args.concurrency, revalidate)
+        for name in names:
+            report[name]["revalidated"]["p50_ms"] = round(percentile(latencies[name], 50) * 1000, 2)
+            full = sum(report[name]["full"]["bytes"]) / len(report[name]["full"]["bytes"])
+            for variant in ("full", "compressed", "revalidated"):
+                stats = report[name][variant]
+                sizes = stats.pop("bytes")
+                stats["body_bytes"] = round(sum(sizes) / len(sizes), 1)
+                stats["bytes_saved_pct"] = round(100 * (full - stats["body_bytes"]) / full, 1) if full else 0.0
+        result.extra["endpoints"] = report
+        return result
+
+    async def search(self, client):
+        """Ranked search over a synthetic corpus; the first query includes any index build"""
+        result = ScenarioResult("search")
+        token = self.tokens[-1]
+        headers = {"Authorization": f"Bearer {token}"}
+        profile = (await client.get("/api/user/profile", headers=headers)).json()
+        rng = random.Random(self.args.seed)
+        syllables = ["ka", "lo", "mi", "ra", "te", "su", "no", "vi", "de", "pa", "zu", "ge"]
+        vocabulary = sorted({"".join(rng.choices(syllables, k=rng.randint(2, 4))) for _ in range(5000)})
+        rng.shuffle(vocabulary)
+        weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+        def sentence(words):
+            return " ".join(rng.choices(vocabulary, weights=weights, k=words))
+
+        started = time.perf_counter()
+        server = self.server
+        batch = []
+        for i in range(self.args.search_corpus_size):
+            batch.append(server.prepare_for_mongo(server.ChatMessage(
+                user_id=profile["id"], message=sentence(12), response=sentence(60), conversation_id=f"c{i % 500}"
+            ).dict()))
+            if len(batch) == 5000:
+                await server.db.chat_messages.insert_many(batch)
+                batch = []
+        if batch:
+            await server.db.chat_messages.insert_many(batch)
+        result.extra["corpus_messages"] = self.args.search_corpus_size
+        result.extra["seed_s"] = round(time.perf_counter() - started, 2)
+
+        # Mid-frequency terms make realistic queries: selective but with many matches
+        query_terms = vocabulary[50:1000]
+        started = time.perf_counter()
+        first = await client.get("/api/chat/search", params={"q": query_terms[0]}, headers=headers)
+        result.extra["first_query_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        result.extra["backend"] = (await client.get(
+            "/api/chat/search/stats", headers={"Authorization": f"Bearer {os.environ['OPS_TOKEN']}"}
+        )).json()["backend"]
+
+        async def query(index):
+            q = " ".join(rng.sample(query_terms, rng.randint(1, 2)))
+            response = await client.get("/api/chat/search", params={"q": q, "limit": 20}, headers=headers)
+            return response.status_code == 200, f"{response.status_code}: {response.text[:120]}"
+
+        await run_concurrently(result, self.args.requests, self.args.concurrency, query)
+        result.extra["first_query_status"] = first.status_code
+        return result
+
+    async def voice_turn(self, client):
+        """The HTTP voice chain App.js would run: STT upload -> chat -> TTS -> audio fetch"""
+        result = ScenarioResult("voice_turn")
+        audio = os.urandom(self.args.audio_bytes)
+        phrases = ["Hello F.A.R.H.A.", "What can you do?", "Tell me something interesting about the ocean."]
+
+        async def turn(index):
+            headers = self.auth_headers(index)
+            stt = await client.post(
+                "/api/voice/stt", files={"audio_file": ("turn.webm", audio, "audio/webm")}, headers=headers
+            )
+            if stt.status_code != 200:
+                return False, f"stt {stt.status_code}"
+            chat = await client.post(
+                "/api/chat", json={"message": stt.json()["transcribed_text"], "is_voice": True}, headers=headers
+            )
+            if chat.status_code != 200:
+                return False, f"chat {chat.status_code}"
+            tts = await client.post(
+                "/api/voice/tts", json={"text": phrases[index % len(phrases)]}, headers=headers
+            )
+            if tts.status_code != 200:
+                return False, f"tts {tts.status_code}"
+            fetched = await client.get(tts.json()["audio_url"])
+            return fetched.status_code == 200, f"audio {fetched.status_code}"
+
+        return await run_concurrently(result, max(1, self.args.requests // 5), self.args.concurrency, turn)
+
+    async def voice_ws(self, client):
+        """Pipelined voice turns over /api/ws/voice (needs --mode uvicorn)"""
+        import websockets
+
+        result = ScenarioResult("voice_ws")
+        first_audio = []
+        ws_url = self.base_url.replace("http://", "ws://") + "/api/ws/voice"
+        frame = os.urandom(4096)
+        frames_per_turn = max(1, self.args.audio_bytes // len(frame))
+
+        async def turn(index):
+            async with websockets.connect(ws_url, max_size=None) as ws:
+                await ws.send(json.dumps({"type": "auth", "token": self.tokens[index % len(self.tokens)]}))
+                json.loads(await ws.recv())
+                await ws.send(json.dumps({"type": "start"}))
+                for _ in range(frames_per_turn):
+                    await ws.send(frame)
+                await ws.send(json.dumps({"type": "end"}))
+                while True:
+                    message = await ws.recv()
+                    if isinstance(message, bytes):
+                        continue
+                    event = json.loads(message)
+                    if event["type"] == "error":
+                        return False, event["detail"]
+                    if event["type"] == "turn_end":
+                        if "first_audio_ms" in event["timings"]:
+                            first_audio.append(event["timings"]["first_audio_ms"] / 1000)
+                        return True, None
+
+        run = await run_concurrently(result, max(1, self.args.requests // 5), self.args.concurrency, turn)
+        for pct in (50, 95):
+            value = percentile(first_audio, pct)
+            run.extra[f"first_audio_p{pct}_ms"] = round(value * 1000, 2) if value is not None else None
+        return run
+
+    def metrics_overhead(self):
+        return MetricsOverheadBenchmark(self.server).run()
+
+    def serialization(self):
+        return SerializationBenchmark(self.server, self.args.serialization_sizes).run()
+
+    def startup(self):
+        return StartupBenchmark(self.args.mongo, self.args.startup_runs).run()
+
+    async def run(self):
+        self.load_app()
+        if self.args.mode == 'uvicorn':
+            self.start_uvicorn()
+        scenarios = self.args.scenarios
+        try:
+            async with self.create_client() as client:
+                for name in scenarios:
+                    if name in ('metrics_overhead', 'serialization', 'startup'):
+                        self.results[name] = await getattr(self, name)()
+                        continue
+                    if name == 'voice_ws' and self.args.mode != 'uvicorn':
+                        self.results[name] = {"skipped": "WebSocket scenario needs --mode uvicorn"}
+                        continue
+                    if name != 'login_storm':
+                        await self.ensure_tokens(client)
+                    result = await getattr(self, name)(client)
+                    self.results[name] = result.to_dict()
+                    print(f"{name}: {json.dumps(self.results[name])}", file=sys.stderr)
+        finally:
+            if self.uvicorn_server is not None:
+                self.uvicorn_server.should_exit = True
+        return {
+            "config": {key: value for key, value in vars(self.args).items() if key not in ("output", "baseline", "save_baseline")},
+            "scenarios": self.results
+        }
+
+
+class MetricsOverheadBenchmark:
+    """Measures what the instrumentation layer costs per request"""
+
+    def __init__(self, server, iterations=20000):
+        self.server = server
+        self.iterations = iterations
+        self.results = {}
+
+    def bench_histogram_observe(self):
+        histogram = self.server.Histogram()
+        started = time.perf_counter()
+        for i in range(self.iterations):
+            histogram.observe(0.001)
+        elapsed = time.perf_counter() - started
+        self.results["histogram_observe_ns"] = round(elapsed / self.iterations * 1e9, 1)
+
+    def bench_span(self):
+        started = time.perf_counter()
+        for i in range(self.iterations):
+            with self.server.Span("bench"):
+                pass
+        elapsed = time.perf_counter() - started
+        self.results["span_ns"] = round(elapsed / self.iterations * 1e9, 1)
+
+    async def bench_middleware(self):
+        """Same trivial ASGI app called bare and wrapped in MetricsMiddleware"""
+        async def trivial_app(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"ok"})
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            pass
+
+        scope = {"type": "http", "method": "GET", "path": "/api/health"}
+
+        async def run(app):
+            started = time.perf_counter()
+            for i in range(self.iterations):
+                await app(dict(scope), receive, send)
+            return (time.perf_counter() - started) / self.iterations
+
+        bare = await run(trivial_app)
+        wrapped = await run(self.server.MetricsMiddleware(trivial_app))
+        self.results["middleware_overhead_ns"] = round((wrapped - bare) * 1e9, 1)
+
+    async def bench_health_request(self):
+        """Full in-process request through the real app for scale"""
+        import httpx
+
+        transport = httpx.ASGITransport(app=self.server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            requests = max(1, self.iterations // 20)
+            started = time.perf_counter()
+            for i in range(requests):
+                await client.get("/api/health")
+            elapsed = (time.perf_counter() - started) / requests
+        self.results["health_request_us"] = round(elapsed * 1e6, 1)
+        self.results["middleware_overhead_pct"] = round(
+            self.results["middleware_overhead_ns"] / (elapsed * 1e9) * 100, 2
+        )
+
+    async def run(self):
+        self.bench_histogram_observe()
+        self.bench_span()
+        await self.bench_middleware()
+        await self.bench_health_request()
+        return self.results
+
+
+class SerializationBenchmark:
+    """Per-message cost of a history page: model round-trip vs direct orjson encoding"""
+
+    def __init__(self, server, sizes, repeats=3):
+        self.server = server
+        self.sizes = sizes
+        self.repeats = repeats
+
+    def documents(self, size):
+        now = datetime.now(timezone.utc)
+        return [
+            {
+                "id": str(uuid.uuid4()),
+                "user_id": "bench-user",
+                "conversation_id": "bench-conversation",
+                "message": f"Question number {i}?",
+                "response": f"Answer number {i}. " + "lorem ipsum dolor sit amet " * 8,
+                "timestamp": now - timedelta(seconds=i),
+                "is_voice": bool(i % 3 == 0)
+            }
+            for i in range(size)
+        ]
+
+    @classmethod
+    def legacy_prepare_for_mongo(cls, data):
+        """The original prepare_for_mongo: a recursive walk turning every datetime into an ISO string"""
+        if isinstance(data, dict):
+            for key, value in data.items():
+                if isinstance(value, datetime):
+                    data[key] = value.isoformat()
+                elif isinstance(value, dict):
+                    data[key] = cls.legacy_prepare_for_mongo(value)
+        return data
+
+    def legacy_read(self, documents):
+        """ISO-string documents as the original code stored them: parse_from_mongo -> ChatMessage -> JSON"""
+        from fastapi.encoders import jsonable_encoder
+
+        messages = [self.server.ChatMessage(**self.server.parse_from_mongo(document)) for document in documents]
+        return json.dumps(jsonable_encoder(messages)).encode()
+
+    async def direct_read(self, documents):
+        async def cursor():
+            for document in documents:
+                yield document
+
+        return b"".join([chunk async for chunk in self.server.stream_history_page(cursor(), len(documents))])
+
+    def legacy_write(self, documents):
+        """.dict() then the original recursive ISO-string conversion"""
+        for document in documents:
+            self.legacy_prepare_for_mongo(self.server.ChatMessage(**document).dict())
+
+    def direct_write(self, documents):
+        for document in documents:
+            self.server.prepare_for_mongo(self.server.ChatMessage(**document).dict())
+
+    async def timed(self, fn, documents):
+        best = None
+        for _ in range(self.repeats):
+            copies = [dict(document) for document in documents]
+            started = time.perf_counter()
+            outcome = fn(copies)
+            if asyncio.iscoroutine(outcome):
+                await outcome
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return round(best / len(documents) * 1e9, 1)
+
+    async def run(self):
+        results = {}
+        for size in self.sizes:
+            documents = self.documents(size)
+            stored_legacy = [self.legacy_prepare_for_mongo(dict(document)) for document in documents]
+            read_legacy = await self.timed(self.legacy_read, stored_legacy)
+            read_direct = await self.timed(self.direct_read, documents)
+            write_legacy = await self.timed(self.legacy_write, documents)
+            write_direct = await self.timed(self.direct_write, documents)
+            results[str(size)] = {
+                "read_legacy_ns_per_message": read_legacy,
+                "read_direct_ns_per_message": read_direct,
+                "read_speedup": round(read_legacy / read_direct, 2),
+                "write_legacy_ns_per_message": write_legacy,
+                "write_direct_ns_per_message": write_direct,
+                "write_speedup": round(write_legacy / write_direct, 2)
+            }
+        return results
+
+
+STARTUP_PROBE = """
+import asyncio, json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import server
+imported = time.perf_counter()
+if sys.argv[2] == 'mock':
+    from mongomock_motor import AsyncMongoMockClient
+    server.client = AsyncMongoMockClient(tz_aware=True)
+    server.db = server.client[os.environ['DB_NAME']]
+
+async def probe():
+    import httpx
+    lifespan_started = time.perf_counter()
+    async with server.app.router.lifespan_context(server.app):
+        ready = time.perf_counter()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            status = (await client.get('/api/ready')).status_code
+            first_request = time.perf_counter()
+    return {
+        'import_ms': (imported - started) * 1000,
+        'startup_ms': (ready - lifespan_started) * 1000,
+        'first_request_ms': (first_request - ready) * 1000,
+        'ready_status': status,
+        'heavy_modules_loaded': sorted(name for name in ('elevenlabs', 'pandas', 'numpy', 'openai') if name in sys.modules)
+    }
+
+print(json.dumps(asyncio.run(probe())))
+"""
+
+
+class StartupBenchmark:
+    """Cold-start cost of a fresh worker: import, lifespan warmup and first request"""
+
+    def __init__(self, mongo, runs):
+        self.mongo = mongo
+        self.runs = runs
+
+    def run_once(self):
+        import subprocess
+
+        started = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE, str(BACKEND_DIR), self.mongo],
+            capture_output=True, text=True, env=dict(os.environ), check=True
+        )
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        result["process_to_ready_ms"] = (time.perf_counter() - started) * 1000
+        return result
+
+    async def run(self):
+        samples = [await asyncio.to_thread(self.run_once) for _ in range(self.runs)]
+        report = {
+            key: round(percentile([sample[key] for sample in samples], 50), 2)
+            for key in ("import_ms", "startup_ms", "first_request_ms", "process_to_ready_ms")
+        }
+        report["runs"] = self.runs
+        report["ready_status"] = samples[-1]["ready_status"]
+        report["heavy_modules_loaded"] = samples[-1]["heavy_modules_loaded"]
+        return report
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """Regressions beyond tolerance: slower p95 or startup, lower RPS or a higher error rate"""
+    regressions = []
+    for name, base in baseline.get("scenarios", {}).items():
+        current = report["scenarios"].get(name)
+        if not current:
+            continue
+        for key in ("import_ms", "process_to_ready_ms"):
+            if key in base and key in current and current[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {current[key]} vs baseline {base[key]}")
+        if "p95_ms" not in base or "p95_ms" not in current:
+            continue
+        if base["p95_ms"] and current["p95_ms"] and current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {current['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if base["rps"] and current["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: {current['rps']} rps vs baseline {base['rps']} rps")
+        if current["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(f"{name}: error rate {current['error_rate']} vs baseline {base['error_rate']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="F.A.R.H.A offline load test and benchmark")
+    parser.add_argument("--mode", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--mongo", choices=["mock", "real"], default="mock",
+                        help="mongomock-motor stand-in, or the MONGO_URL/DB_NAME from the environment")
+    parser.add_argument("--scenarios", nargs="+", choices=ALL_SCENARIOS, default=ALL_SCENARIOS)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--history-size", type=int, default=2000)
+    parser.add_argument("--search-corpus-size", type=int, default=100000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--audio-bytes", type=int, default=32 * 1024)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Mock LLM delay per streamed chunk (s)")
+    parser.add_argument("--tts-latency", type=float, default=0.0, help="Fake TTS synthesis latency (s)")
+    parser.add_argument("--stt-latency", type=float, default=0.0, help="Fake STT transcription latency (s)")
+    parser.add_argument("--llm-concurrency", type=int, default=64, help="LLM admission control concurrency cap")
+    parser.add_argument("--llm-user-rate", type=float, default=0.0,
+                        help="Per-user LLM token bucket rate per second (0 disables rate limiting)")
+    parser.add_argument("--auth-latency", type=float, default=0.0, help="Fake auth upstream latency (s)")
+    parser.add_argument("--serialization-sizes", type=int, nargs="+", default=[50, 1000, 10000])
+    parser.add_argument("--startup-runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--baseline", help="Compare against this stored JSON report")
+    parser.add_argument("--save-baseline", help="Also store this run as a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    report = asyncio.run(FarhaBenchmark(args).run())
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    for path in (args.output, args.save_baseline):
+        if path:
+            Path(path).write_text(output)
+
+    if args.baseline:
+        regressions = compare_to_baseline(report, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    errors = sum(scenario.get("errors", 0) for scenario in report["scenarios"].values())
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
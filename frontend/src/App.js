@@ -36,7 +36,7 @@ const Avatar = ({ children, className, fallbackText, imageUrl }) => {
 };
 // Removed AvatarImage and AvatarFallback mock components as logic is now in Avatar
 const Badge = (props) => <span {...props} className={"inline-flex items-center px-3 py-1 text-xs font-medium rounded-full " + props.className}>{props.children}</span>;
-const ScrollArea = (props) => <div {...props} className={"overflow-y-auto " + props.className}>{props.children}</div>;
+const ScrollArea = React.forwardRef((props, ref) => <div {...props} ref={ref} className={"overflow-y-auto " + props.className}>{props.children}</div>);
 const Separator = (props) => <div {...props} className={"h-px w-full bg-gray-200 " + props.className} />;
 const toast = { error: (msg) => console.error("Toast Error:", msg) }; // Simple mock for toast
 const Toaster = () => null; // Mock for toaster
@@ -52,6 +52,7 @@ const Volume2 = (props) => <svg {...props} xmlns="http://www.w3.org/2000/svg" wi
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+const HISTORY_PAGE_SIZE = 50;
 
 // Auth service
 class AuthService {
@@ -623,7 +624,14 @@ function ChatInterface({ user, onLogout }) {
     const [messages, setMessages] = useState([]);
     const [inputMessage, setInputMessage] = useState('');
     const [isLoading, setIsLoading] = useState(false);
+    const [isLoadingHistory, setIsLoadingHistory] = useState(false);
+    const [conversationId, setConversationId] = useState(null);
     const messagesEndRef = useRef(null);
+    const messagesAreaRef = useRef(null);
+    const preserveScrollRef = useRef(null);
+    // Refs, not state: scroll events fire before a re-render and would see a stale cursor and flag
+    const historyCursorRef = useRef(null);
+    const historyRequestRef = useRef(false);
     const inputRef = useRef(null);
 
     const scrollToBottom = () => {
@@ -640,6 +648,13 @@ function ChatInterface({ user, onLogout }) {
     };
 
     useEffect(() => {
+        // Older history was prepended: keep the viewport anchored instead of jumping to the bottom
+        if (preserveScrollRef.current !== null && messagesAreaRef.current) {
+            const area = messagesAreaRef.current;
+            area.scrollTop = area.scrollHeight - preserveScrollRef.current;
+            preserveScrollRef.current = null;
+            return;
+        }
         // Delay scrolling slightly to allow DOM layout to finish, improving reliability on mobile
         const timer = setTimeout(() => scrollToBottom(), 100); 
         return () => clearTimeout(timer);
@@ -649,33 +664,58 @@ function ChatInterface({ user, onLogout }) {
         loadChatHistory();
     }, []);
 
-    const loadChatHistory = async () => {
+    const loadChatHistory = async (before = null) => {
+        if (historyRequestRef.current) return;
+        historyRequestRef.current = true;
+        setIsLoadingHistory(true);
         try {
             const response = await axios.get(`${API}/chat/history`, {
-                headers: AuthService.getAuthHeaders()
+                headers: AuthService.getAuthHeaders(),
+                params: before ? { limit: HISTORY_PAGE_SIZE, before } : { limit: HISTORY_PAGE_SIZE }
             });
             
-            const historyMessages = response.data.reverse().flatMap(item => {
+            const historyMessages = response.data.messages.slice().reverse().flatMap(item => {
                 const userMsg = {
-                    id: item.message_id + '-user',
+                    id: item.id + '-user',
                     text: item.message,
                     timestamp: item.timestamp,
                     isUser: true,
                     status: 'sent'
                 };
                 const aiMsg = {
-                    id: item.message_id + '-ai',
+                    id: item.id + '-ai',
                     text: item.response,
-                    timestamp: new Date().toISOString(),
+                    timestamp: item.timestamp,
                     isUser: false,
                     status: 'received'
                 };
                 return [userMsg, aiMsg];
             });
 
-            setMessages(historyMessages);
+            if (before) {
+                const area = messagesAreaRef.current;
+                preserveScrollRef.current = area ? area.scrollHeight - area.scrollTop : null;
+                setMessages(prev => [...historyMessages, ...prev]);
+            } else {
+                setMessages(historyMessages);
+                // Continue the most recent conversation after a reload
+                if (response.data.messages.length > 0) {
+                    setConversationId(response.data.messages[0].conversation_id || null);
+                }
+            }
+            historyCursorRef.current = response.data.next_cursor;
         } catch (error) {
             console.error('Error loading chat history:', error);
+        } finally {
+            historyRequestRef.current = false;
+            setIsLoadingHistory(false);
+        }
+    };
+
+    const handleMessagesScroll = (e) => {
+        // Lazily fetch the next older page once the user scrolls near the top
+        if (e.currentTarget.scrollTop < 80 && historyCursorRef.current) {
+            loadChatHistory(historyCursorRef.current);
         }
     };
 
@@ -705,9 +745,10 @@ function ChatInterface({ user, onLogout }) {
         try {
             const response = await axios.post(
                 `${API}/chat`,
-                { message: text }, 
+                { message: text, conversation_id: conversationId }, 
                 { headers: AuthService.getAuthHeaders() }
             );
+            setConversationId(response.data.conversation_id);
 
             const finalAiMessage = {
                 id: response.data.message_id + '-ai',
@@ -796,8 +837,16 @@ function ChatInterface({ user, onLogout }) {
 
             {/* Chat Area (flex-grow: 1) */}
             <div className="chat-container">
-                <ScrollArea className="messages-area">
+                <ScrollArea className="messages-area" ref={messagesAreaRef} onScroll={handleMessagesScroll}>
                     <div className="messages-list">
+                        {isLoadingHistory && messages.length > 0 && (
+                            <div className="typing-indicator" data-testid="history-loading">
+                                <span></span>
+                                <span></span>
+                                <span></span>
+                            </div>
+                        )}
+                        
                         {messages.length === 0 && (
                             <div className="welcome-message">
                                 <div className="welcome-content">
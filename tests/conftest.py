@@ -0,0 +1,51 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# Offline settings, applied before the server module reads them at import
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "farha_test")
+os.environ.setdefault("TTS_BACKEND", "fake")
+os.environ.setdefault("STT_BACKEND", "fake")
+# Tests that exercise the per-user rate limit build their own scheduler
+os.environ.setdefault("LLM_USER_RATE_PER_SECOND", "0")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import httpx  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A fresh in-memory database installed as the server's Motor client"""
+    client = AsyncMongoMockClient(tz_aware=True)
+    database = client[os.environ["DB_NAME"]]
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+@pytest.fixture
+def user(monkeypatch):
+    """A signed-in user: get_current_user is overridden to return it"""
+    current = server.User(email="tester@example.com", name="Tester")
+    server.app.dependency_overrides[server.get_current_user] = lambda: current
+    yield current
+    server.app.dependency_overrides.pop(server.get_current_user, None)
+
+
+@pytest.fixture
+async def api(db):
+    """HTTP client bound to the app in-process (the lifespan is not run)"""
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as client:
+        yield client
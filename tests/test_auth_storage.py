@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+from pymongo.errors import OperationFailure
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def session_cache(monkeypatch):
+    cache = server.SessionCache(100, 60)
+    monkeypatch.setattr(server, "session_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def auth_upstream(monkeypatch):
+    async def fetch_auth_session_data(session_id):
+        return httpx.Response(200, json={
+            "email": "login@example.com", "name": "Login", "session_token": f"token-{session_id}"
+        })
+
+    monkeypatch.setattr(server, "fetch_auth_session_data", fetch_auth_session_data)
+
+
+async def test_login_stores_native_dates(db, auth_upstream):
+    await server.exchange_session("s1")
+
+    user = await db.users.find_one({"email": "login@example.com"})
+    session = await db.auth_sessions.find_one({"session_token": "token-s1"})
+    assert isinstance(user["created_at"], datetime)
+    assert isinstance(session["created_at"], datetime) and isinstance(session["expires_at"], datetime)
+
+
+async def test_repeated_logins_share_one_user(db, auth_upstream):
+    first = await server.exchange_session("s1")
+    second = await server.exchange_session("s2")
+
+    assert first["user"]["id"] == second["user"]["id"]
+    assert await db.users.count_documents({}) == 1
+
+
+async def test_session_and_user_resolve_in_one_query(db, auth_upstream, session_cache, monkeypatch):
+    login = await server.exchange_session("s1")
+
+    async def find_one(*args, **kwargs):
+        raise AssertionError("resolved with a second query")
+
+    monkeypatch.setattr(type(db.users), "find_one", find_one)
+    user = await server.resolve_session_user("token-s1")
+
+    assert user.id == login["user"]["id"]
+
+
+async def test_expired_session_is_rejected(db, auth_upstream, session_cache):
+    await server.exchange_session("s1")
+    await db.auth_sessions.update_one(
+        {"session_token": "token-s1"}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+
+    with pytest.raises(server.HTTPException) as rejected:
+        await server.resolve_session_user("token-s1")
+    assert rejected.value.status_code == 401
+
+
+async def test_migrate_dates_converts_iso_strings(db):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    await db.users.insert_one({"id": "u1", "email": "old@example.com", "name": "Old", "created_at": now.isoformat()})
+    await db.auth_sessions.insert_one({
+        "user_id": "u1", "session_token": "t1",
+        "created_at": now.isoformat(), "expires_at": (now + timedelta(days=1)).isoformat().replace("+00:00", "Z")
+    })
+    await db.chat_messages.insert_one({"id": "m1", "user_id": "u1", "message": "m", "response": "r", "timestamp": now})
+
+    migrated = await server.migrate_datetime_fields()
+
+    assert migrated == {"users": 1, "auth_sessions": 1, "chat_messages": 0}
+    session = await db.auth_sessions.find_one({"session_token": "t1"})
+    assert session["expires_at"] == now + timedelta(days=1)
+    assert (await db.users.find_one({"id": "u1"}))["created_at"] == now
+
+
+async def insert_duplicate_users(db):
+    created = datetime.now(timezone.utc) - timedelta(days=1)
+    for index, user_id in enumerate(["kept", "duplicate"]):
+        await db.users.insert_one({
+            "id": user_id, "email": "twice@example.com", "name": user_id, "created_at": created + timedelta(seconds=index)
+        })
+        await db.auth_sessions.insert_one({
+            "user_id": user_id, "session_token": f"token-{user_id}",
+            "created_at": created, "expires_at": created + timedelta(days=7)
+        })
+        await db.chat_messages.insert_one(
+            server.ChatMessage(user_id=user_id, message=f"from {user_id}", response="r").dict()
+        )
+
+
+async def test_unique_email_index_is_skipped_at_startup_over_duplicates(db):
+    await insert_duplicate_users(db)
+
+    with pytest.raises(OperationFailure):
+        await server.create_indexes(strict=True)
+    await server.create_indexes(strict=False)
+
+    assert "email_1" not in await db.users.index_information()
+
+
+async def test_merge_duplicate_users_keeps_the_oldest_and_its_data(db):
+    await insert_duplicate_users(db)
+
+    merged = await server.merge_duplicate_users()
+
+    assert (merged["users"], merged["auth_sessions"], merged["chat_messages"]) == (1, 1, 1)
+    assert [user["id"] async for user in db.users.find()] == ["kept"]
+    assert await db.auth_sessions.count_documents({"user_id": "kept"}) == 2
+    assert await db.chat_messages.count_documents({"user_id": "kept"}) == 2
+    await server.create_indexes(strict=True)
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def archive(db, monkeypatch):
+    chat_archive = server.ChatArchive(30, 8)
+    monkeypatch.setattr(server, "chat_archive", chat_archive)
+    return chat_archive
+
+
+@pytest.fixture
+async def messages(db, user):
+    """Six months of history, two messages per timestamp so pages split inside ties"""
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    documents = []
+    for index in range(90):
+        document = server.ChatMessage(
+            user_id=user.id, message=f"q{index}", response=f"a{index}", conversation_id=f"c{index % 3}"
+        ).dict()
+        document["timestamp"] = now - timedelta(days=2 * (index // 2))
+        documents.append(document)
+    await db.chat_messages.insert_many([dict(document) for document in documents])
+    return sorted(documents, key=lambda document: (document["timestamp"], document["id"]), reverse=True)
+
+
+async def walk_history(api, limit, **params):
+    """Ids of every message, following next_cursor until the last page"""
+    ids, cursor = [], None
+    while True:
+        if cursor:
+            params["before"] = cursor
+        page = (await api.get("/api/chat/history", params={"limit": limit, **params})).json()
+        assert len(page["messages"]) <= limit
+        ids += [message["id"] for message in page["messages"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return ids
+
+
+async def test_pages_walk_from_hot_into_archive_without_gaps_or_repeats(api, db, archive, messages):
+    expected = [document["id"] for document in messages]
+    assert await walk_history(api, 7) == expected
+
+    report = await archive.archive()
+
+    hot = await db.chat_messages.count_documents({})
+    assert 0 < hot < len(messages)
+    assert report["archived_messages"] == len(messages) - hot
+    for limit in (1, 7, 50):
+        assert await walk_history(api, limit) == expected
+
+
+async def test_conversation_filter_applies_across_tiers(api, archive, messages):
+    await archive.archive()
+
+    ids = await walk_history(api, 4, conversation_id="c1")
+
+    assert ids == [document["id"] for document in messages if document["conversation_id"] == "c1"]
+
+
+async def test_page_boundary_on_the_last_hot_message_continues_in_the_archive(api, db, archive, messages):
+    await archive.archive()
+    hot = await db.chat_messages.count_documents({})
+
+    first = (await api.get("/api/chat/history", params={"limit": hot})).json()
+    second = (await api.get("/api/chat/history", params={"limit": 5, "before": first["next_cursor"]})).json()
+
+    assert [message["id"] for message in first["messages"]] == [document["id"] for document in messages[:hot]]
+    assert [message["id"] for message in second["messages"]] == [document["id"] for document in messages[hot:hot + 5]]
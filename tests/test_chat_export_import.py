@@ -0,0 +1,119 @@
+import gzip
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import pytest
+from fastapi import HTTPException
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def archive(db, monkeypatch):
+    await server.create_indexes()
+    chat_archive = server.ChatArchive(30, 8)
+    monkeypatch.setattr(server, "chat_archive", chat_archive)
+    return chat_archive
+
+
+@pytest.fixture
+async def history(db, user, archive):
+    """Forty messages over four months, the older ones archived"""
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    documents = []
+    for index in range(40):
+        document = server.ChatMessage(
+            user_id=user.id, message=f"q{index}", response=f"a{index}", conversation_id=f"c{index % 2}"
+        ).dict()
+        document["timestamp"] = now - timedelta(days=3 * index)
+        documents.append(document)
+    await db.chat_messages.insert_many([dict(document) for document in documents])
+    await archive.archive()
+    assert await db.chat_archive.count_documents({}) > 0
+    return sorted(documents, key=lambda document: (document["timestamp"], document["id"]))
+
+
+def exported(body: bytes):
+    return [orjson.loads(line) for line in body.splitlines()]
+
+
+async def chunked(data: bytes, size: int = 8192):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+async def test_export_then_import_round_trips(api, db, history, compress):
+    response = await api.get("/api/chat/export", params={"compress": compress})
+    body = response.content
+    lines = exported(gzip.decompress(body) if compress else body)
+    assert [line["id"] for line in lines] == [document["id"] for document in history]
+
+    await db.chat_messages.delete_many({})
+    await db.chat_archive.delete_many({})
+    report = (await api.post("/api/chat/import", content=body)).json()
+
+    assert report["received"] == report["inserted"] == len(history)
+    assert exported((await api.get("/api/chat/export")).content) == lines
+
+
+async def test_reimport_counts_hot_and_archived_messages_as_duplicates(api, db, history):
+    body = (await api.get("/api/chat/export", params={"compress": True})).content
+    hot = await db.chat_messages.count_documents({})
+
+    report = (await api.post("/api/chat/import", content=body)).json()
+
+    assert report["inserted"] == 0
+    assert report["duplicates"] == len(history)
+    assert await db.chat_messages.count_documents({}) == hot
+
+
+async def test_import_takes_ownership_and_skips_invalid_lines(api, db, user, archive):
+    lines = [
+        orjson.dumps(server.ChatMessage(user_id="someone-else", message="hi", response="hello").dict()),
+        b"not json",
+        b"",
+        orjson.dumps({"message": "missing fields"})
+    ]
+
+    report = (await api.post("/api/chat/import", content=b"\n".join(lines))).json()
+
+    assert (report["inserted"], report["invalid"]) == (1, 2)
+    assert await db.chat_messages.count_documents({"user_id": user.id}) == 1
+
+
+async def test_gzip_bomb_is_rejected_before_it_inflates(monkeypatch):
+    monkeypatch.setattr(server, "IMPORT_MAX_BYTES", 8 * 1024 * 1024)
+    bomb = gzip.compress(b"\n" * (64 * 1024 * 1024), 9)
+
+    tracemalloc.start()
+    try:
+        with pytest.raises(HTTPException) as rejected:
+            async for _ in server.iter_ndjson_lines(chunked(bomb)):
+                pass
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert rejected.value.status_code == 413
+    assert peak < 4 * 1024 * 1024
+
+
+async def test_long_line_is_rejected_as_it_grows(monkeypatch):
+    monkeypatch.setattr(server, "IMPORT_MAX_LINE_BYTES", 1024 * 1024)
+    line = gzip.compress(b"x" * (32 * 1024 * 1024), 9)
+
+    tracemalloc.start()
+    try:
+        with pytest.raises(HTTPException) as rejected:
+            async for _ in server.iter_ndjson_lines(chunked(line)):
+                pass
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert rejected.value.detail == "Import line too long"
+    assert peak < 4 * 1024 * 1024
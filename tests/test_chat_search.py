@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def search(db, monkeypatch):
+    chat_search = server.ChatSearch("auto", 10, 160)
+    monkeypatch.setattr(server, "chat_search", chat_search)
+    monkeypatch.setattr(server, "chat_archive", server.ChatArchive(30, 8))
+    return chat_search
+
+
+async def store(db, user_id, message, response, days_ago=0):
+    document = server.ChatMessage(user_id=user_id, message=message, response=response).dict()
+    document["timestamp"] = datetime.now(timezone.utc) - timedelta(days=days_ago)
+    await db.chat_messages.insert_one(document)
+    return document["id"]
+
+
+async def test_ranks_matches_across_hot_and_archived_messages(api, db, user, search):
+    in_message = await store(db, user.id, "how do I bake sourdough bread", "with patience")
+    in_response = await store(db, user.id, "what's for dinner", "maybe some bread", days_ago=90)
+    both_terms = await store(db, user.id, "sourdough bread starter tips", "feed the sourdough daily", days_ago=120)
+    await store(db, user.id, "unrelated", "nothing here")
+    await store(db, "someone-else", "sourdough bread", "sourdough bread")
+    await server.chat_archive.archive()
+
+    results = (await api.get("/api/chat/search", params={"q": "sourdough bread"})).json()["results"]
+
+    assert [result["id"] for result in results] == [both_terms, in_message, in_response]
+    assert [result["archived"] for result in results] == [True, False, True]
+    highlight = results[1]["snippet"]
+    assert [highlight["text"][start:end] for start, end in highlight["highlights"]] == ["sourdough", "bread"]
+
+
+async def test_cursor_pages_through_every_match_once(api, db, user, search):
+    for index in range(7):
+        await store(db, user.id, f"note {index} about gardening", "ok", days_ago=index * 20)
+    await server.chat_archive.archive()
+    everything = (await api.get("/api/chat/search", params={"q": "gardening", "limit": 50})).json()
+
+    paged, cursor = [], None
+    while True:
+        params = {"q": "gardening", "limit": 3}
+        if cursor:
+            params["after"] = cursor
+        page = (await api.get("/api/chat/search", params=params)).json()
+        paged += [result["id"] for result in page["results"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert paged == [result["id"] for result in everything["results"]]
+    assert len(set(paged)) == 7
+
+
+async def test_new_messages_are_searchable_once_the_index_is_built(api, db, user, search):
+    await store(db, user.id, "first note", "about kites")
+    assert len((await api.get("/api/chat/search", params={"q": "kites"})).json()["results"]) == 1
+
+    await api.post("/api/chat", json={"message": "more kites please", "bypass_cache": True})
+
+    results = (await api.get("/api/chat/search", params={"q": "kites"})).json()["results"]
+    assert [result["message"] for result in results] == ["more kites please", "first note"]
+
+
+async def test_empty_query_is_rejected(api, user, search):
+    assert (await api.get("/api/chat/search", params={"q": "  "})).status_code == 400
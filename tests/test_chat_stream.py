@@ -0,0 +1,57 @@
+import asyncio
+
+import orjson
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def slow_llm(monkeypatch):
+    monkeypatch.setenv("MOCK_LLM_CHUNK_SIZE", "4")
+    monkeypatch.setenv("MOCK_LLM_CHUNK_DELAY", "0.02")
+
+
+def events(body: bytes):
+    for frame in body.decode().strip().split("\n\n"):
+        event, data = frame.split("\n")
+        yield event[len("event: "):], orjson.loads(data[len("data: "):])
+
+
+async def test_stream_sends_tokens_then_done_and_stores_the_reply(api, db, user):
+    async with api.stream("POST", "/api/chat/stream", json={"message": "hello", "bypass_cache": True}) as response:
+        assert response.headers["content-type"].startswith("text/event-stream")
+        body = b"".join([chunk async for chunk in response.aiter_bytes()])
+
+    received = list(events(body))
+    assert [event for event, _ in received[:-1]] == ["token"] * (len(received) - 1)
+    event, done = received[-1]
+    assert event == "done"
+    stored = await db.chat_messages.find_one({"id": done["message_id"]})
+    assert stored["response"] == "".join(data["text"] for _, data in received[:-1])
+    assert stored["conversation_id"] == done["conversation_id"]
+
+
+async def test_partial_reply_is_stored_when_the_client_disconnects(db, user, slow_llm):
+    response = await server.stream_chat_with_farha(
+        server.ChatRequest(message="tell me a long story", bypass_cache=True), current_user=user
+    )
+    received = []
+
+    async def client():
+        async for frame in response.body_iterator:
+            received.append(frame)
+
+    reading = asyncio.create_task(client())
+    while len(received) < 2:
+        await asyncio.sleep(0.005)
+    # The server cancels the response task when the client goes away
+    reading.cancel()
+    await asyncio.gather(reading, return_exceptions=True)
+
+    stored = await db.chat_messages.find_one({"user_id": user.id})
+    sent = "".join(data["text"] for _, data in events("".join(received).encode()))
+    assert stored["response"].startswith(sent)
+    assert 0 < len(stored["response"]) < len("Local AI mock reply to: tell me a long story")
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def write_buffer(db, monkeypatch):
+    # Batches never fill and the flush interval never fires, so nothing is written before drain()
+    buffer = server.ChatWriteBuffer(100, 60, 1000, 1, 0)
+    monkeypatch.setattr(server, "chat_write_buffer", buffer)
+    return buffer
+
+
+async def test_chat_is_readable_before_it_is_written(api, user, db, write_buffer):
+    reply = (await api.post("/api/chat", json={"message": "remember me", "bypass_cache": True})).json()
+
+    assert await db.chat_messages.count_documents({}) == 0
+    assert [document["id"] for document in write_buffer.pending_for(user.id)] == [reply["message_id"]]
+
+    history = (await api.get("/api/chat/history")).json()
+    assert [message["id"] for message in history["messages"]] == [reply["message_id"]]
+    assert history["messages"][0]["message"] == "remember me"
+
+    await write_buffer.drain()
+
+    assert await db.chat_messages.count_documents({"id": reply["message_id"]}) == 1
+    history = (await api.get("/api/chat/history")).json()
+    assert [message["id"] for message in history["messages"]] == [reply["message_id"]]
+
+
+async def test_history_merges_buffered_and_written_messages_newest_first(api, user, db, write_buffer):
+    async def chat(index):
+        # Stored timestamps have millisecond precision; keep these distinct so the order is deterministic
+        await asyncio.sleep(0.002)
+        return (await api.post("/api/chat", json={"message": f"m{index}", "bypass_cache": True})).json()["message_id"]
+
+    ids = [await chat(index) for index in range(3)]
+    await write_buffer.drain()
+    ids += [await chat(index) for index in range(3, 5)]
+
+    history = (await api.get("/api/chat/history")).json()
+
+    assert [message["id"] for message in history["messages"]] == ids[::-1]
+
+
+async def test_drain_writes_everything_and_stops(db, write_buffer):
+    documents = [
+        server.prepare_for_mongo(server.ChatMessage(user_id="u1", message=f"m{index}", response="r").dict())
+        for index in range(250)
+    ]
+    for document in documents:
+        await write_buffer.add(document)
+
+    await write_buffer.drain()
+
+    assert await db.chat_messages.count_documents({"user_id": "u1"}) == 250
+    assert write_buffer.pending_for("u1") == []
+    assert write_buffer.stats() == {"buffered": 0, "pending": 0, "written": 250, "failed": 0, "batches": 3}
+    assert write_buffer._task.done()
+
+
+async def test_drain_skips_documents_an_earlier_attempt_already_wrote(db, write_buffer):
+    document = server.prepare_for_mongo(server.ChatMessage(user_id="u1", message="m", response="r").dict())
+    await db.chat_messages.create_index("id", unique=True)
+    await db.chat_messages.insert_one(dict(document))
+
+    await write_buffer.add(document)
+    await write_buffer.drain()
+
+    assert await db.chat_messages.count_documents({"id": document["id"]}) == 1
+    assert write_buffer.stats()["failed"] == 0
+
+
+async def test_retry_after_an_applied_but_unacknowledged_batch_stores_no_duplicates(db, write_buffer, monkeypatch):
+    # No unique index on id: the retry must not depend on one
+    collection_class = type(db.chat_messages)
+    original = collection_class.insert_many
+    calls = 0
+
+    async def applied_then_lost(self, documents, **kwargs):
+        nonlocal calls
+        calls += 1
+        result = await original(self, documents, **kwargs)
+        if calls == 1:
+            raise AutoReconnect("connection closed before the reply")
+        return result
+
+    monkeypatch.setattr(collection_class, "insert_many", applied_then_lost)
+    documents = [
+        server.prepare_for_mongo(server.ChatMessage(user_id="u1", message=f"m{index}", response="r").dict())
+        for index in range(5)
+    ]
+    for document in documents:
+        await write_buffer.add(document)
+
+    await write_buffer.drain()
+
+    assert calls == 2
+    assert await db.chat_messages.count_documents({}) == 5
+    assert write_buffer.stats()["written"] == 5 and write_buffer.stats()["failed"] == 0
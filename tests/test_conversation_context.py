@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def contexts(monkeypatch):
+    cache = server.ConversationContextCache(10)
+    monkeypatch.setattr(server, "conversation_contexts", cache)
+    return cache
+
+
+def test_oldest_turns_fold_into_the_summary_to_fit_the_budget():
+    context = server.ConversationContext(token_budget=100, summary_token_budget=1000)
+    for index in range(10):
+        context.add_turn(f"question {index} " + "x" * 80, f"answer {index} " + "y" * 80)
+
+    assert context.turn_tokens <= 100
+    assert context.turns[-1][0].startswith("question 9")
+    assert len(context.summary) == 10 - len(context.turns)
+    rendered = context.render("System")
+    assert "question 0" in rendered and "question 9" in rendered
+
+
+async def test_follow_up_reuses_the_cached_context(api, user, contexts):
+    first = (await api.post("/api/chat", json={"message": "hello", "bypass_cache": True})).json()
+    cached = await contexts.get(user.id, first["conversation_id"])
+
+    await api.post("/api/chat", json={"message": "again", "conversation_id": first["conversation_id"], "bypass_cache": True})
+
+    context = await contexts.get(user.id, first["conversation_id"])
+    assert context is cached
+    assert [turn[0] for turn in context.turns] == ["hello", "again"]
+
+
+async def test_turn_written_by_another_worker_rebuilds_the_context(api, db, user, contexts):
+    first = (await api.post("/api/chat", json={"message": "hello", "bypass_cache": True})).json()
+    cached = await contexts.get(user.id, first["conversation_id"])
+    await asyncio.sleep(0.002)
+    elsewhere = server.ChatMessage(
+        user_id=user.id, message="from elsewhere", response="r", conversation_id=first["conversation_id"]
+    )
+    await db.chat_messages.insert_one(elsewhere.dict())
+
+    context = await contexts.get(user.id, first["conversation_id"])
+
+    assert context is not cached
+    assert [turn[0] for turn in context.turns] == ["hello", "from elsewhere"]
+    assert context.newest_id == elsewhere.id
@@ -0,0 +1,114 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def stored_user(db, user):
+    await db.users.insert_one(server.prepare_for_mongo(user.dict()))
+    return user
+
+
+async def chat(api, message):
+    # Stored timestamps have millisecond precision; keep consecutive messages apart
+    await asyncio.sleep(0.002)
+    return (await api.post("/api/chat", json={"message": message, "bypass_cache": True})).json()
+
+
+async def test_history_is_not_modified_until_a_new_message(api, stored_user):
+    await chat(api, "first")
+    first = await api.get("/api/chat/history")
+    etag = first.headers["etag"]
+
+    repeat = await api.get("/api/chat/history", headers={"If-None-Match": etag})
+    assert repeat.status_code == 304
+    assert repeat.content == b""
+
+    await chat(api, "second")
+    changed = await api.get("/api/chat/history", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+
+
+async def test_importing_older_messages_invalidates_cached_history(api, db, stored_user):
+    # A minute old, so Last-Modified (whole seconds) can tell it from the import
+    current = server.ChatMessage(user_id=stored_user.id, message="current", response="r").dict()
+    current["timestamp"] = datetime.now(timezone.utc) - timedelta(minutes=1)
+    await db.chat_messages.insert_one(current)
+    cached = await api.get("/api/chat/history")
+    older = server.ChatMessage(user_id=stored_user.id, message="imported", response="r").dict()
+    older["timestamp"] = datetime.now(timezone.utc) - timedelta(days=20)
+
+    await api.post("/api/chat/import", content=orjson.dumps(older))
+
+    for validator in ({"If-None-Match": cached.headers["etag"]}, {"If-Modified-Since": cached.headers["last-modified"]}):
+        response = await api.get("/api/chat/history", headers=validator)
+        assert response.status_code == 200
+        assert [message["message"] for message in response.json()["messages"]] == ["current", "imported"]
+
+
+async def test_merging_duplicate_users_invalidates_cached_history(api, db, stored_user):
+    await chat(api, "kept")
+    cached = await api.get("/api/chat/history")
+    duplicate = server.User(email=stored_user.email, name="Duplicate")
+    duplicate_document = server.prepare_for_mongo(duplicate.dict())
+    duplicate_document["created_at"] = stored_user.created_at + timedelta(seconds=1)
+    await db.users.insert_one(duplicate_document)
+    older = server.ChatMessage(user_id=duplicate.id, message="from the duplicate", response="r").dict()
+    older["timestamp"] = datetime.now(timezone.utc) - timedelta(days=1)
+    await db.chat_messages.insert_one(older)
+
+    await server.merge_duplicate_users()
+
+    response = await api.get("/api/chat/history", headers={"If-None-Match": cached.headers["etag"]})
+    assert response.status_code == 200
+    assert len(response.json()["messages"]) == 2
+
+
+@pytest.fixture
+async def audio_url(api, user, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "tts_audio_cache", server.TTSAudioCache(tmp_path, 16 * 1024 * 1024))
+    return (await api.post("/api/voice/tts", json={"text": "Hello there, this is a test."})).json()["audio_url"]
+
+
+async def test_audio_ranges_and_validators(api, audio_url):
+    full = await api.get(audio_url)
+    size = len(full.content)
+    etag = full.headers["etag"]
+
+    partial = await api.get(audio_url, headers={"Range": "bytes=10-19"})
+    assert partial.status_code == 206
+    assert partial.content == full.content[10:20]
+    assert partial.headers["content-range"] == f"bytes 10-19/{size}"
+
+    suffix = await api.get(audio_url, headers={"Range": "bytes=-5"})
+    assert suffix.content == full.content[-5:]
+
+    unsatisfiable = await api.get(audio_url, headers={"Range": f"bytes={size}-"})
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers["content-range"] == f"bytes */{size}"
+
+    stale_if_range = await api.get(audio_url, headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+    assert stale_if_range.status_code == 200 and len(stale_if_range.content) == size
+
+    not_modified = await api.get(audio_url, headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+
+
+async def test_large_json_is_compressed_and_audio_is_not(api, stored_user, audio_url):
+    for index in range(20):
+        await chat(api, f"message {index} " + "padding " * 20)
+
+    history = await api.get("/api/chat/history", headers={"Accept-Encoding": "gzip"})
+    assert history.headers["content-encoding"] == "gzip"
+    assert "accept-encoding" in history.headers["vary"].lower()
+    assert len(history.json()["messages"]) == 20
+
+    audio = await api.get(audio_url, headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in audio.headers
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_slots_are_handed_out_round_robin_across_users():
+    scheduler = server.LLMScheduler(1, 10, 5, 0, 1, 100)
+    order = []
+    release_holder = asyncio.Event()
+
+    async def holder():
+        async with scheduler.slot("a"):
+            await release_holder.wait()
+
+    async def call(user_id, label):
+        async with scheduler.slot(user_id):
+            order.append(label)
+
+    holding = asyncio.create_task(holder())
+    await asyncio.sleep(0)
+    # "a" queues three calls before "b" and "c" queue one each
+    waiting = [asyncio.create_task(call(user_id, label))
+               for user_id, label in (("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1"))]
+    await asyncio.sleep(0)
+    assert scheduler.queued == 5
+
+    release_holder.set()
+    await asyncio.gather(holding, *waiting)
+
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+    assert scheduler.active == 0 and scheduler.queued == 0
+
+
+async def test_rate_limited_user_gets_429_with_retry_after():
+    scheduler = server.LLMScheduler(10, 10, 5, 0.5, 2, 100)
+    scheduler.admit("u")
+    scheduler.admit("u")
+
+    with pytest.raises(HTTPException) as rejected:
+        scheduler.admit("u")
+
+    assert rejected.value.status_code == 429
+    assert rejected.value.headers["Retry-After"] == "2"
+    assert scheduler.rejections["rate_limited"].value == 1
+    # Another user's bucket is untouched
+    scheduler.admit("v")
+
+
+async def test_full_queue_gets_503_with_retry_after():
+    scheduler = server.LLMScheduler(1, 1, 5, 0, 1, 100)
+    release_holder = asyncio.Event()
+
+    async def holder():
+        async with scheduler.slot("a"):
+            await release_holder.wait()
+
+    holding = asyncio.create_task(holder())
+    await asyncio.sleep(0)
+    queued = asyncio.create_task(scheduler.acquire("b"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(HTTPException) as rejected:
+        scheduler.admit("c")
+
+    assert rejected.value.status_code == 503
+    assert int(rejected.value.headers["Retry-After"]) >= 1
+    assert scheduler.rejections["queue_full"].value == 1
+
+    release_holder.set()
+    await asyncio.gather(holding, queued)
+    scheduler.release()
+    assert scheduler.active == 0 and scheduler.queued == 0
+
+
+async def test_queue_timeout_gets_503_and_frees_the_waiter():
+    scheduler = server.LLMScheduler(1, 10, 0.05, 0, 1, 100)
+    release_holder = asyncio.Event()
+
+    async def holder():
+        async with scheduler.slot("a"):
+            await release_holder.wait()
+
+    holding = asyncio.create_task(holder())
+    await asyncio.sleep(0)
+
+    with pytest.raises(HTTPException) as rejected:
+        await scheduler.acquire("b")
+
+    assert rejected.value.status_code == 503
+    assert "Retry-After" in rejected.value.headers
+    assert scheduler.queued == 0
+    release_holder.set()
+    await holding
+    assert scheduler.active == 0
+
+
+async def test_chat_endpoint_returns_429_with_retry_after(api, user, monkeypatch):
+    monkeypatch.setattr(server, "llm_scheduler", server.LLMScheduler(4, 4, 5, 0.5, 1, 100))
+
+    first = await api.post("/api/chat", json={"message": "hello", "bypass_cache": True})
+    second = await api.post("/api/chat", json={"message": "hello again", "bypass_cache": True})
+
+    assert first.status_code == 200
+    assert second.status_code == 429
+    assert second.headers["retry-after"] == "2"
@@ -0,0 +1,45 @@
+import asyncio
+from datetime import datetime
+
+import orjson
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def write_buffer(db, monkeypatch):
+    # Nothing is written before drain()
+    buffer = server.ChatWriteBuffer(100, 60, 1000, 1, 0)
+    monkeypatch.setattr(server, "chat_write_buffer", buffer)
+    return buffer
+
+
+async def chat(api, message):
+    await asyncio.sleep(0.002)
+    return (await api.post("/api/chat", json={"message": message, "bypass_cache": True})).json()
+
+
+async def test_reply_timestamps_match_what_is_stored(api, db, user, write_buffer):
+    reply = await chat(api, "hello")
+    async with api.stream("POST", "/api/chat/stream", json={"message": "again", "bypass_cache": True}) as response:
+        body = b"".join([chunk async for chunk in response.aiter_bytes()])
+    done = orjson.loads(body.split(b"event: done\ndata: ")[1].split(b"\n")[0])
+    await write_buffer.drain()
+
+    stored = {document["id"]: document["timestamp"] async for document in db.chat_messages.find()}
+    for sent in (reply, done):
+        assert datetime.fromisoformat(sent["timestamp"]) == stored[sent["message_id"]]
+
+
+async def test_cursor_from_a_buffered_message_does_not_repeat_it_after_the_flush(api, user, write_buffer):
+    ids = [(await chat(api, f"m{index}"))["message_id"] for index in range(3)]
+    first = (await api.get("/api/chat/history", params={"limit": 2})).json()
+    assert [message["id"] for message in first["messages"]] == ids[:0:-1]
+
+    await write_buffer.drain()
+    rest = (await api.get("/api/chat/history", params={"limit": 2, "before": first["next_cursor"]})).json()
+
+    assert [message["id"] for message in rest["messages"]] == ids[:1]
@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def session_cache(monkeypatch):
+    cache = server.SessionCache(100, 60)
+    monkeypatch.setattr(server, "session_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def login(db, monkeypatch):
+    async def fetch_auth_session_data(session_id):
+        return httpx.Response(200, json={
+            "email": "sessions@example.com", "name": "Sessions", "session_token": f"token-{session_id}"
+        })
+
+    monkeypatch.setattr(server, "fetch_auth_session_data", fetch_auth_session_data)
+
+    async def log_in(session_id):
+        # created_at orders the cap's eviction and is stored at millisecond precision
+        await asyncio.sleep(0.002)
+        return await server.exchange_session(session_id)
+    return log_in
+
+
+async def expires_at(db, token):
+    return (await db.auth_sessions.find_one({"session_token": token}))["expires_at"]
+
+
+async def test_session_cap_evicts_the_oldest_sessions(db, login, session_cache, monkeypatch):
+    monkeypatch.setattr(server, "SESSION_MAX_PER_USER", 3)
+    await login("s0")
+    await server.resolve_session_user("token-s0")
+
+    for index in range(1, 5):
+        await login(f"s{index}")
+
+    assert sorted([session["session_token"] async for session in db.auth_sessions.find()]) == [
+        "token-s2", "token-s3", "token-s4"
+    ]
+    # Evicted sessions are dropped from the cache too, not just from the collection
+    with pytest.raises(server.HTTPException) as rejected:
+        await server.resolve_session_user("token-s0")
+    assert rejected.value.status_code == 401
+
+
+async def test_sliding_expiry_refreshes_at_most_once_per_interval(db, login, session_cache, monkeypatch):
+    monkeypatch.setattr(server, "SESSION_SLIDING_EXPIRATION", True)
+    monkeypatch.setattr(server, "SESSION_REFRESH_INTERVAL_SECONDS", 60)
+    await login("s1")
+    fresh = await expires_at(db, "token-s1")
+
+    await server.resolve_session_user("token-s1")
+    assert await expires_at(db, "token-s1") == fresh
+
+    # Last refreshed two minutes ago: the next request slides it forward, in the DB and the cache
+    stale = fresh - timedelta(minutes=2)
+    await db.auth_sessions.update_one({"session_token": "token-s1"}, {"$set": {"expires_at": stale}})
+    session_cache.invalidate("token-s1")
+    await server.resolve_session_user("token-s1")
+
+    refreshed = await expires_at(db, "token-s1")
+    assert refreshed > stale + timedelta(seconds=60)
+    assert session_cache.expires_at("token-s1") == refreshed
+
+
+async def test_sweeper_deletes_only_expired_sessions(db, login, session_cache):
+    for index in range(5):
+        await login(f"s{index}")
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await db.auth_sessions.update_many(
+        {"session_token": {"$in": ["token-s0", "token-s1", "token-s2"]}}, {"$set": {"expires_at": past}}
+    )
+
+    swept = await server.SessionSweeper(60, batch_size=2).sweep()
+
+    assert swept == 3
+    assert sorted([session["session_token"] async for session in db.auth_sessions.find()]) == ["token-s3", "token-s4"]
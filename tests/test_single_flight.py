@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_cancelled_leader_does_not_cancel_waiters():
+    flight = server.SingleFlight()
+    started = asyncio.Event()
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        started.set()
+        await asyncio.sleep(0.05)
+        return "done"
+
+    leader = asyncio.create_task(flight.run("key", work))
+    await started.wait()
+    waiter = asyncio.create_task(flight.run("key", work))
+    await asyncio.sleep(0)
+
+    leader.cancel()
+
+    assert await waiter == "done"
+    assert leader.cancelled()
+    assert calls == 1
+    assert "key" not in flight
+
+
+async def test_failure_is_shared_with_waiters_and_not_kept():
+    flight = server.SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream down")
+
+    results = await asyncio.gather(flight.run("key", fail), flight.run("key", fail), return_exceptions=True)
+
+    assert [type(result) for result in results] == [ValueError, ValueError]
+    assert len(flight) == 0
+
+
+async def test_session_exchange_survives_cancelled_leader():
+    coalescer = server.SessionExchangeCoalescer(60, 10)
+    started = asyncio.Event()
+
+    async def exchange(session_id):
+        started.set()
+        await asyncio.sleep(0.05)
+        return {"user": {"id": "u1"}, "session_token": f"token-for-{session_id}"}
+
+    leader = asyncio.create_task(coalescer.run("s1", exchange))
+    await started.wait()
+    waiter = asyncio.create_task(coalescer.run("s1", exchange))
+    await asyncio.sleep(0)
+
+    leader.cancel()
+
+    assert (await waiter)["session_token"] == "token-for-s1"
+    assert coalescer.stats() == {"exchanges": 1, "coalesced": 1, "cache_hits": 0, "cached": 1, "inflight": 0}
+    # The finished exchange is cached even though the caller that started it went away
+    assert (await coalescer.run("s1", exchange))["session_token"] == "token-for-s1"
+    assert coalescer.stats()["exchanges"] == 1
+
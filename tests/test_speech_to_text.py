@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    def install(latency=0.0):
+        transcription_pool = server.TranscriptionPool(server.FakeSpeechTranscriber(latency=latency), 2, 4, 600)
+        monkeypatch.setattr(server, "transcription_pool", transcription_pool)
+        return transcription_pool
+    return install
+
+
+def upload(size: int = 4096):
+    return {"audio_file": ("turn.webm", b"\0" * size, "audio/webm")}
+
+
+async def poll(api, url):
+    for _ in range(100):
+        job = (await api.get(url)).json()
+        if job["status"] != "queued":
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError("job never finished")
+
+
+async def test_sync_transcription(api, user, pool):
+    pool()
+    response = await api.post("/api/voice/stt", files=upload())
+    assert response.json() == {"transcribed_text": "Hello F.A.R.H.A", "filename": "turn.webm"}
+
+
+async def test_oversized_upload_is_rejected_by_content_length(api, user, pool, monkeypatch):
+    pool()
+    monkeypatch.setattr(server, "STT_MAX_UPLOAD_BYTES", 1024)
+    response = await api.post("/api/voice/stt", files=upload(server.STT_MULTIPART_OVERHEAD_BYTES + 4096))
+    assert response.status_code == 413
+
+
+async def test_oversized_upload_is_rejected_while_streaming(api, user, pool, monkeypatch):
+    pool()
+    monkeypatch.setattr(server, "STT_MAX_UPLOAD_BYTES", 1024)
+    boundary = "upload-boundary"
+    head = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"audio_file\"; filename=\"turn.webm\"\r\n"
+        "Content-Type: audio/webm\r\n\r\n"
+    ).encode()
+
+    async def body():
+        # No Content-Length: only the per-chunk check can stop it
+        yield head
+        for _ in range(16):
+            yield b"\0" * 1024
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    response = await api.post(
+        "/api/voice/stt", content=body(), headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    )
+    assert response.status_code == 413
+
+
+async def test_async_job_can_be_polled_from_another_worker(api, db, user, pool):
+    pool(latency=0.02)
+    submitted = await api.post("/api/voice/stt", params={"mode": "async"}, files=upload())
+    assert submitted.status_code == 202
+    url = submitted.headers["location"]
+    assert (await api.get(url)).json()["status"] == "queued"
+
+    await asyncio.sleep(0.1)
+    # A fresh pool shares nothing in memory with the one that ran the job
+    pool()
+    job = await poll(api, url)
+
+    assert job["status"] == "completed"
+    assert job["transcribed_text"] == "Hello F.A.R.H.A"
+
+
+async def test_jobs_are_private_to_their_user(api, db, user, pool):
+    pool()
+    url = (await api.post("/api/voice/stt", params={"mode": "async"}, files=upload())).headers["location"]
+    await db.stt_jobs.update_many({}, {"$set": {"user_id": "someone-else"}})
+
+    assert (await api.get(url)).status_code == 404
+
+
+async def test_job_left_queued_by_a_lost_worker_is_reported_failed(api, db, user, pool):
+    pool()
+    created = datetime.now(timezone.utc) - timedelta(seconds=server.STT_JOB_TIMEOUT_SECONDS + 1)
+    await db.stt_jobs.insert_one({
+        "job_id": "orphan", "user_id": user.id, "status": "queued", "filename": "turn.webm",
+        "transcribed_text": None, "error": None,
+        "created_at": created, "expires_at": created + timedelta(hours=1)
+    })
+
+    job = (await api.get("/api/voice/stt/jobs/orphan")).json()
+    assert job["status"] == "failed"
+
+
+async def test_shutdown_marks_running_jobs_failed(api, db, user, pool):
+    transcription_pool = pool(latency=0.5)
+    url = (await api.post("/api/voice/stt", params={"mode": "async"}, files=upload())).headers["location"]
+
+    await transcription_pool.shutdown()
+
+    job = (await api.get(url)).json()
+    assert job["status"] == "failed"
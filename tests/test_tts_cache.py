@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    audio_cache = server.TTSAudioCache(tmp_path, 10 * 1024 * 1024)
+    monkeypatch.setattr(server, "tts_audio_cache", audio_cache)
+    return audio_cache
+
+
+class CountingSynthesizer(server.FakeSpeechSynthesizer):
+    def __init__(self, latency=0.0):
+        super().__init__(latency=latency)
+        self.calls = 0
+        self.started = asyncio.Event()
+
+    async def synthesize(self, request):
+        self.calls += 1
+        self.started.set()
+        return await super().synthesize(request)
+
+
+def test_keys_are_keyed_by_the_server_secret(tmp_path):
+    request = server.TTSRequest(text="my private reply")
+    synthesizer = server.FakeSpeechSynthesizer()
+    params = [
+        synthesizer.name, request.text, request.voice_id, request.stability,
+        request.similarity_boost, request.style, request.use_speaker_boost
+    ]
+
+    key = server.TTSAudioCache(tmp_path / "a", 1024, "one secret").key_for(request, synthesizer)
+
+    assert key != hashlib.sha256(json.dumps(params).encode()).hexdigest()
+    assert key != server.TTSAudioCache(tmp_path / "b", 1024, "another secret").key_for(request, synthesizer)
+    # A generated secret is kept in the directory, so restarts and other workers agree on keys
+    generated = server.TTSAudioCache(tmp_path / "c", 1024).key_for(request, synthesizer)
+    assert server.TTSAudioCache(tmp_path / "c", 1024).key_for(request, synthesizer) == generated
+
+
+async def test_audio_is_served_privately(api, user, cache):
+    audio_url = (await api.post("/api/voice/tts", json={"text": "Hello there"})).json()["audio_url"]
+
+    response = await api.get(audio_url)
+
+    assert response.status_code == 200
+    assert response.headers["cache-control"].startswith("private")
+
+
+async def test_audio_evicted_before_it_is_read_is_404(api, user, cache, monkeypatch):
+    audio_url = (await api.post("/api/voice/tts", json={"text": "Hello there"})).json()["audio_url"]
+    entry = cache.get(audio_url.rsplit("/", 1)[1])
+    original_get = cache.get
+
+    def get_then_evict(key):
+        found = original_get(key)
+        entry.path.unlink()
+        return found
+
+    monkeypatch.setattr(cache, "get", get_then_evict)
+    response = await api.get(audio_url)
+
+    assert response.status_code == 404
+    assert cache.stats()["entries"] == 0 and cache.total_bytes == 0
+
+
+async def test_audio_resynthesizes_when_the_file_is_gone(cache):
+    synthesizer = CountingSynthesizer()
+    request = server.TTSRequest(text="Hello there")
+    entry, _ = await cache.get_or_synthesize(request, synthesizer)
+    original = server.TTSAudioCache.get_or_synthesize
+
+    async def evict_after_lookup(self, *args):
+        found = await original(self, *args)
+        if synthesizer.calls == 1:
+            found[0].path.unlink()
+        return found
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(server.TTSAudioCache, "get_or_synthesize", evict_after_lookup)
+        audio = await cache.audio(request, synthesizer)
+
+    assert audio[:4] == b"RIFF"
+    assert synthesizer.calls == 2
+    assert cache.total_bytes == len(audio)
+
+
+def test_partial_writes_are_not_indexed(tmp_path):
+    key = "a" * 64
+    (tmp_path / f"{key}.{'b' * 32}.wav").write_bytes(b"RIFF" + b"\0" * 60)
+    fresh = tmp_path / f"{'c' * 64}.{'d' * 32}.wav.1234abcd.tmp"
+    stale = tmp_path / f"{'e' * 64}.{'f' * 32}.wav.5678abcd.tmp"
+    fresh.write_bytes(b"partial")
+    stale.write_bytes(b"partial")
+    old = time.time() - 3600
+    os.utime(stale, (old, old))
+
+    cache = server.TTSAudioCache(tmp_path, 1024 * 1024)
+
+    assert cache.stats()["entries"] == 1
+    assert cache.get(key) is not None
+    assert fresh.exists() and not stale.exists()
+
+
+async def test_replacing_an_entry_keeps_the_byte_count(cache):
+    synthesizer = CountingSynthesizer()
+    request = server.TTSRequest(text="Hello there")
+    first, _ = await cache.get_or_synthesize(request, synthesizer)
+
+    replaced = await cache._synthesize(first.key, request.copy(update={"stability": 0.2}), synthesizer)
+
+    assert cache.total_bytes == replaced.size
+    assert not first.path.exists() and replaced.path.exists()
+    assert cache.stats()["entries"] == 1
+
+
+async def test_synthesis_survives_cancelled_leader(cache):
+    synthesizer = CountingSynthesizer(latency=0.05)
+    request = server.TTSRequest(text="Hello there")
+
+    leader = asyncio.create_task(cache.get_or_synthesize(request, synthesizer))
+    await synthesizer.started.wait()
+    waiter = asyncio.create_task(cache.get_or_synthesize(request, synthesizer))
+    await asyncio.sleep(0)
+
+    leader.cancel()
+    entry, cached = await waiter
+
+    assert cached is True
+    assert entry.path.exists() and entry.path.stat().st_size == entry.size
+    assert synthesizer.calls == 1
+    assert cache.stats()["entries"] == 1
+    assert (await cache.get_or_synthesize(request, synthesizer)) == (entry, True)
+    assert synthesizer.calls == 1
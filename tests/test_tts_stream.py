@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class CountingSynthesizer(server.FakeSpeechSynthesizer):
+    def __init__(self):
+        super().__init__(latency=0.01)
+        self.started = []
+
+    async def synthesize(self, request):
+        self.started.append(request.text)
+        return await super().synthesize(request)
+
+
+@pytest.fixture
+def synthesizer(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "tts_audio_cache", server.TTSAudioCache(tmp_path, 64 * 1024 * 1024))
+    monkeypatch.setattr(server, "TTS_STREAM_CONCURRENCY", 2)
+    return CountingSynthesizer()
+
+
+def sentences(count):
+    return [f"Sentence number {index} of the reply." for index in range(count)]
+
+
+async def test_stream_yields_every_chunk_in_order(synthesizer):
+    chunks = sentences(6)
+    request = server.TTSRequest(text=" ".join(chunks))
+
+    frames = [frame async for frame in server.stream_tts_chunks(request, chunks, synthesizer)]
+
+    assert frames[0] == synthesizer.stream_header()
+    expected = [synthesizer.stream_frames(synthesizer._render(request.copy(update={"text": text}))) for text in chunks]
+    assert frames[1:] == expected
+    assert synthesizer.started == chunks
+
+
+async def test_slow_client_bounds_synthesis_to_the_read_ahead_window(synthesizer):
+    chunks = sentences(10)
+    stream = server.stream_tts_chunks(server.TTSRequest(text=" ".join(chunks)), chunks, synthesizer)
+
+    await stream.__anext__()
+    await stream.__anext__()
+    # The client stops reading; nothing beyond the window may start meanwhile
+    await asyncio.sleep(0.1)
+
+    assert len(synthesizer.started) == 1 + 2
+    await stream.aclose()
+
+
+async def test_disconnect_stops_reading_ahead(synthesizer):
+    chunks = sentences(10)
+    stream = server.stream_tts_chunks(server.TTSRequest(text=" ".join(chunks)), chunks, synthesizer)
+
+    async def consume():
+        async for _ in stream:
+            await asyncio.sleep(1)
+
+    client = asyncio.create_task(consume())
+    await asyncio.sleep(0.005)
+    client.cancel()
+    await asyncio.gather(client, return_exceptions=True)
+    await stream.aclose()
+    await asyncio.sleep(0.05)
+
+    # Only the window already started finishes (into the cache); the rest of the reply never starts
+    assert len(synthesizer.started) <= 2
+    assert server.tts_audio_cache.stats()["entries"] <= 2
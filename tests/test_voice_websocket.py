@@ -0,0 +1,66 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import server
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    user = server.User(email="voice@example.com", name="Voice")
+
+    async def resolve_session_user(token):
+        if token != "good-token":
+            raise server.HTTPException(status_code=401, detail="Invalid session")
+        return user
+
+    monkeypatch.setattr(server, "resolve_session_user", resolve_session_user)
+    return TestClient(server.app)
+
+
+def close_code(ws) -> int:
+    with pytest.raises(WebSocketDisconnect) as closed:
+        ws.receive_json()
+    return closed.value.code
+
+
+def test_first_message_auth_then_a_full_turn(client):
+    with client.websocket_connect("/api/ws/voice") as ws:
+        ws.send_json({"type": "auth", "token": "good-token"})
+        assert ws.receive_json()["type"] == "ready"
+
+        ws.send_json({"type": "start"})
+        ws.send_bytes(b"\0" * 4096)
+        ws.send_json({"type": "end"})
+        events = []
+        while not events or events[-1] != "turn_end":
+            message = ws.receive()
+            if message.get("text"):
+                events.append(json.loads(message["text"])["type"])
+
+    assert events[0] == "transcript"
+    assert "token" in events and "audio" in events
+
+
+def test_token_in_the_query_string_is_not_accepted(client):
+    with client.websocket_connect("/api/ws/voice?token=good-token") as ws:
+        ws.send_json({"type": "start"})
+        assert close_code(ws) == 4401
+
+
+def test_wrong_token_is_rejected(client):
+    with client.websocket_connect("/api/ws/voice") as ws:
+        ws.send_json({"type": "auth", "token": "bad-token"})
+        assert close_code(ws) == 4401
+
+
+@pytest.mark.parametrize("first_frame", [b"\x00\x01binary", "not json", "[1, 2]"])
+def test_malformed_first_frame_closes_with_policy_violation(client, first_frame):
+    with client.websocket_connect("/api/ws/voice") as ws:
+        if isinstance(first_frame, bytes):
+            ws.send_bytes(first_frame)
+        else:
+            ws.send_text(first_frame)
+        assert close_code(ws) == 1008